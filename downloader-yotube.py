@@ -6,6 +6,9 @@ Requiere: pip install yt-dlp
 
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 try:
@@ -121,6 +124,161 @@ def descargar_solo_audio(url_playlist, carpeta_destino="Audio_YouTube"):
     return True
 
 
+class ProgresoAgregado:
+    """Progreso combinado de varias descargas simultáneas en una sola línea"""
+
+    def __init__(self, total, ya_descargados=0):
+        self.total = total
+        self.completados = ya_descargados
+        self.errores = 0
+        self.activos = {}  # indice -> (bytes descargados, bytes totales, velocidad)
+        self.lock = threading.Lock()
+        self.ultima_impresion = 0.0
+
+    def hook(self, indice):
+        def progreso(d):
+            with self.lock:
+                if d['status'] == 'downloading':
+                    total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+                    self.activos[indice] = (d.get('downloaded_bytes', 0), total, d.get('speed') or 0)
+                elif d['status'] == 'finished':
+                    self.activos.pop(indice, None)
+                self._imprimir()
+        return progreso
+
+    def terminar(self, indice, ok):
+        with self.lock:
+            self.activos.pop(indice, None)
+            if ok:
+                self.completados += 1
+            else:
+                self.errores += 1
+            self._imprimir(forzar=True)
+
+    def _imprimir(self, forzar=False):
+        ahora = time.monotonic()
+        if not forzar and ahora - self.ultima_impresion < 0.5:
+            return
+        self.ultima_impresion = ahora
+        descargado = sum(a[0] for a in self.activos.values())
+        total = sum(a[1] for a in self.activos.values())
+        velocidad = sum(a[2] for a in self.activos.values()) / 1024 / 1024
+        porcentaje = f"{100 * descargado / total:5.1f}%" if total else "  -  "
+        print(f"\r[{self.completados}/{self.total} completados, {self.errores} errores] "
+              f"Activos: {len(self.activos)} | {porcentaje} | {velocidad:.2f} MiB/s   ", end='', flush=True)
+
+
+def leer_registro(archivo_registro):
+    """Devuelve los IDs ya descargados según el archivo de registro de yt-dlp"""
+    if not os.path.exists(archivo_registro):
+        return set()
+    with open(archivo_registro, encoding='utf-8') as f:
+        return {linea.strip() for linea in f if linea.strip()}
+
+
+def descargar_playlist_paralelo(url_playlist, carpeta_destino="Descargas_YouTube", solo_audio=False, hilos=4):
+    """
+    Descarga una playlist con varias descargas simultáneas y reanudables
+
+    La playlist se resuelve una sola vez (extracción plana, sin tocar cada
+    video) y los elementos se reparten entre un grupo de hilos. Un archivo de
+    registro permite que al volver a ejecutar se omitan los ya descargados,
+    y los archivos .part incompletos se continúan en lugar de empezar de cero.
+
+    Args:
+        url_playlist: URL de la playlist de YouTube
+        carpeta_destino: Carpeta donde se guardarán los archivos
+        solo_audio: True para extraer solo el audio en MP3
+        hilos: Número máximo de descargas simultáneas
+    """
+
+    Path(carpeta_destino).mkdir(parents=True, exist_ok=True)
+    archivo_registro = os.path.join(carpeta_destino, 'descargados.txt')
+
+    try:
+        print(f"\n📥 Resolviendo playlist: {url_playlist}")
+        with yt_dlp.YoutubeDL({'extract_flat': 'in_playlist', 'quiet': True, 'ignoreerrors': True}) as ydl:
+            info = ydl.extract_info(url_playlist, download=False)
+    except Exception as e:
+        print(f"\n❌ Error al obtener la playlist: {str(e)}")
+        return False
+
+    if not info:
+        print("\n❌ No se pudo obtener la playlist")
+        return False
+
+    entradas = [e for e in (info.get('entries') or [info]) if e]
+    titulo = yt_dlp.utils.sanitize_filename(info.get('title') or 'Sin título')
+    registro = leer_registro(archivo_registro)
+
+    def ya_descargado(entrada):
+        # Sin extractor o ID se deja decidir a yt-dlp con el mismo registro
+        if not entrada.get('ie_key') or not entrada.get('id'):
+            return False
+        return yt_dlp.utils.make_archive_id(entrada['ie_key'], entrada['id']) in registro
+
+    pendientes = [
+        (indice, entrada) for indice, entrada in enumerate(entradas, start=1)
+        if not ya_descargado(entrada)
+    ]
+
+    print(f"✓ Playlist encontrada: {info.get('title', 'Sin título')}")
+    print(f"✓ Total: {len(entradas)} | Ya descargados: {len(entradas) - len(pendientes)} | Pendientes: {len(pendientes)}")
+    print(f"📁 Destino: {os.path.join(carpeta_destino, titulo)}\n")
+
+    if solo_audio:
+        formato = {
+            'format': 'bestaudio/best',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }],
+        }
+    else:
+        formato = {
+            'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
+            'postprocessors': [{
+                'key': 'FFmpegVideoConvertor',
+                'preferedformat': 'mp4',
+            }],
+        }
+
+    progreso = ProgresoAgregado(len(entradas), ya_descargados=len(entradas) - len(pendientes))
+
+    def descargar_entrada(indice, entrada):
+        opciones = dict(formato)
+        opciones.update({
+            # El índice va fijo porque cada video se descarga por separado
+            'outtmpl': os.path.join(carpeta_destino, titulo, f'{indice:03d} - %(title)s.%(ext)s'),
+            'download_archive': archivo_registro,
+            'continuedl': True,  # Reanudar archivos .part
+            'ignoreerrors': True,
+            'quiet': True,
+            'no_warnings': True,
+            'noprogress': True,
+            'progress_hooks': [progreso.hook(indice)],
+        })
+        with yt_dlp.YoutubeDL(opciones) as ydl:
+            return ydl.download([entrada.get('webpage_url') or entrada.get('url') or entrada['id']]) == 0
+
+    with ThreadPoolExecutor(max_workers=hilos) as grupo:
+        futuros = {grupo.submit(descargar_entrada, indice, entrada): indice for indice, entrada in pendientes}
+        for futuro in as_completed(futuros):
+            try:
+                ok = futuro.result()
+            except Exception:
+                ok = False
+            progreso.terminar(futuros[futuro], ok)
+
+    print("\n")
+    if progreso.errores:
+        print(f"⚠️  {progreso.errores} elementos fallaron; vuelve a ejecutar para reintentarlos")
+        return False
+    print("✅ ¡Descarga completada!")
+    return True
+
+
 def main():
     """Función principal"""
     print("=" * 60)
@@ -131,8 +289,10 @@ def main():
     print("\n¿Qué deseas descargar?")
     print("1. Video completo (MP4)")
     print("2. Solo audio (MP3)")
+    print("3. Video completo (MP4) - descarga paralela y reanudable")
+    print("4. Solo audio (MP3) - descarga paralela y reanudable")
     
-    opcion = input("\nElige una opción (1 o 2): ").strip()
+    opcion = input("\nElige una opción (1-4): ").strip()
     
     # Solicitar URL de la playlist
     url = input("\nPega la URL de la playlist de YouTube: ").strip()
@@ -151,6 +311,11 @@ def main():
     elif opcion == "2":
         carpeta = carpeta or "Audio_YouTube"
         descargar_solo_audio(url, carpeta)
+    elif opcion in ("3", "4"):
+        solo_audio = opcion == "4"
+        carpeta = carpeta or ("Audio_YouTube" if solo_audio else "Descargas_YouTube")
+        hilos = input("\nDescargas simultáneas (Enter para 4): ").strip()
+        descargar_playlist_paralelo(url, carpeta, solo_audio=solo_audio, hilos=int(hilos) if hilos.isdigit() else 4)
     else:
         print("❌ Opción no válida")
 
@@ -1,14 +1,52 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Response, stream_with_context, send_file, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
+from werkzeug.wsgi import wrap_file
+import click
 import os
+import re
+import shutil
+import sys
+import base64
+import copy
+import functools
+import json
+import mimetypes
+import socket
+import struct
+import subprocess
+import tarfile
+import tempfile
 import threading
+import time
+import zlib
+import hashlib
 import yt_dlp
 from pathlib import Path
 import glob
-from datetime import datetime
+from array import array
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import quote, urlsplit, urlunsplit, parse_qsl, urlencode
 from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateColumn
+
+try:
+    import fcntl # optional: coalesces variant transcodes and tracks live metrics writers across workers
+except ImportError:
+    fcntl = None
+
+try:
+    import mutagen # optional: reads tags of files added by /files/sync
+except ImportError:
+    mutagen = None
 
 # Load environment variables
 load_dotenv()
@@ -18,6 +56,94 @@ app = Flask(__name__)
 # Secret key from environment
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-prod')
 
+# Metrics: each process keeps its own counters and histograms and writes
+# them to METRICS_DIR; /metrics merges every process's file, so the numbers
+# cover all gunicorn workers whichever one answers the scrape. Totals of
+# exited processes are folded into one retired file, so counters never go
+# backwards when workers restart.
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'media-player-metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '1'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') # if set, /metrics requires 'Authorization: Bearer <token>'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS = {
+    # name: (type, help, histogram buckets)
+    'http_request_duration_seconds': ('histogram', 'Request latency by route', LATENCY_BUCKETS),
+    'http_request_db_queries': ('histogram', 'SQL statements per request by route', (0, 1, 2, 3, 5, 10, 20, 50, 100)),
+    'db_query_duration_seconds': ('histogram', 'SQL statement latency by route (background for non-request work)',
+                                  (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)),
+    'db_pool_checkout_wait_seconds': ('histogram', 'Time waiting for a pooled database connection',
+                                      (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)),
+    'ffmpeg_duration_seconds': ('histogram', 'Wall time of ffmpeg work by task', (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)),
+    'download_bytes_total': ('counter', 'Bytes fetched by the download stage', None),
+    'pipeline_stage_items_total': ('counter', 'Items finished by pipeline stage and result', None),
+    'pipeline_stage_bytes_total': ('counter', 'Input bytes processed by pipeline stage', None),
+    'pipeline_stage_busy_seconds_total': ('counter', 'Time spent working by pipeline stage', None),
+    'pipeline_stage_queued': ('gauge', 'Items waiting for a pipeline stage', None),
+    'pipeline_stage_active': ('gauge', 'Items in progress in a pipeline stage', None),
+    'db_pool_checked_out': ('gauge', 'Database connections in use', None),
+    'db_pool_size': ('gauge', 'Configured database connections', None),
+    'download_jobs': ('gauge', 'Download jobs by active status', None),
+    'library_files': ('gauge', 'Files in DOWNLOAD_FOLDER as of the last reconciliation', None),
+    'library_bytes': ('gauge', 'Bytes in DOWNLOAD_FOLDER as of the last reconciliation', None),
+    'user_storage_bytes': ('gauge', 'Sum of per-user storage counters', None),
+    'disk_free_bytes': ('gauge', 'Free space on the DOWNLOAD_FOLDER filesystem', None),
+    'disk_total_bytes': ('gauge', 'Size of the DOWNLOAD_FOLDER filesystem', None),
+}
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms for this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float) # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(buckets)] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), list(series)] for (name, labels), series in self.histograms.items()],
+            }
+
+metrics = MetricsRegistry()
+
+@contextmanager
+def timed_ffmpeg(task):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('ffmpeg_duration_seconds', time.perf_counter() - started, task=task)
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe('db_pool_checkout_wait_seconds', time.perf_counter() - started)
+
 # Database configuration
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
@@ -30,6 +156,7 @@ if DATABASE_URL:
     
     # PostgreSQL connection pool settings
     app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': TimedQueuePool,
         'pool_size': 10,
         'pool_recycle': 3600,
         'pool_pre_ping': True
@@ -37,6 +164,7 @@ if DATABASE_URL:
 else:
     # Development: SQLite
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///media.db'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': TimedQueuePool}
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
@@ -48,11 +176,64 @@ login_manager.login_view = 'login'
 DOWNLOAD_FOLDER = os.environ.get('DOWNLOAD_FOLDER', os.path.join(app.root_path, 'static', 'downloads'))
 Path(DOWNLOAD_FOLDER).mkdir(parents=True, exist_ok=True)
 
+# Media streaming: set MEDIA_ACCEL_REDIRECT to an nginx `internal` location
+# aliased to DOWNLOAD_FOLDER, or USE_X_SENDFILE for Apache/lighttpd.
+MEDIA_ACCEL_REDIRECT = os.environ.get('MEDIA_ACCEL_REDIRECT')
+MEDIA_CACHE_MAX_AGE = int(os.environ.get('MEDIA_CACHE_MAX_AGE', '3600'))
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+
+FILES_PAGE_SIZE = 200
+FILES_MAX_PAGE_SIZE = 1000
+
+# Benchmarking: report the number of SQL statements each request ran in an
+# X-Query-Count response header (see bench/loadtest.py)
+QUERY_COUNT_HEADER = os.environ.get('QUERY_COUNT_HEADER', '').lower() in ('1', 'true', 'yes')
+
+def _metrics_route():
+    if not has_request_context():
+        return 'background'
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+with app.app_context():
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def _before_query(conn, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+        if has_request_context():
+            g.query_count = g.get('query_count', 0) + 1
+
+    @event.listens_for(db.engine, 'after_cursor_execute')
+    def _after_query(conn, cursor, statement, parameters, context, executemany):
+        metrics.observe('db_query_duration_seconds', time.perf_counter() - context._query_started,
+                        route=_metrics_route())
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = _metrics_route()
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_started,
+                    method=request.method, route=route, status=str(response.status_code))
+    metrics.observe('http_request_db_queries', g.get('query_count', 0), route=route)
+    if QUERY_COUNT_HEADER:
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+    return response
+
 # --- Models ---
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(120), nullable=False)
+    # Bumped whenever the user's media rows change; backs the /files ETag
+    library_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Sum of the user's Media.size_bytes, kept in step with every media insert/delete
+    storage_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    storage_quota_bytes = db.Column(db.BigInteger) # None: STORAGE_QUOTA_BYTES applies
+    # Part of the session ID; bumping it signs out every session of the user
+    session_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Oldest /sync/changes cursor still served; raised when tombstones are pruned
+    sync_floor = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
     media_items = db.relationship('Media', backref='owner', lazy=True)
     playlists = db.relationship('Playlist', backref='owner', lazy=True)
 
@@ -62,7 +243,17 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def get_id(self):
+        return f"{self.id}:{self.session_version or 0}"
+
 class Media(db.Model):
+    __table_args__ = (
+        db.Index('ix_media_user_created', 'user_id', 'created_at'),
+        db.Index('ix_media_user_filename', 'user_id', 'filename'),
+        db.Index('ix_media_filename', 'filename'),
+        db.Index('ix_media_user_last_played', 'user_id', 'last_played_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
@@ -71,159 +262,2606 @@ class Media(db.Model):
     type = db.Column(db.String(10)) # 'video' or 'audio'
     path = db.Column(db.String(500))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    blob_id = db.Column(db.Integer, db.ForeignKey('media_blob.id'), index=True) # None for files added by sync
+    missing = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false()) # file gone from disk
+    tags = db.Column(db.Text) # artist/album/genre etc., indexed by /search
+    size_bytes = db.Column(db.BigInteger) # counted against the owner's storage_bytes
+    last_played_at = db.Column(db.DateTime) # None: never played; evicted first
+    cover_hash = db.Column(db.String(64)) # thumbnails in COVER_FOLDER; None: not extracted, '': no artwork
 
 class Playlist(db.Model):
+    __table_args__ = (db.Index('ux_playlist_user_name', 'user_id', 'name', unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
     items = db.relationship('PlaylistItem', backref='playlist', cascade="all, delete-orphan", lazy=True)
 
 class PlaylistItem(db.Model):
+    __table_args__ = (db.Index('ux_playlist_item_playlist_media', 'playlist_id', 'media_id', unique=True),
+                      db.Index('ix_playlist_item_position', 'playlist_id', 'position'))
+
     id = db.Column(db.Integer, primary_key=True)
     playlist_id = db.Column(db.Integer, db.ForeignKey('playlist.id'), nullable=False)
     media_id = db.Column(db.Integer, db.ForeignKey('media.id'), nullable=False)
+    # Fractional order key (see Playlist Order); byte-wise collation so the
+    # database sorts keys the way they are generated
+    position = db.Column(db.String().with_variant(db.String(collation='C'), 'postgresql'))
     media = db.relationship('Media')
 
+def bump_library_version(user_id):
+    """Invalidate cached /files pages; call inside the transaction that changes media."""
+    db.session.execute(
+        db.update(User).where(User.id == user_id).values(library_version=User.library_version + 1)
+    )
+
+def bump_library_versions(owners):
+    """bump_library_version for every user ID in owners (a list or SELECT)."""
+    db.session.execute(
+        db.update(User).where(User.id.in_(owners)).values(library_version=User.library_version + 1)
+    )
+
+def adjust_storage(user_id, delta):
+    """Add delta bytes to the user's usage counter, in the caller's transaction."""
+    if delta:
+        db.session.execute(
+            db.update(User).where(User.id == user_id).values(storage_bytes=User.storage_bytes + delta)
+        )
+
+def insert_ignore(model):
+    """INSERT that silently skips rows hitting a unique index (PostgreSQL/SQLite)."""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(model).on_conflict_do_nothing()
+    return sqlite.insert(model).on_conflict_do_nothing()
+
+def upsert(model, values, index_elements):
+    """INSERT ... ON CONFLICT DO UPDATE of the non-key columns in values."""
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    stmt = dialect.insert(model).values(**values)
+    return stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={name: stmt.excluded[name] for name in values if name not in index_elements},
+    )
+
+# Logged-in identity is cached per process, so authenticated requests don't
+# touch the database: the session cookie carries the session version and a
+# warm cache hit is checked against it. invalidate_user() drops an identity
+# here and appends its ID to SESSION_INVALIDATION_LOG; every worker stats the
+# log on each request and drops the IDs added since, so a password change
+# signs old sessions out everywhere at once. Workers that don't share the
+# file (other hosts) catch up within USER_CACHE_TTL.
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '60')) # seconds
+USER_CACHE_SIZE = 4096
+SESSION_INVALIDATION_LOG = os.environ.get(
+    'SESSION_INVALIDATION_LOG', os.path.join(tempfile.gettempdir(), 'media-player-sessions.log')
+)
+
+class SessionUser(UserMixin):
+    """Minimal identity of the logged-in user (what current_user is per request)."""
+
+    def __init__(self, id, username, session_version):
+        self.id = id
+        self.username = username
+        self.session_version = session_version
+
+    def get_id(self):
+        return f"{self.id}:{self.session_version}"
+
+_user_cache = OrderedDict() # user_id -> (SessionUser, expires_at)
+_user_cache_lock = threading.Lock()
+_invalidation_offset = None # bytes of SESSION_INVALIDATION_LOG this process has applied
+
+def invalidate_user(user_id):
+    """Drop a cached identity in this process now and in the others on their next request."""
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+    try:
+        fd = os.open(SESSION_INVALIDATION_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, f"{user_id}\n".encode()) # one short O_APPEND write: never interleaved
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Error signalling session invalidation: {e}")
+
+def _apply_invalidations():
+    """Drop identities invalidated by other workers since the last call (one stat if none)."""
+    global _invalidation_offset
+    try:
+        size = os.stat(SESSION_INVALIDATION_LOG).st_size
+    except FileNotFoundError:
+        size = 0
+    with _user_cache_lock:
+        if _invalidation_offset is None or size < _invalidation_offset:
+            if _invalidation_offset is not None:
+                _user_cache.clear() # log truncated: what it held is unknown
+            _invalidation_offset = size
+            return
+        if size == _invalidation_offset:
+            return
+        try:
+            with open(SESSION_INVALIDATION_LOG, 'rb') as f:
+                f.seek(_invalidation_offset)
+                added = f.read(size - _invalidation_offset)
+        except OSError:
+            _user_cache.clear()
+            return
+        added = added[:added.rfind(b'\n') + 1] # a line still being written waits for the next call
+        _invalidation_offset += len(added)
+        for line in added.split():
+            if line.isdigit():
+                _user_cache.pop(int(line), None)
+
 @login_manager.user_loader
-def load_user(user_id):
-    return db.session.get(User, int(user_id))
+def load_user(session_id):
+    try:
+        user_id, _, version = session_id.partition(':')
+        user_id, version = int(user_id), int(version or 0) # bare IDs are pre-versioning sessions
+    except ValueError:
+        return None
+    _apply_invalidations()
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry and entry[1] > now:
+            _user_cache.move_to_end(user_id)
+        else:
+            entry = None
+    # A newer version than cached: changed elsewhere and not signalled here yet
+    if entry is None or entry[0].session_version < version:
+        row = db.session.execute(
+            db.select(User.id, User.username, User.session_version).where(User.id == user_id)
+        ).first()
+        if not row:
+            return None
+        entry = (SessionUser(*row), now + USER_CACHE_TTL)
+        with _user_cache_lock:
+            _user_cache[user_id] = entry
+            _user_cache.move_to_end(user_id)
+            while len(_user_cache) > USER_CACHE_SIZE:
+                _user_cache.popitem(last=False)
+    identity = entry[0]
+    return identity if identity.session_version == version else None
+
+# --- Playlist Order ---
+# Items are ordered by a fractional key: a string that sorts between its
+# neighbours, so inserting, moving or removing an item writes only that row.
+# Keys are an integer part (a head letter giving its length, then base-62
+# digits) plus an optional fraction. Appending increments the integer, which
+# keeps keys short; placing between two keys extends the fraction.
+POSITION_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+POSITION_KEY = re.compile(r'^[A-Za-z][0-9A-Za-z]*$')
+_POSITION_ZERO = 'a0'
+_POSITION_SMALLEST = 'A' + '0' * 26
+
+def _position_integer(key):
+    head = key[0]
+    length = ord(head) - ord('a') + 2 if 'a' <= head <= 'z' else ord('Z') - ord(head) + 2
+    if length > len(key):
+        raise ValueError(f"Invalid position key: {key!r}")
+    return key[:length]
+
+def _position_midpoint(a, b):
+    """Fraction digits strictly between fractions a and b (b None: 1)."""
+    if b is not None:
+        n = 0
+        while (a[n] if n < len(a) else '0') == b[n]:
+            n += 1
+        if n:
+            return b[:n] + _position_midpoint(a[n:], b[n:])
+    digit_a = POSITION_DIGITS.index(a[0]) if a else 0
+    digit_b = POSITION_DIGITS.index(b[0]) if b is not None else len(POSITION_DIGITS)
+    if digit_b - digit_a > 1:
+        return POSITION_DIGITS[(digit_a + digit_b + 1) // 2]
+    if b is not None and len(b) > 1:
+        return b[0]
+    return POSITION_DIGITS[digit_a] + _position_midpoint(a[1:], None)
+
+def _position_step(integer, step):
+    """The integer part after (step=1) or before (step=-1) this one, None past the end."""
+    head, digits = integer[0], list(integer[1:])
+    wrap, base = ('0', len(POSITION_DIGITS)) if step > 0 else (POSITION_DIGITS[-1], -1)
+    for i in reversed(range(len(digits))):
+        digit = POSITION_DIGITS.index(digits[i]) + step
+        if digit != base:
+            digits[i] = POSITION_DIGITS[digit]
+            return head + ''.join(digits)
+        digits[i] = wrap
+    # Carried out of the last digit: the integer changes length
+    if step > 0:
+        if head == 'z':
+            return None
+        if head == 'Z':
+            return _POSITION_ZERO
+        head = chr(ord(head) + 1)
+        digits = digits + ['0'] if head > 'a' else digits[:-1]
+    else:
+        if head == 'A':
+            return None
+        if head == 'a':
+            return 'Z' + POSITION_DIGITS[-1]
+        head = chr(ord(head) - 1)
+        digits = digits + [POSITION_DIGITS[-1]] if head < 'Z' else digits[:-1]
+    return head + ''.join(digits)
+
+def position_between(a, b):
+    """A position key sorting after a and before b (either None: open end)."""
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f"Position {a!r} is not before {b!r}")
+    if a is None:
+        if b is None:
+            return _POSITION_ZERO
+        integer = _position_integer(b)
+        if integer == _POSITION_SMALLEST:
+            if b == integer:
+                raise ValueError('Position keys exhausted')
+            return integer + _position_midpoint('', b[len(integer):])
+        if integer < b:
+            return integer
+        before = _position_step(integer, -1)
+        if before is None:
+            raise ValueError('Position keys exhausted')
+        return before
+    integer = _position_integer(a)
+    after = _position_step(integer, 1)
+    if b is None:
+        return after if after is not None else integer + _position_midpoint(a[len(integer):], None)
+    if integer == _position_integer(b):
+        return integer + _position_midpoint(a[len(integer):], b[len(integer):])
+    if after is None:
+        raise ValueError('Position keys exhausted')
+    return after if after < b else integer + _position_midpoint(a[len(integer):], None)
+
+def next_positions(playlist_id, count):
+    """count keys after the playlist's last item.
+
+    Callers lock the playlist row first (with_for_update), so concurrent
+    appends to one playlist don't draw the same keys.
+    """
+    last = db.session.scalar(
+        db.select(db.func.max(PlaylistItem.position)).where(PlaylistItem.playlist_id == playlist_id)
+    )
+    keys = []
+    for _ in range(count):
+        last = position_between(last, None)
+        keys.append(last)
+    return keys
+
+# --- Media Store ---
+# Downloaded files are shared blobs keyed by extractor + video ID + output
+# format, so the same video is fetched and transcoded once no matter how many
+# users add it. Each user's Media row holds a reference; the file is removed
+# when the last reference goes.
+AUDIO_FORMAT = 'mp3-192'
+
+class MediaBlob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(200), unique=True, nullable=False) # extractor:video_id:format
+    filename = db.Column(db.String(255), nullable=False, index=True)
+    title = db.Column(db.String(255))
+    tags = db.Column(db.Text)
+    size_bytes = db.Column(db.BigInteger)
+    cover_hash = db.Column(db.String(64))
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+_extractor_classes = None
+
+def blob_key(extractor_key, video_id):
+    return f"{extractor_key}:{video_id}:{AUDIO_FORMAT}"
+
+def video_key_for_url(url):
+    """'extractor:video_id' derived from the URL alone (no network), or None.
+
+    Matches extractors the same way yt-dlp picks them. URLs only the generic
+    extractor handles have no stable ID until downloaded.
+    """
+    ie = extractor_for_url(url)
+    video_id = ie.get_temp_id(url) if ie else None
+    return f"{ie.ie_key()}:{video_id}" if video_id else None
+
+def extractor_for_url(url):
+    """The non-generic yt-dlp extractor class that would handle url, or None."""
+    global _extractor_classes
+    if _extractor_classes is None:
+        _extractor_classes = [ie for ie in yt_dlp.extractor.gen_extractor_classes()
+                              if ie.ie_key() != 'Generic']
+    for ie in _extractor_classes:
+        if ie.suitable(url):
+            return ie
+    return None
+
+def blob_key_for_url(url):
+    video_key = video_key_for_url(url)
+    return f"{video_key}:{AUDIO_FORMAT}" if video_key else None
+
+def get_or_create_blob(key, filename, title, tags=None):
+    db.session.execute(insert_ignore(MediaBlob).values(
+        key=key, filename=filename, title=title, tags=tags, ref_count=0, created_at=datetime.utcnow(),
+        size_bytes=os.path.getsize(os.path.join(DOWNLOAD_FOLDER, filename)),
+    ))
+    return MediaBlob.query.filter_by(key=key).first()
+
+def link_blob(user_id, blob, url):
+    """Give user_id a Media row referencing blob (in the caller's transaction).
+
+    Returns the user's Media row, or None if the blob was deleted concurrently
+    (its last reference went away) and has to be downloaded again.
+    """
+    existing = Media.query.filter_by(user_id=user_id, blob_id=blob.id).first()
+    if existing:
+        return existing
+    referenced = db.session.execute(
+        db.update(MediaBlob).where(MediaBlob.id == blob.id)
+        .values(ref_count=MediaBlob.ref_count + 1)
+    ).rowcount
+    if not referenced:
+        return None
+    media = Media(
+        user_id=user_id,
+        filename=blob.filename,
+        original_url=url,
+        title=blob.title,
+        tags=blob.tags,
+        type='audio',
+        path=f'/static/downloads/{blob.filename}',
+        blob_id=blob.id,
+        size_bytes=blob.size_bytes,
+        cover_hash=blob.cover_hash
+    )
+    db.session.add(media)
+    adjust_storage(user_id, blob.size_bytes or 0)
+    return media
+
+def link_stored_url(user_id, url, key=None, playlist_id=None):
+    """Link an already-stored video to the user without downloading; True on success."""
+    key = key or blob_key_for_url(url)
+    blob = MediaBlob.query.filter_by(key=key).first() if key else None
+    if not blob or not os.path.exists(os.path.join(DOWNLOAD_FOLDER, blob.filename)):
+        return False
+    if not link_blob(user_id, blob, url):
+        db.session.rollback()
+        return False
+    if playlist_id:
+        add_blobs_to_playlist(playlist_id, user_id, [blob.id])
+    bump_library_version(user_id)
+    db.session.commit()
+    return True
+
+def link_stored_blobs(user_id, urls_by_key):
+    """Link every already-stored blob in {blob key: url} to the user in bulk (caller's transaction).
+
+    A handful of statements however many keys: one SELECT for the blobs, one
+    for what the user already has, one reference-count UPDATE and one
+    multi-row INSERT. Returns {key: blob_id} for the keys now in the library.
+    """
+    blobs = {}
+    for chunk in _chunks(filter(None, urls_by_key)):
+        for blob in db.session.execute(
+            db.select(MediaBlob.id, MediaBlob.key, MediaBlob.filename, MediaBlob.title, MediaBlob.tags,
+                      MediaBlob.size_bytes, MediaBlob.cover_hash).where(MediaBlob.key.in_(chunk))
+        ):
+            if os.path.exists(os.path.join(DOWNLOAD_FOLDER, blob.filename)):
+                blobs[blob.id] = blob
+    if not blobs:
+        return {}
+    owned = set(db.session.execute(
+        db.select(Media.blob_id).where(Media.user_id == user_id, Media.blob_id.in_(list(blobs)))
+    ).scalars())
+    new_ids = [blob_id for blob_id in blobs if blob_id not in owned]
+    if new_ids:
+        # Blobs whose last reference went away since the SELECT are skipped
+        # and get downloaded again
+        referenced = set(db.session.execute(
+            db.update(MediaBlob).where(MediaBlob.id.in_(new_ids))
+            .values(ref_count=MediaBlob.ref_count + 1).returning(MediaBlob.id)
+        ).scalars())
+        rows = [{
+            'user_id': user_id, 'filename': blobs[blob_id].filename,
+            'original_url': urls_by_key[blobs[blob_id].key],
+            'title': blobs[blob_id].title, 'tags': blobs[blob_id].tags, 'type': 'audio',
+            'path': f'/static/downloads/{blobs[blob_id].filename}', 'blob_id': blob_id,
+            'size_bytes': blobs[blob_id].size_bytes, 'cover_hash': blobs[blob_id].cover_hash,
+            'created_at': datetime.utcnow(),
+        } for blob_id in new_ids if blob_id in referenced]
+        if rows:
+            db.session.execute(db.insert(Media), rows)
+            adjust_storage(user_id, sum(row['size_bytes'] or 0 for row in rows))
+            bump_library_version(user_id)
+        blobs = {blob_id: blob for blob_id, blob in blobs.items()
+                 if blob_id in owned or blob_id in referenced}
+    return {blob.key: blob_id for blob_id, blob in blobs.items()}
+
+def append_playlist_items(playlist_id, media_ids):
+    """Append media to the end of a playlist, in order, skipping ones already in it.
+
+    Runs in the caller's transaction; returns the number of items added.
+    """
+    db.session.execute(db.select(Playlist.id).where(Playlist.id == playlist_id).with_for_update())
+    present = set(db.session.execute(
+        db.select(PlaylistItem.media_id)
+        .where(PlaylistItem.playlist_id == playlist_id, PlaylistItem.media_id.in_(media_ids))
+    ).scalars())
+    media_ids = [media_id for media_id in dict.fromkeys(media_ids) if media_id not in present]
+    if not media_ids:
+        return 0
+    positions = next_positions(playlist_id, len(media_ids))
+    return db.session.execute(insert_ignore(PlaylistItem).values([
+        {'playlist_id': playlist_id, 'media_id': media_id, 'position': position}
+        for media_id, position in zip(media_ids, positions)
+    ])).rowcount
+
+def add_blobs_to_playlist(playlist_id, user_id, blob_ids):
+    """Append the user's media for blob_ids to a playlist, skipping ones already in it."""
+    media_by_blob = dict(db.session.execute(
+        db.select(Media.blob_id, Media.id).where(Media.user_id == user_id, Media.blob_id.in_(blob_ids))
+    ).all())
+    append_playlist_items(playlist_id, [media_by_blob[blob_id] for blob_id in blob_ids
+                                        if blob_id in media_by_blob])
+
+def release_media(media):
+    """Delete a Media row and drop its blob reference (in the caller's transaction).
+
+    Returns the filename to unlink once the transaction commits, or None if
+    another reference still uses the file.
+    """
+    db.session.execute(db.delete(PlaylistItem).where(PlaylistItem.media_id == media.id))
+    db.session.delete(media)
+    return release_media_file(media)
+
+def release_media_file(media):
+    """Storage and blob bookkeeping for a Media row being deleted (caller's transaction).
+
+    media is the row or any object with its id, user_id, filename, blob_id
+    and size_bytes. Returns the filename to unlink once the transaction
+    commits, or None if another reference still uses the file.
+    """
+    adjust_storage(media.user_id, -(media.size_bytes or 0))
+    if media.blob_id is None:
+        # Synced file: only shared by filename, remove it when nobody else lists it
+        still_used = db.session.scalar(
+            db.select(Media.id).where(Media.filename == media.filename, Media.id != media.id).limit(1)
+        )
+        return None if still_used else media.filename
+    db.session.execute(
+        db.update(MediaBlob).where(MediaBlob.id == media.blob_id)
+        .values(ref_count=MediaBlob.ref_count - 1)
+    )
+    removed = db.session.execute(
+        db.delete(MediaBlob).where(MediaBlob.id == media.blob_id, MediaBlob.ref_count <= 0)
+    ).rowcount
+    return media.filename if removed else None
+
+def remove_library_file(filename):
+    """Unlink a released file and its derived peaks and variants (after commit)."""
+    for path in (os.path.join(DOWNLOAD_FOLDER, filename), peaks_path(filename)):
+        if os.path.exists(path):
+            os.remove(path)
+    remove_variants(filename)
+
+# --- Metadata Resolver ---
+# yt-dlp info dicts are cached in two tiers: an in-process LRU and the
+# resolved_info table shared by every worker. Entries are keyed by
+# extractor:video_id when the URL reveals it (so youtu.be and watch?v= links
+# share one entry) and by the normalized URL otherwise. The TTL stays below
+# the lifetime of the signed stream URLs inside the info dict.
+RESOLVE_CACHE_SIZE = int(os.environ.get('RESOLVE_CACHE_SIZE', '256'))
+RESOLVE_CACHE_TTL = int(os.environ.get('RESOLVE_CACHE_TTL', '3600'))
+# Large fields the downloader never needs
+RESOLVE_DROP_FIELDS = ('automatic_captions', 'subtitles', 'heatmap')
+TRACKING_PARAMS = ('si', 'feature', 'pp')
+
+class ResolvedInfo(db.Model):
+    key = db.Column(db.String(500), primary_key=True)
+    title = db.Column(db.String(255))
+    info = db.Column(db.LargeBinary, nullable=False) # zlib-compressed JSON
+    resolved_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+_resolve_cache = OrderedDict() # key -> (expires monotonic, info)
+_resolve_cache_lock = threading.Lock()
+
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if k not in TRACKING_PARAMS and not k.startswith('utm_'))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
+
+def resolve_cache_key(url):
+    return video_key_for_url(url) or f"url:{normalize_url(url)}"
+
+def _cache_get(key):
+    with _resolve_cache_lock:
+        hit = _resolve_cache.get(key)
+        if hit and hit[0] > time.monotonic():
+            _resolve_cache.move_to_end(key)
+            return hit[1]
+        _resolve_cache.pop(key, None)
+    return None
+
+def _cache_put(key, info, ttl):
+    with _resolve_cache_lock:
+        _resolve_cache[key] = (time.monotonic() + ttl, info)
+        _resolve_cache.move_to_end(key)
+        while len(_resolve_cache) > RESOLVE_CACHE_SIZE:
+            _resolve_cache.popitem(last=False)
+
+def resolve_url(url, refresh=False):
+    """Info dict for a single video URL (no download), cached; None if it can't be resolved.
+
+    Callers get their own copy and may mutate it.
+    """
+    key = resolve_cache_key(url)
+    info = None if refresh else _cache_get(key)
+    if info is None and not refresh:
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(ResolvedInfo.info, ResolvedInfo.expires_at)
+                .where(ResolvedInfo.key == key, ResolvedInfo.expires_at > datetime.utcnow())
+            ).first()
+        if row:
+            info = json.loads(zlib.decompress(row.info))
+            _cache_put(key, info, (row.expires_at - datetime.utcnow()).total_seconds())
+
+    if info is None:
+        ydl_opts = {'quiet': True, 'no_warnings': True, 'noplaylist': True, 'skip_download': True}
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            try:
+                info = ydl.extract_info(url, download=False)
+            except yt_dlp.utils.DownloadError:
+                return None
+            if not info or 'entries' in info:
+                return None
+            info = ydl.sanitize_info(info)
+        for field in RESOLVE_DROP_FIELDS:
+            info.pop(field, None)
+
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(ResolvedInfo).where(ResolvedInfo.expires_at <= now))
+            conn.execute(upsert(ResolvedInfo, {
+                'key': key,
+                'title': (info.get('title') or '')[:255],
+                'info': zlib.compress(json.dumps(info).encode()),
+                'resolved_at': now,
+                'expires_at': now + timedelta(seconds=RESOLVE_CACHE_TTL),
+            }, ['key']))
+        _cache_put(key, info, RESOLVE_CACHE_TTL)
+    return copy.deepcopy(info)
+
+def invalidate_resolved(url):
+    key = resolve_cache_key(url)
+    with _resolve_cache_lock:
+        _resolve_cache.pop(key, None)
+    with db.engine.begin() as conn:
+        conn.execute(db.delete(ResolvedInfo).where(ResolvedInfo.key == key))
+
+def expand_url(url):
+    """(playlist title, entries) for a download URL; entries are dicts with url and key.
+
+    URLs whose extractor only ever returns one video (and URLs left to the
+    generic extractor) are taken as-is without touching the network. Anything
+    that may be a playlist is expanded with flat extraction: one listing
+    request per page, no per-video metadata. title is None for single videos.
+    """
+    ie = extractor_for_url(url)
+    if ie is None or ie.is_single_video(url):
+        return None, [{'url': url, 'key': blob_key_for_url(url)}]
+    ydl_opts = {
+        'quiet': True, 'no_warnings': True, 'noplaylist': True, 'skip_download': True,
+        'extract_flat': 'in_playlist', 'playlistend': DOWNLOAD_BATCH_MAX,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        try:
+            info = ydl.extract_info(url, download=False)
+        except yt_dlp.utils.DownloadError:
+            info = None
+    if not info or 'entries' not in info:
+        return None, [{'url': url, 'key': blob_key_for_url(url)}]
+    entries = []
+    for entry in info['entries']:
+        entry_url = entry and (entry.get('webpage_url') or entry.get('url'))
+        if not entry_url:
+            continue # private or removed
+        key = (blob_key(entry['ie_key'], entry['id']) if entry.get('ie_key') and entry.get('id')
+               else blob_key_for_url(entry_url))
+        entries.append({'url': entry_url, 'key': key})
+    return info.get('title'), entries
+
+# --- Library Reconciliation ---
+# DOWNLOAD_FOLDER is mirrored into file_index (name, size, mtime). A pass
+# scans the directory once with os.scandir, diffs it against the index in
+# memory and writes only the differences in bulk, so syncing costs a handful
+# of queries however many files there are.
+MEDIA_EXTENSIONS = ('.mp4', '.mp3', '.m4a')
+LIBRARY_WATCH_INTERVAL = float(os.environ.get('LIBRARY_WATCH_INTERVAL', '0')) # seconds, 0 = off
+RECONCILE_CHUNK = 500
+
+class FileIndex(db.Model):
+    name = db.Column(db.String(255), primary_key=True)
+    size_bytes = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    missing = db.Column(db.Boolean, nullable=False, default=False)
+    seen_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def _chunks(items, size=RECONCILE_CHUNK):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def scan_download_folder():
+    files = {}
+    with os.scandir(DOWNLOAD_FOLDER) as entries:
+        for entry in entries:
+            if entry.name.endswith(MEDIA_EXTENSIONS) and entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+def reconcile_download_folder():
+    """Bring file_index and media.missing in line with the disk; commits.
+
+    Returns a dict with the names that were added, changed, went missing
+    and reappeared since the previous pass.
+    """
+    on_disk = scan_download_folder()
+    indexed = {row.name: row for row in db.session.execute(
+        db.select(FileIndex.name, FileIndex.size_bytes, FileIndex.mtime_ns, FileIndex.missing)
+    )}
+    now = datetime.utcnow()
+
+    added, changed, reappeared = [], [], []
+    for name, (size, mtime_ns) in on_disk.items():
+        row = indexed.get(name)
+        if row is None:
+            added.append(name)
+        elif row.missing:
+            reappeared.append(name)
+        elif (row.size_bytes, row.mtime_ns) != (size, mtime_ns):
+            changed.append(name)
+    gone = [name for name, row in indexed.items() if name not in on_disk and not row.missing]
+
+    if added:
+        db.session.execute(insert_ignore(FileIndex), [
+            {'name': name, 'size_bytes': on_disk[name][0], 'mtime_ns': on_disk[name][1],
+             'missing': False, 'seen_at': now}
+            for name in added
+        ])
+    if changed or reappeared:
+        db.session.execute(db.update(FileIndex), [
+            {'name': name, 'size_bytes': on_disk[name][0], 'mtime_ns': on_disk[name][1],
+             'missing': False, 'seen_at': now}
+            for name in changed + reappeared
+        ])
+    if gone:
+        db.session.execute(db.update(FileIndex), [{'name': name, 'missing': True} for name in gone])
+
+    for names, missing in ((gone, True), (reappeared + added, False)):
+        for chunk in _chunks(names):
+            # Every owner's cached /files pages show the flag
+            bump_library_versions(
+                db.select(Media.user_id).where(Media.filename.in_(chunk), Media.missing != missing)
+            )
+            db.session.execute(
+                db.update(Media).where(Media.filename.in_(chunk), Media.missing != missing)
+                .values(missing=missing)
+            )
+    db.session.commit()
+    return {'added': added, 'changed': changed, 'missing': gone, 'reappeared': reappeared}
+
+def _library_watcher_loop():
+    """Reconcile whenever DOWNLOAD_FOLDER's entries change.
+
+    Polls the directory mtime (it changes on every create, delete or rename
+    inside it), so no inotify dependency is needed and idle cost is one stat().
+    """
+    last_mtime = None
+    while True:
+        try:
+            mtime = os.stat(DOWNLOAD_FOLDER).st_mtime_ns
+            if mtime != last_mtime:
+                with app.app_context():
+                    reconcile_download_folder()
+                last_mtime = mtime
+        except Exception as e:
+            print(f"Error reconciling {DOWNLOAD_FOLDER}: {e}")
+        time.sleep(LIBRARY_WATCH_INTERVAL)
+
+def start_library_watcher():
+    if LIBRARY_WATCH_INTERVAL > 0:
+        threading.Thread(target=_library_watcher_loop, name='library-watcher', daemon=True).start()
+
+# --- Storage Accounting ---
+# Usage is a counter on User maintained in the same transactions that add
+# and remove Media rows, so reading it never touches the disk. A background
+# evictor releases the least recently played media of users over quota;
+# anything in a playlist is kept.
+STORAGE_QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', '0')) # per user, 0 = unlimited
+STORAGE_EVICT_INTERVAL = float(os.environ.get('STORAGE_EVICT_INTERVAL', '300')) # seconds, 0 = off
+STORAGE_EVICT_BATCH = 100
+EVICTOR_LOCK_KEY = 727002
+
+def effective_quota():
+    """SQL expression for each user's quota in bytes (0 = unlimited)."""
+    return db.func.coalesce(User.storage_quota_bytes, STORAGE_QUOTA_BYTES)
+
+def evict_user_media(user_id, quota):
+    """Release least recently played, playlist-free media until usage fits quota; commits.
+
+    Returns the number of media rows released.
+    """
+    released = 0
+    unlink = []
+    while True:
+        usage = db.session.scalar(db.select(User.storage_bytes).where(User.id == user_id))
+        if usage <= quota:
+            break
+        unlisted = ~db.select(PlaylistItem.id).where(PlaylistItem.media_id == Media.id).exists()
+        candidates = db.session.execute(
+            db.select(Media.id, Media.user_id, Media.filename, Media.blob_id, Media.size_bytes)
+            .where(Media.user_id == user_id, unlisted)
+            .order_by(Media.last_played_at.asc().nulls_first(), Media.created_at.asc(), Media.id.asc())
+            .limit(STORAGE_EVICT_BATCH)
+        ).all()
+        if not candidates:
+            break # everything left is in a playlist
+        for media in candidates:
+            if usage <= quota:
+                break
+            # The DELETE re-checks playlist membership, so media added to a
+            # playlist since it was picked is kept
+            if not db.session.execute(db.delete(Media).where(Media.id == media.id, unlisted)).rowcount:
+                continue
+            usage -= media.size_bytes or 0
+            filename = release_media_file(media)
+            if filename:
+                db.session.execute(db.delete(FileIndex).where(FileIndex.name == filename))
+                unlink.append(filename)
+            released += 1
+        bump_library_version(user_id)
+        db.session.commit()
+        for filename in unlink:
+            remove_library_file(filename)
+        unlink.clear()
+    return released
+
+def enforce_storage_quotas():
+    """Evict media of every user over quota; returns {user_id: media released}."""
+    over_quota = db.session.execute(
+        db.select(User.id, effective_quota())
+        .where(effective_quota() > 0, User.storage_bytes > effective_quota())
+    ).all()
+    return {user_id: evict_user_media(user_id, quota) for user_id, quota in over_quota}
+
+@contextmanager
+def _pass_lock(key):
+    """Yield True if this process should run a periodic pass (one at a time on PostgreSQL)."""
+    if db.engine.dialect.name != 'postgresql':
+        yield True
+        return
+    with db.engine.connect() as conn:
+        locked = conn.execute(db.text('SELECT pg_try_advisory_lock(:key)'), {'key': key}).scalar()
+        conn.commit()
+        try:
+            yield locked
+        finally:
+            if locked:
+                conn.execute(db.text('SELECT pg_advisory_unlock(:key)'), {'key': key})
+                conn.commit()
 
-# --- Global Download Status ---
-current_download_status = {
-    'status': 'idle',
-    'percentage': 0, 'filename': '', 'speed': '', 'eta': '', 'user_id': None, 'should_cancel': False
+def _storage_evictor_loop():
+    while True:
+        time.sleep(STORAGE_EVICT_INTERVAL)
+        with app.app_context():
+            try:
+                with _pass_lock(EVICTOR_LOCK_KEY) as locked:
+                    if locked:
+                        for user_id, released in enforce_storage_quotas().items():
+                            print(f"Evicted {released} media for user {user_id} over storage quota")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error enforcing storage quotas: {e}")
+
+def start_storage_evictor():
+    if STORAGE_EVICT_INTERVAL > 0:
+        threading.Thread(target=_storage_evictor_loop, name='storage-evictor', daemon=True).start()
+
+# --- Housekeeping ---
+# Expired sync tombstones, cover thumbnails no media uses and job folders
+# left by dead workers are cleaned up on their own cadence, whether or not
+# quota eviction is on.
+HOUSEKEEPING_INTERVAL = float(os.environ.get('HOUSEKEEPING_INTERVAL', '300')) # seconds, 0 = off
+HOUSEKEEPING_LOCK_KEY = 727004
+
+def run_housekeeping():
+    """One cleanup pass; each step runs even if an earlier one failed."""
+    for step in (prune_change_log, remove_orphan_covers, remove_stale_staging):
+        try:
+            step()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error in housekeeping ({step.__name__}): {e}")
+
+def _housekeeping_loop():
+    while True:
+        time.sleep(HOUSEKEEPING_INTERVAL)
+        with app.app_context():
+            try:
+                with _pass_lock(HOUSEKEEPING_LOCK_KEY) as locked:
+                    if locked:
+                        run_housekeeping()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error in housekeeping: {e}")
+
+def start_housekeeping():
+    if HOUSEKEEPING_INTERVAL > 0:
+        threading.Thread(target=_housekeeping_loop, name='housekeeping', daemon=True).start()
+
+# --- Library Search ---
+# Media title, filename and tags are full-text indexed in the database: an
+# FTS5 table kept current by triggers on SQLite, a generated tsvector column
+# with a GIN index on PostgreSQL. Either way every insert, update and delete
+# of a media row updates the index in the same transaction.
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 200
+SEARCH_MAX_TERMS = 8
+
+# Info dict / tag fields folded into Media.tags (what FFmpegMetadata embeds)
+TAG_FIELDS = ('artist', 'creator', 'uploader', 'album', 'album_artist', 'composer', 'genre', 'track')
+
+_search_backend = None
+
+def media_tags(info):
+    """Searchable tag text from a yt-dlp info dict, or None."""
+    values = []
+    for field in TAG_FIELDS:
+        value = info.get(field)
+        if value and str(value) not in values:
+            values.append(str(value))
+    return '; '.join(values) or None
+
+def read_file_tags(path):
+    """(title, tag text) embedded in a media file (needs mutagen); either may be None."""
+    if mutagen is None:
+        return None, None
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception:
+        return None, None
+    if not audio or not audio.tags:
+        return None, None
+    # Easy tags name the album artist 'albumartist'; TAG_FIELDS follows yt-dlp's 'album_artist'
+    fields = {'artist': 'artist', 'album': 'album', 'album_artist': 'albumartist', 'composer': 'composer',
+              'genre': 'genre'}
+    title = ', '.join(audio.tags.get('title', [])).strip() or None
+    return title, media_tags({field: ', '.join(audio.tags.get(key, [])) for field, key in fields.items()})
+
+def search_terms(q):
+    return re.findall(r'\w+', q.lower())[:SEARCH_MAX_TERMS]
+
+def search_backend():
+    """'postgresql', 'fts5', or 'like' when this SQLite build lacks FTS5."""
+    global _search_backend
+    if _search_backend is None:
+        if db.engine.dialect.name == 'postgresql':
+            _search_backend = 'postgresql'
+        elif db.inspect(db.engine).has_table('media_fts'):
+            _search_backend = 'fts5'
+        else:
+            _search_backend = 'like'
+    return _search_backend
+
+def search_media(user_id, q, limit, offset):
+    """Best matches first; every term must match as a word prefix (anywhere, on the LIKE fallback)."""
+    terms = search_terms(q)
+    if not terms:
+        return []
+    params = {'user_id': user_id, 'limit': limit, 'offset': offset}
+    backend = search_backend()
+    if backend == 'postgresql':
+        params['query'] = ' & '.join(f'{term}:*' for term in terms)
+        sql = (
+            "SELECT m.id, m.filename, m.type, m.title, m.missing, m.cover_hash "
+            "FROM media m, to_tsquery('simple', :query) query "
+            "WHERE m.user_id = :user_id AND m.search_vector @@ query "
+            "ORDER BY ts_rank(m.search_vector, query) DESC, m.id DESC "
+            "LIMIT :limit OFFSET :offset"
+        )
+    elif backend == 'fts5':
+        # Quoted terms so user input can't form FTS5 query syntax
+        params['query'] = ' '.join(f'"{term}"*' for term in terms)
+        sql = (
+            "SELECT m.id, m.filename, m.type, m.title, m.missing, m.cover_hash "
+            "FROM media_fts JOIN media m ON m.id = media_fts.rowid "
+            "WHERE media_fts MATCH :query AND m.user_id = :user_id "
+            "ORDER BY bm25(media_fts, 10.0, 2.0, 5.0), m.id DESC "
+            "LIMIT :limit OFFSET :offset"
+        )
+    else:
+        clauses = []
+        for i, term in enumerate(terms):
+            # Terms are word characters, which include LIKE's '_' wildcard
+            escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params[f'term{i}'] = f'%{escaped}%'
+            clauses.append(f"(lower(m.title) LIKE :term{i} ESCAPE '\\' "
+                           f"OR lower(m.filename) LIKE :term{i} ESCAPE '\\' "
+                           f"OR lower(coalesce(m.tags, '')) LIKE :term{i} ESCAPE '\\')")
+        sql = (
+            "SELECT m.id, m.filename, m.type, m.title, m.missing, m.cover_hash FROM media m "
+            f"WHERE m.user_id = :user_id AND {' AND '.join(clauses)} "
+            "ORDER BY m.created_at DESC, m.id DESC LIMIT :limit OFFSET :offset"
+        )
+    return db.session.execute(db.text(sql), params).all()
+
+def _create_search_index():
+    conn = db.session.connection()
+    if conn.dialect.name == 'postgresql':
+        if 'search_vector' not in {c['name'] for c in db.inspect(conn).get_columns('media')}:
+            conn.execute(db.text(
+                "ALTER TABLE media ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+                "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+                "setweight(to_tsvector('simple', coalesce(tags, '')), 'B') || "
+                "setweight(to_tsvector('simple', regexp_replace(filename, '[^[:alnum:]]+', ' ', 'g')), 'C')"
+                ") STORED"
+            ))
+        conn.execute(db.text('CREATE INDEX IF NOT EXISTS ix_media_search ON media USING GIN (search_vector)'))
+        return
+    try:
+        conn.execute(db.text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5("
+            "title, filename, tags, content='media', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        ))
+    except Exception as e:
+        print(f"FTS5 unavailable, /search falls back to LIKE: {e}")
+        return
+    conn.execute(db.text(
+        "CREATE TRIGGER IF NOT EXISTS media_fts_ai AFTER INSERT ON media BEGIN "
+        "INSERT INTO media_fts(rowid, title, filename, tags) VALUES (new.id, new.title, new.filename, new.tags); "
+        "END"
+    ))
+    conn.execute(db.text(
+        "CREATE TRIGGER IF NOT EXISTS media_fts_ad AFTER DELETE ON media BEGIN "
+        "INSERT INTO media_fts(media_fts, rowid, title, filename, tags) "
+        "VALUES ('delete', old.id, old.title, old.filename, old.tags); "
+        "END"
+    ))
+    conn.execute(db.text(
+        "CREATE TRIGGER IF NOT EXISTS media_fts_au AFTER UPDATE OF title, filename, tags ON media BEGIN "
+        "INSERT INTO media_fts(media_fts, rowid, title, filename, tags) "
+        "VALUES ('delete', old.id, old.title, old.filename, old.tags); "
+        "INSERT INTO media_fts(rowid, title, filename, tags) VALUES (new.id, new.title, new.filename, new.tags); "
+        "END"
+    ))
+    conn.execute(db.text("INSERT INTO media_fts(media_fts) VALUES ('rebuild')"))
+
+# --- Sync Change Log ---
+# Offline clients keep a copy of the library and catch up through
+# /sync/changes. Triggers on media, playlist and playlist_item record every
+# insert, update and delete in change_log, one row per entity holding the
+# sequence number of its latest change (a compacted log), so catching up
+# costs one indexed range scan over what changed since the client's cursor.
+# On PostgreSQL the triggers take a per-user advisory lock before drawing a
+# sequence number, so a user's changes commit in sequence order and a
+# client can never skip one still in flight; SQLite has a single writer.
+# Tombstones are pruned after SYNC_TOMBSTONE_TTL; cursors older than that
+# get a full resync.
+SYNC_PAGE_SIZE = 1000
+SYNC_TOMBSTONE_TTL = int(os.environ.get('SYNC_TOMBSTONE_TTL', str(30 * 24 * 3600)))
+CHANGE_LOG_LOCK_KEY = 727003
+# Tracked tables and the columns whose updates clients care about (None: all)
+CHANGE_LOG_TABLES = {
+    'playlist': ('name',),
+    'media': ('filename', 'title', 'type', 'missing', 'cover_hash'),
+    'playlist_item': None,
 }
 
-def progress_hook(d):
-    global current_download_status
-    if current_download_status.get('should_cancel', False):
-        raise Exception("Download cancelled by user")
-    if d['status'] == 'downloading':
-        current_download_status['status'] = 'downloading'
-        current_download_status['percentage'] = d.get('_percent_str', '0%').strip()
-        current_download_status['filename'] = os.path.basename(d.get('filename', ''))
-        current_download_status['speed'] = d.get('_speed_str', 'N/A')
-        current_download_status['eta'] = d.get('_eta_str', 'N/A')
-    elif d['status'] == 'finished':
-        current_download_status['status'] = 'processing'
-        current_download_status['percentage'] = '100%'
-
-def run_download(url, type_format, user_id):
-    global current_download_status
-    current_download_status = {
-        'status': 'starting', 'percentage': '0%', 'filename': 'Initializing...', 
-        'speed': '', 'eta': '', 'user_id': user_id, 'should_cancel': False
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    __table_args__ = (db.Index('ix_change_log_user_seq', 'user_id', 'seq'),)
+
+    entity = db.Column(db.String(20), primary_key=True) # table name
+    entity_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    seq = db.Column(db.BigInteger, nullable=False, unique=True)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+def _create_change_log_triggers():
+    """(Re)create the change_log triggers; run again when CHANGE_LOG_TABLES changes."""
+    conn = db.session.connection()
+    if conn.dialect.name == 'postgresql':
+        conn.execute(db.text('CREATE SEQUENCE IF NOT EXISTS change_log_seq'))
+        # Start past any backfilled rows; never move the sequence backwards
+        conn.execute(db.text(
+            "SELECT setval('change_log_seq', GREATEST((SELECT COALESCE(MAX(seq), 0) FROM change_log), "
+            "(SELECT last_value FROM change_log_seq)))"
+        ))
+        conn.execute(db.text(f"""
+            CREATE OR REPLACE FUNCTION change_log_record() RETURNS trigger AS $$
+            DECLARE
+                rec record;
+                owner integer;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN rec := OLD; ELSE rec := NEW; END IF;
+                IF TG_TABLE_NAME = 'playlist_item' THEN
+                    SELECT user_id INTO owner FROM playlist WHERE id = rec.playlist_id;
+                ELSE
+                    owner := rec.user_id;
+                END IF;
+                IF owner IS NULL THEN RETURN NULL; END IF;
+                PERFORM pg_advisory_xact_lock({CHANGE_LOG_LOCK_KEY}, owner);
+                INSERT INTO change_log (entity, entity_id, user_id, seq, deleted, changed_at)
+                VALUES (TG_TABLE_NAME, rec.id, owner, nextval('change_log_seq'), TG_OP = 'DELETE',
+                        timezone('utc', now()))
+                ON CONFLICT (entity, entity_id) DO UPDATE SET user_id = EXCLUDED.user_id,
+                    seq = EXCLUDED.seq, deleted = EXCLUDED.deleted, changed_at = EXCLUDED.changed_at;
+                RETURN NULL;
+            END $$ LANGUAGE plpgsql
+        """))
+        for table, columns in CHANGE_LOG_TABLES.items():
+            update = f"UPDATE OF {', '.join(columns)}" if columns else 'UPDATE'
+            conn.execute(db.text(f'DROP TRIGGER IF EXISTS change_log_{table} ON {table}'))
+            conn.execute(db.text(
+                f'CREATE TRIGGER change_log_{table} AFTER INSERT OR {update} OR DELETE ON {table} '
+                f'FOR EACH ROW EXECUTE FUNCTION change_log_record()'
+            ))
+        return
+    # Sequence numbers come from a counter, never from MAX(seq): pruning can
+    # delete the newest rows, and reusing their numbers would hide changes
+    # from clients whose cursor is already past them
+    conn.execute(db.text('CREATE TABLE IF NOT EXISTS change_log_seq (value INTEGER NOT NULL)'))
+    conn.execute(db.text(
+        'INSERT INTO change_log_seq (value) SELECT COALESCE(MAX(seq), 0) FROM change_log '
+        'WHERE NOT EXISTS (SELECT 1 FROM change_log_seq)'
+    ))
+    for table, columns in CHANGE_LOG_TABLES.items():
+        for suffix, op, ref in (('ai', 'INSERT', 'new'), ('ad', 'DELETE', 'old'),
+                                ('au', f"UPDATE OF {', '.join(columns)}" if columns else 'UPDATE', 'new')):
+            if table == 'playlist_item':
+                owner, source = 'playlist.user_id', f'FROM playlist WHERE playlist.id = {ref}.playlist_id'
+            else:
+                owner, source = f'{ref}.user_id', 'WHERE true'
+            conn.execute(db.text(f'DROP TRIGGER IF EXISTS change_log_{table}_{suffix}'))
+            conn.execute(db.text(
+                f"CREATE TRIGGER change_log_{table}_{suffix} AFTER {op} ON {table} BEGIN "
+                f"UPDATE change_log_seq SET value = value + 1; "
+                f"INSERT INTO change_log (entity, entity_id, user_id, seq, deleted, changed_at) "
+                f"SELECT '{table}', {ref}.id, {owner}, (SELECT value FROM change_log_seq), "
+                f"{int(suffix == 'ad')}, CURRENT_TIMESTAMP {source} "
+                f"ON CONFLICT (entity, entity_id) DO UPDATE SET user_id = excluded.user_id, "
+                f"seq = excluded.seq, deleted = excluded.deleted, changed_at = excluded.changed_at; "
+                f"END"
+            ))
+
+def _backfill_change_log():
+    """Log every existing playlist, media and playlist item as a fresh insert.
+
+    Runs before the triggers are created, which start the sequence past these rows.
+    """
+    sources = {
+        'playlist': db.select(Playlist.id, Playlist.user_id),
+        'media': db.select(Media.id, Media.user_id),
+        'playlist_item': db.select(PlaylistItem.id, Playlist.user_id)
+                           .join(Playlist, Playlist.id == PlaylistItem.playlist_id),
     }
-    
+    for entity, source in sources.items():
+        offset = db.session.scalar(db.select(db.func.coalesce(db.func.max(ChangeLog.seq), 0)))
+        entity_id, user_id = source.selected_columns
+        seq = db.literal(offset) + db.func.row_number().over(order_by=entity_id)
+        db.session.execute(db.insert(ChangeLog).from_select(
+            ['entity', 'entity_id', 'user_id', 'seq', 'deleted'],
+            source.with_only_columns(db.literal(entity), entity_id, user_id, seq, db.false())
+        ))
+
+def prune_change_log():
+    """Drop tombstones older than SYNC_TOMBSTONE_TTL; commits.
+
+    Each affected user's sync_floor moves past the pruned tombstones, so
+    clients holding an older cursor are told to resync from scratch.
+    """
+    newest = db.aliased(ChangeLog)
+    expired = db.and_(ChangeLog.deleted.is_(True),
+                      ChangeLog.changed_at < datetime.utcnow() - timedelta(seconds=SYNC_TOMBSTONE_TTL),
+                      # the newest row always stays, so the log's high-water mark survives
+                      ChangeLog.seq < db.select(db.func.max(newest.seq)).scalar_subquery())
+    pruned_through = (db.select(db.func.max(ChangeLog.seq))
+                      .where(expired, ChangeLog.user_id == User.id).scalar_subquery())
+    db.session.execute(
+        db.update(User).where(db.exists().where(expired, ChangeLog.user_id == User.id))
+        .values(sync_floor=pruned_through)
+    )
+    pruned = db.session.execute(db.delete(ChangeLog).where(expired)).rowcount
+    db.session.commit()
+    return pruned
+
+# --- Download Job Queue ---
+# Jobs live in the database so every gunicorn worker sees the same queue and
+# queued work survives restarts. Each process runs DOWNLOAD_WORKERS threads
+# that claim jobs with a compare-and-set UPDATE.
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_POSTPROCESSING = 'postprocessing'
+JOB_DONE = 'done'
+JOB_ERROR = 'error'
+JOB_CANCELLED = 'cancelled'
+JOB_ACTIVE_STATES = (JOB_QUEUED, JOB_RUNNING, JOB_POSTPROCESSING)
+JOB_FINISHED_STATES = (JOB_DONE, JOB_ERROR, JOB_CANCELLED)
+
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '2'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '2'))
+# Each job downloads and converts in its own folder, so two jobs fetching the
+# same video never write the same partial file; the result is then linked
+# into DOWNLOAD_FOLDER. A requeued job resumes from what its folder holds.
+JOB_STAGING_FOLDER = os.environ.get('JOB_STAGING_FOLDER', os.path.join(DOWNLOAD_FOLDER, '.jobs'))
+JOB_HEARTBEAT_INTERVAL = int(os.environ.get('JOB_HEARTBEAT_INTERVAL', '30'))
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', '300'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+# Running downloads per user across all workers (0 = no cap), so one user's
+# playlist can't occupy every worker while other users' jobs wait
+DOWNLOAD_USER_CONCURRENCY = int(os.environ.get('DOWNLOAD_USER_CONCURRENCY', '2'))
+CLAIM_LOCK_KEY = 727005 # advisory lock namespace for per-user claims
+DOWNLOAD_BATCH_MAX = int(os.environ.get('DOWNLOAD_BATCH_MAX', '500')) # entries per /download request
+DOWNLOAD_TYPES = ('video', 'audio') # what /download accepts as "type"
+# Transcoding runs on its own pool, one ffmpeg process per core by default
+POSTPROCESS_WORKERS = int(os.environ.get('POSTPROCESS_WORKERS', '0')) or os.cpu_count() or 2
+# Progress is written at most every 250 ms, and only once it has moved by at
+# least 1% (speed/ETA still refresh every PROGRESS_REFRESH_INTERVAL).
+PROGRESS_WRITE_INTERVAL = 0.25
+PROGRESS_MIN_STEP = 1.0
+PROGRESS_REFRESH_INTERVAL = 2.0
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', '0.5'))
+SSE_KEEPALIVE_INTERVAL = 15
+
+class DownloadJob(db.Model):
+    __table_args__ = (db.Index('ix_download_job_status_created', 'status', 'created_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    url = db.Column(db.String(500), nullable=False)
+    type = db.Column(db.String(10))
+    status = db.Column(db.String(20), nullable=False, default=JOB_QUEUED)
+    percentage = db.Column(db.Float, nullable=False, default=0)
+    filename = db.Column(db.String(255))
+    speed = db.Column(db.String(32))
+    eta = db.Column(db.String(32))
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    playlist_id = db.Column(db.Integer, db.ForeignKey('playlist.id')) # media is added there when done
+    worker = db.Column(db.String(100)) # host:pid of the process running it
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'url': self.url,
+            'status': self.status,
+            'percentage': self.percentage,
+            'filename': self.filename or '',
+            'speed': self.speed or '',
+            'eta': self.eta or '',
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+_job_wakeup = threading.Event()
+_job_changed = threading.Condition() # wakes SSE streams served by this process
+_download_workers_started = False
+WORKER_ID = None
+
+def update_job(job_id, **values):
+    """Write job fields in their own transaction and return the cancel flag.
+
+    Uses a separate connection so progress writes never flush or commit the
+    caller's ORM session.
+    """
+    values['heartbeat_at'] = datetime.utcnow()
+    with db.engine.begin() as conn:
+        conn.execute(db.update(DownloadJob).where(DownloadJob.id == job_id).values(**values))
+        cancel_requested = conn.execute(
+            db.select(DownloadJob.cancel_requested).where(DownloadJob.id == job_id)
+        ).scalar()
+    with _job_changed:
+        _job_changed.notify_all()
+    return cancel_requested
+
+def make_progress_hook(job_id):
+    last_write = {'at': 0.0, 'percentage': -PROGRESS_MIN_STEP}
+    counted = {} # filename -> bytes already added to download_bytes_total
+
+    def progress_hook(d):
+        if d['status'] in ('downloading', 'finished'):
+            downloaded = d.get('downloaded_bytes') or 0
+            delta = downloaded - counted.get(d.get('filename'), 0)
+            if delta > 0:
+                metrics.inc('download_bytes_total', delta)
+                counted[d.get('filename')] = downloaded
+        if d['status'] == 'downloading':
+            now = time.monotonic()
+            elapsed = now - last_write['at']
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            percentage = round(100.0 * d.get('downloaded_bytes', 0) / total, 1) if total else 0
+            if elapsed < PROGRESS_WRITE_INTERVAL:
+                return
+            if (percentage - last_write['percentage'] < PROGRESS_MIN_STEP
+                    and elapsed < PROGRESS_REFRESH_INTERVAL):
+                return
+            last_write.update(at=now, percentage=percentage)
+            values = {
+                'status': JOB_RUNNING,
+                'percentage': percentage,
+                'filename': os.path.basename(d.get('filename', '')),
+                'speed': d.get('_speed_str', 'N/A'),
+                'eta': d.get('_eta_str', 'N/A'),
+            }
+        elif d['status'] == 'finished':
+            values = {'status': JOB_POSTPROCESSING, 'percentage': 100.0}
+        else:
+            return
+        if update_job(job_id, **values):
+            raise yt_dlp.utils.DownloadCancelled("Download cancelled by user")
+
+    return progress_hook
+
+class PipelineStage:
+    """Queue depth and throughput counters for one download pipeline stage (per process)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.queued = self.active = self.completed = self.failed = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+
+    def enqueue(self):
+        with self.lock:
+            self.queued += 1
+
+    @contextmanager
+    def track(self, queued=False):
+        with self.lock:
+            if queued:
+                self.queued -= 1
+            self.active += 1
+        started = time.monotonic()
+        work = {'bytes': 0}
+        ok = False
+        try:
+            yield work
+            ok = True
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.busy_seconds += time.monotonic() - started
+                self.bytes += work['bytes']
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'failed': self.failed,
+                'bytes': self.bytes,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'bytes_per_second': round(self.bytes / self.busy_seconds) if self.busy_seconds else 0,
+            }
+
+download_stage = PipelineStage('download')
+postprocess_stage = PipelineStage('postprocess')
+_postprocess_executor = None
+_postprocess_executor_lock = threading.Lock()
+
+def submit_postprocess(fn, *args):
+    """Queue CPU work on the postprocessing pool (one ffmpeg per core)."""
+    global _postprocess_executor
+    with _postprocess_executor_lock:
+        if _postprocess_executor is None:
+            _postprocess_executor = ThreadPoolExecutor(POSTPROCESS_WORKERS, thread_name_prefix='postprocess')
+    postprocess_stage.enqueue()
+    _postprocess_executor.submit(fn, *args)
+
+def job_staging_path(job_id):
+    return os.path.join(JOB_STAGING_FOLDER, str(job_id))
+
+def remove_job_staging(job_id):
+    shutil.rmtree(job_staging_path(job_id), ignore_errors=True)
+
+def remove_stale_staging():
+    """Delete staging folders of jobs that are finished or no longer exist."""
+    try:
+        names = os.listdir(JOB_STAGING_FOLDER)
+    except FileNotFoundError:
+        return
+    job_ids = {int(name) for name in names if name.isdigit()}
+    active = set(db.session.execute(
+        db.select(DownloadJob.id).where(DownloadJob.id.in_(job_ids),
+                                        DownloadJob.status.in_(JOB_ACTIVE_STATES))
+    ).scalars()) if job_ids else set()
+    for job_id in job_ids - active:
+        remove_job_staging(job_id)
+
+def publish_download(path):
+    """Move a converted file from its job folder into the library; returns its filename.
+
+    If another job already published the same video under this name, that
+    copy is kept and this one dropped.
+    """
+    filename = os.path.basename(path)
+    target = os.path.join(DOWNLOAD_FOLDER, filename)
+    try:
+        os.link(path, target)
+    except FileExistsError:
+        pass
+    except OSError: # filesystem without hard links
+        if not os.path.exists(target):
+            os.replace(path, target)
+            return filename
+    os.remove(path)
+    return filename
+
+def downloaded_paths(info):
+    entries = (info.get('entries') or []) if info and 'entries' in info else [info]
+    return [d['filepath'] for entry in entries if entry
+            for d in entry.get('requested_downloads') or []
+            if d.get('filepath') and os.path.exists(d['filepath'])]
+
+def run_download(job_id):
+    """Network stage: fetch the raw audio, then hand it to the postprocessing pool.
+
+    The download thread returns to the queue as soon as the transfer is done,
+    so the next download starts while ffmpeg is still transcoding this one.
+    """
     with app.app_context():
+        job = db.session.get(DownloadJob, job_id)
+        url, user_id, playlist_id = job.url, job.user_id, job.playlist_id
+        update_job(job_id, filename='Initializing...')
         try:
+            # Cached metadata also catches stored videos whose URL alone
+            # doesn't reveal the ID
+            info = resolve_url(url)
+            if link_stored_url(user_id, url, playlist_id=playlist_id) or (info and link_stored_url(
+                    user_id, url, blob_key(info.get('extractor_key', 'Generic'), info.get('id')),
+                    playlist_id)):
+                update_job(job_id, status=JOB_DONE, percentage=100.0, finished_at=datetime.utcnow())
+                return
+
             ydl_opts = {
-                'progress_hooks': [progress_hook],
-                'outtmpl': os.path.join(DOWNLOAD_FOLDER, '%(title)s.%(ext)s'),
-                'ignoreerrors': True,
+                'progress_hooks': [make_progress_hook(job_id)],
+                # The video ID keeps same-titled videos from overwriting each other
+                'outtmpl': os.path.join(job_staging_path(job_id), '%(title)s [%(id)s].%(ext)s'),
                 'no_warnings': True,
                 'noplaylist': True, # Ensure only the single video is downloaded
                 'writethumbnail': True, # Download thumbnail
+                'format': 'bestaudio/best',
             }
 
-            # Enforce Audio + Thumbnail Embedding
-            ydl_opts.update({
-                'format': 'bestaudio/best',
-                'postprocessors': [
-                    {'key': 'FFmpegExtractAudio','preferredcodec': 'mp3','preferredquality': '192'},
-                    {'key': 'EmbedThumbnail'},
-                    {'key': 'FFmpegMetadata'},
-                ],
-            })
+            with download_stage.track() as work, yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                # Download from the cached info dict; if its stream URLs have
+                # gone stale, resolve again from scratch
+                if info:
+                    try:
+                        info = ydl.process_ie_result(info, download=True)
+                    except yt_dlp.utils.DownloadError:
+                        info = None
+                if not downloaded_paths(info):
+                    invalidate_resolved(url)
+                    info = ydl.extract_info(url, download=True)
+                if not downloaded_paths(info):
+                    raise Exception("Download failed")
 
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                
                 # Metadata extraction for DB
                 if 'entries' in info:
                     entries = info['entries']
                 else:
                     entries = [info]
 
+                downloads = []
                 for entry in entries:
                     if not entry: continue
-                    title = entry.get('title', 'Unknown')
-                    # Filename logic is tricky with yt-dlp outtmpl, relying on what we find or reconstructing it
-                    # Simplified: Re-scan directory or trust yt-dlp return (often messy). 
-                    # Better approach: Check what file was created.
-                    # For this implementation, we will use the 'requested_downloads' or search for the title.
-                    # Fallback: We will just save what we know.
-                    
-                    # Get actual filename from yt-dlp
-                    # We need to run prepare_filename on the entry to see what it *would* be
-                    # But post-processing might change extension (e.g. mkv -> mp4, or mp4 -> mp3)
-                    # For audio, we force mp3 in postprocessor.
-                    
-                    # Try to get the exact final filename from yt-dlp's internal state
                     if 'requested_downloads' in entry and entry['requested_downloads']:
-                        final_path = entry['requested_downloads'][0]['filepath']
-                        final_filename = os.path.basename(final_path)
+                        raw_path = entry['requested_downloads'][0]['filepath']
                     else:
-                        # Fallback: Prepare filename and guess extension if requested_downloads is missing
-                        try:
-                            filepath_from_ydl = ydl.prepare_filename(entry)
-                            base_name = os.path.splitext(os.path.basename(filepath_from_ydl))[0]
-                            final_filename = f"{base_name}.mp3"
-                        except Exception as e:
-                            print(f"Error preparing filename: {e}")
-                            final_filename = f"{title}.mp3"
-
-                    # Final verification
-                    expected_path = os.path.join(DOWNLOAD_FOLDER, final_filename)
-                    if not os.path.exists(expected_path):
-                         # Try to find a match by globbing title if strict match fails (due to sanitization)
-                        # This is a fallback
-                        try:
-                            candidates = glob.glob(os.path.join(DOWNLOAD_FOLDER, f"{glob.escape(os.path.splitext(final_filename)[0])}*"))
-                            if not candidates:
-                               candidates = glob.glob(os.path.join(DOWNLOAD_FOLDER, f"{glob.escape(title)}*"))
-                            
-                            if candidates:
-                                # Pick the newest or best match
-                                expected_path = candidates[0]
-                                final_filename = os.path.basename(expected_path)
-                            else:
-                                print(f"Warning: Could not locate file for {title}")
-                                continue
-                        except Exception as e:
-                            print(f"Error in fallback search: {e}")
-                            continue
+                        raw_path = ydl.prepare_filename(entry)
+                    if os.path.exists(raw_path):
+                        work['bytes'] += os.path.getsize(raw_path)
+                    downloads.append((raw_path, entry))
+
+            update_job(job_id, status=JOB_POSTPROCESSING, percentage=100.0, filename='Converting...')
+            submit_postprocess(run_postprocess, job_id, url, user_id, downloads, playlist_id)
+
+        except yt_dlp.utils.DownloadCancelled:
+            db.session.rollback()
+            remove_job_staging(job_id)
+            update_job(job_id, status=JOB_CANCELLED, filename='Download cancelled by user',
+                       finished_at=datetime.utcnow())
+        except Exception as e:
+            db.session.rollback()
+            remove_job_staging(job_id)
+            update_job(job_id, status=JOB_ERROR, error=str(e), finished_at=datetime.utcnow())
 
-                    # Insert into DB
-                    new_media = Media(
-                        user_id=user_id,
-                        filename=final_filename, 
-                        original_url=url,
-                        title=title,
-                        type='audio', # Force type to audio
-                        path=f'/static/downloads/{final_filename}'
+def run_postprocess(job_id, url, user_id, downloads, playlist_id=None):
+    """CPU stage: transcode to MP3, embed thumbnail and tags, then register the media."""
+    with app.app_context(), postprocess_stage.track(queued=True) as work:
+        try:
+            if update_job(job_id, filename='Converting...'):
+                remove_job_staging(job_id)
+                update_job(job_id, status=JOB_CANCELLED, filename='Download cancelled by user',
+                           finished_at=datetime.utcnow())
+                return
+
+            ydl_opts = {
+                'no_warnings': True,
+                'quiet': True,
+                'postprocessors': [
+                    {'key': 'FFmpegExtractAudio','preferredcodec': 'mp3','preferredquality': '192'},
+                    {'key': 'EmbedThumbnail'},
+                    {'key': 'FFmpegMetadata'},
+                ],
+            }
+            stored = []
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                for raw_path, entry in downloads:
+                    title = entry.get('title', 'Unknown')
+                    if os.path.exists(raw_path):
+                        work['bytes'] += os.path.getsize(raw_path)
+                    with timed_ffmpeg('postprocess'):
+                        final_path = ydl.post_process(raw_path, entry)['filepath']
+                    if not os.path.exists(final_path):
+                        raise Exception(f"Converted file not found for {title}")
+                    final_filename = publish_download(final_path)
+
+                    # Insert into DB; if another job stored the same video
+                    # meanwhile, its blob wins and this user just references it
+                    blob = get_or_create_blob(
+                        blob_key(entry.get('extractor_key', 'Generic'), entry.get('id')),
+                        final_filename, title, media_tags(entry)
                     )
-                    db.session.add(new_media)
-                
+                    if link_blob(user_id, blob, url):
+                        stored.append(blob)
+
+            if playlist_id and stored:
+                db.session.flush()
+                add_blobs_to_playlist(playlist_id, user_id, [blob.id for blob in stored])
+            bump_library_version(user_id)
+            db.session.commit()
+            update_job(job_id, status=JOB_DONE, percentage=100.0, filename='',
+                       finished_at=datetime.utcnow())
+            queue_peaks([blob.filename for blob in stored])
+            queue_covers([blob.filename for blob in stored if blob.cover_hash is None])
+
+        except Exception as e:
+            db.session.rollback()
+            update_job(job_id, status=JOB_ERROR, error=str(e), finished_at=datetime.utcnow())
+        finally:
+            remove_job_staging(job_id)
+
+def claim_next_job():
+    """Move the oldest queued job to running and return its id, or None.
+
+    The UPDATE only matches while the row is still queued, so workers in
+    every process can race on the same candidates without double-claiming.
+    Users already running DOWNLOAD_USER_CONCURRENCY jobs are skipped; the
+    UPDATE re-checks the count so racing claims don't overshoot it either.
+    SQLite runs one write at a time, so that count is always current; on
+    PostgreSQL (READ COMMITTED) claims for one user take an advisory lock
+    first, or two claims of different rows would both count the old total.
+    """
+    query = db.select(DownloadJob.id, DownloadJob.user_id).where(DownloadJob.status == JOB_QUEUED)
+    if DOWNLOAD_USER_CONCURRENCY > 0:
+        busy_users = (
+            db.select(DownloadJob.user_id).where(DownloadJob.status == JOB_RUNNING)
+            .group_by(DownloadJob.user_id)
+            .having(db.func.count() >= DOWNLOAD_USER_CONCURRENCY)
+        )
+        query = query.where(DownloadJob.user_id.not_in(busy_users))
+    candidates = db.session.execute(
+        query.order_by(DownloadJob.created_at, DownloadJob.id).limit(DOWNLOAD_WORKERS)
+    ).all()
+    for job_id, user_id in candidates:
+        now = datetime.utcnow()
+        claim = [DownloadJob.id == job_id, DownloadJob.status == JOB_QUEUED]
+        if DOWNLOAD_USER_CONCURRENCY > 0:
+            if db.engine.dialect.name == 'postgresql':
+                # Held until the commit below; the UPDATE then sees every earlier claim
+                db.session.execute(db.text('SELECT pg_advisory_xact_lock(:key, :user_id)'),
+                                   {'key': CLAIM_LOCK_KEY, 'user_id': user_id})
+            running = db.aliased(DownloadJob)
+            claim.append(
+                db.select(db.func.count()).select_from(running)
+                .where(running.user_id == user_id, running.status == JOB_RUNNING)
+                .scalar_subquery() < DOWNLOAD_USER_CONCURRENCY
+            )
+        result = db.session.execute(
+            db.update(DownloadJob)
+            .where(*claim)
+            .values(status=JOB_RUNNING, worker=WORKER_ID, started_at=now,
+                    heartbeat_at=now, attempts=DownloadJob.attempts + 1)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return job_id
+    return None
+
+def _download_worker_loop():
+    while True:
+        job_id = None
+        with app.app_context():
+            try:
+                job_id = claim_next_job()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error claiming download job: {e}")
+        if job_id is None:
+            _job_wakeup.wait(JOB_POLL_INTERVAL)
+            _job_wakeup.clear()
+            continue
+        run_download(job_id)
+
+def _job_supervisor_loop():
+    """Heartbeat this process's jobs and requeue jobs whose worker died."""
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        with app.app_context():
+            try:
+                now = datetime.utcnow()
+                db.session.execute(
+                    db.update(DownloadJob)
+                    .where(DownloadJob.worker == WORKER_ID,
+                           DownloadJob.status.in_((JOB_RUNNING, JOB_POSTPROCESSING)))
+                    .values(heartbeat_at=now)
+                )
+                stale = db.and_(
+                    DownloadJob.status.in_((JOB_RUNNING, JOB_POSTPROCESSING)),
+                    DownloadJob.heartbeat_at < now - timedelta(seconds=JOB_STALE_AFTER),
+                )
+                db.session.execute(
+                    db.update(DownloadJob)
+                    .where(stale, DownloadJob.attempts < JOB_MAX_ATTEMPTS)
+                    .values(status=JOB_QUEUED, worker=None, percentage=0)
+                )
+                db.session.execute(
+                    db.update(DownloadJob)
+                    .where(stale)
+                    .values(status=JOB_ERROR, error='Worker stopped responding', finished_at=now)
+                )
                 db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error supervising download jobs: {e}")
+
+def start_download_workers():
+    """Start this process's download threads (once per process)."""
+    global _download_workers_started, WORKER_ID
+    if _download_workers_started or DOWNLOAD_WORKERS <= 0:
+        return
+    _download_workers_started = True
+    WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+    for i in range(DOWNLOAD_WORKERS):
+        threading.Thread(target=_download_worker_loop, name=f'download-worker-{i}', daemon=True).start()
+    threading.Thread(target=_job_supervisor_loop, name='download-supervisor', daemon=True).start()
+
+# --- Waveform Peaks ---
+# Min/max peaks are computed once per library file by a background stage
+# (ffmpeg decodes to low-rate mono PCM) and stored beside the downloads, so
+# the player draws a waveform from a few KB instead of decoding the track.
+#
+# File layout, little-endian:
+#   header  4s magic 'WPK1', u16 level count, u16 bits per value (8),
+#           u32 decode sample rate, i64 source size, i64 source mtime_ns
+#   levels  per level: u32 samples per peak, u32 peak count
+#   data    per level, in order: peak count (min, max) int8 pairs
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+PEAKS_FOLDER = os.environ.get('PEAKS_FOLDER', os.path.join(DOWNLOAD_FOLDER, '.peaks'))
+PEAKS_WORKERS = int(os.environ.get('PEAKS_WORKERS', '1'))
+PEAKS_SAMPLE_RATE = 8000
+PEAKS_LEVELS = (512, 2048, 8192) # samples per peak, finest first; each a multiple of the first
+PEAKS_MAGIC = b'WPK1'
+PEAKS_HEADER = struct.Struct('<4sHHIqq')
+PEAKS_LEVEL = struct.Struct('<II')
+PEAKS_CACHE_MAX_AGE = 365 * 24 * 3600 # for URLs carrying the current ?v=
+
+Path(PEAKS_FOLDER).mkdir(parents=True, exist_ok=True)
+
+peaks_stage = PipelineStage('peaks')
+_peaks_executor = None
+_peaks_pending = set()
+_peaks_failed = {} # filename -> (size, mtime_ns) of a version ffmpeg couldn't decode
+_peaks_lock = threading.Lock()
+
+def peaks_path(filename):
+    return os.path.join(PEAKS_FOLDER, hashlib.sha1(filename.encode()).hexdigest() + '.peaks')
+
+def _file_signature(filename):
+    try:
+        stat = os.stat(os.path.join(DOWNLOAD_FOLDER, filename))
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def peaks_version(filename):
+    """The ?v= for a file's peaks URL: changes whenever the file on disk (and so its peaks) does."""
+    signature = _file_signature(filename)
+    return f"{signature[0]:x}-{signature[1]:x}" if signature else None
+
+def peaks_failed(filename):
+    return _peaks_failed.get(filename) == _file_signature(filename)
+
+def peaks_fresh(filename):
+    """True if the stored peaks were computed from the current file on disk."""
+    try:
+        stat = os.stat(os.path.join(DOWNLOAD_FOLDER, filename))
+        with open(peaks_path(filename), 'rb') as f:
+            header = f.read(PEAKS_HEADER.size)
+    except OSError:
+        return False
+    if len(header) != PEAKS_HEADER.size:
+        return False
+    magic, _, _, _, size, mtime_ns = PEAKS_HEADER.unpack(header)
+    return magic == PEAKS_MAGIC and size == stat.st_size and mtime_ns == stat.st_mtime_ns
+
+def compute_peaks(path):
+    """Decode path with ffmpeg and return the encoded peaks file contents."""
+    step = PEAKS_LEVELS[0]
+    base = array('b')
+    proc = subprocess.Popen(
+        [FFMPEG_BINARY, '-v', 'error', '-nostdin', '-i', path,
+         '-ac', '1', '-ar', str(PEAKS_SAMPLE_RATE), '-f', 's16le', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    with proc.stdout:
+        while True:
+            # Buffered reads return whole chunks until EOF, so blocks never straddle reads
+            chunk = proc.stdout.read(step * 2 * 64)
+            if not chunk:
+                break
+            samples = array('h')
+            samples.frombytes(chunk[:len(chunk) - len(chunk) % 2])
+            if sys.byteorder == 'big':
+                samples.byteswap()
+            for i in range(0, len(samples), step):
+                block = samples[i:i + step]
+                base.append(min(block) >> 8)
+                base.append(max(block) >> 8)
+    if proc.wait() != 0:
+        raise RuntimeError(f'ffmpeg exited with {proc.returncode}')
+
+    levels = [(step, base)]
+    for samples_per_peak in PEAKS_LEVELS[1:]:
+        ratio = samples_per_peak // step
+        peaks = array('b')
+        for i in range(0, len(base), ratio * 2):
+            group = base[i:i + ratio * 2]
+            peaks.append(min(group[0::2]))
+            peaks.append(max(group[1::2]))
+        levels.append((samples_per_peak, peaks))
+
+    stat = os.stat(path)
+    parts = [PEAKS_HEADER.pack(PEAKS_MAGIC, len(levels), 8, PEAKS_SAMPLE_RATE,
+                               stat.st_size, stat.st_mtime_ns)]
+    parts += [PEAKS_LEVEL.pack(samples_per_peak, len(peaks) // 2) for samples_per_peak, peaks in levels]
+    parts += [peaks.tobytes() for _, peaks in levels]
+    return b''.join(parts)
 
-            current_download_status['status'] = 'completed'
-            
+def run_peaks(filename):
+    try:
+        with peaks_stage.track(queued=True) as work:
+            path = os.path.join(DOWNLOAD_FOLDER, filename)
+            if not os.path.exists(path) or peaks_fresh(filename):
+                return
+            with timed_ffmpeg('peaks'):
+                data = compute_peaks(path)
+            work['bytes'] += os.path.getsize(path)
+            target = peaks_path(filename)
+            tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+    except Exception as e:
+        print(f"Error computing peaks for {filename}: {e}")
+        _peaks_failed[filename] = _file_signature(filename)
+    finally:
+        with _peaks_lock:
+            _peaks_pending.discard(filename)
+
+def queue_peaks(filenames):
+    """Compute peaks in the background for files that don't have current ones."""
+    global _peaks_executor
+    for filename in filenames:
+        if peaks_fresh(filename) or peaks_failed(filename):
+            continue
+        with _peaks_lock:
+            if filename in _peaks_pending:
+                continue
+            _peaks_pending.add(filename)
+            if _peaks_executor is None:
+                _peaks_executor = ThreadPoolExecutor(PEAKS_WORKERS, thread_name_prefix='peaks')
+        peaks_stage.enqueue()
+        _peaks_executor.submit(run_peaks, filename)
+
+# --- Cover Art ---
+# Artwork embedded in library files is extracted once by a background stage
+# and stored as square thumbnails named after a hash of the embedded image,
+# so files sharing an album cover share the thumbnails. Media.cover_hash
+# points at them: None until extracted, '' when the file has no artwork.
+# Thumbnails no media refers to any more are removed by the evictor pass.
+COVER_FOLDER = os.environ.get('COVER_FOLDER', os.path.join(DOWNLOAD_FOLDER, '.covers'))
+COVER_WORKERS = int(os.environ.get('COVER_WORKERS', '1'))
+COVER_CACHE_MAX_AGE = 365 * 24 * 3600
+COVER_SIZES = (96, 256, 512)
+COVER_FORMATS = {
+    # extension: (mimetype, ffmpeg encoder options)
+    'webp': ('image/webp', ['-c:v', 'libwebp', '-quality', '80']),
+    'jpg': ('image/jpeg', ['-c:v', 'mjpeg', '-q:v', '4']),
+}
+COVER_ORPHAN_GRACE = 3600 # seconds before an unreferenced thumbnail may be removed
+
+Path(COVER_FOLDER).mkdir(parents=True, exist_ok=True)
+
+covers_stage = PipelineStage('covers')
+_covers_executor = None
+_covers_pending = set()
+_covers_lock = threading.Lock()
+
+def cover_path(cover_hash, size, ext):
+    return os.path.join(COVER_FOLDER, f"{cover_hash}-{size}.{ext}")
+
+def extract_cover(path):
+    """The artwork embedded in path, as stored (JPEG/PNG bytes), or b'' if there is none."""
+    proc = subprocess.run(
+        [FFMPEG_BINARY, '-v', 'error', '-nostdin', '-i', path, '-map', '0:v:0?',
+         '-frames:v', '1', '-c', 'copy', '-f', 'image2pipe', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60,
+    )
+    return proc.stdout # no video stream: ffmpeg fails with empty output
+
+def write_cover_thumbnails(image, cover_hash):
+    """Encode every size of every format not stored yet, one ffmpeg run per format."""
+    for ext, (_, codec) in COVER_FORMATS.items():
+        if all(os.path.exists(cover_path(cover_hash, size, ext)) for size in COVER_SIZES):
+            continue
+        split = f"[0:v]split={len(COVER_SIZES)}" + ''.join(f"[in{size}]" for size in COVER_SIZES)
+        scales = [f"[in{size}]scale={size}:{size}:force_original_aspect_ratio=increase,"
+                  f"crop={size}:{size}[out{size}]" for size in COVER_SIZES]
+        command = [FFMPEG_BINARY, '-v', 'error', '-nostdin', '-y', '-i', '-',
+                   '-filter_complex', ';'.join([split] + scales)]
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp.{ext}"
+        for size in COVER_SIZES:
+            command += ['-map', f"[out{size}]", '-frames:v', '1', *codec,
+                        cover_path(cover_hash, size, ext) + suffix]
+        try:
+            subprocess.run(command, input=image, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, timeout=60, check=True)
+            for size in COVER_SIZES:
+                os.replace(cover_path(cover_hash, size, ext) + suffix, cover_path(cover_hash, size, ext))
         except Exception as e:
-            current_download_status['status'] = 'error'
-            current_download_status['filename'] = str(e)
+            print(f"Error encoding {ext} cover {cover_hash}: {e}")
+        finally:
+            for size in COVER_SIZES:
+                if os.path.exists(cover_path(cover_hash, size, ext) + suffix):
+                    os.remove(cover_path(cover_hash, size, ext) + suffix)
 
-# --- Routes ---
+def run_covers(filename):
+    with app.app_context(), covers_stage.track(queued=True) as work:
+        try:
+            path = os.path.join(DOWNLOAD_FOLDER, filename)
+            if not os.path.exists(path):
+                return
+            with timed_ffmpeg('covers'):
+                image = extract_cover(path)
+                cover_hash = hashlib.sha256(image).hexdigest()[:24] if image else ''
+                if image:
+                    work['bytes'] += len(image)
+                    write_cover_thumbnails(image, cover_hash)
+            if cover_hash and not any(os.path.exists(cover_path(cover_hash, COVER_SIZES[0], ext))
+                                      for ext in COVER_FORMATS):
+                cover_hash = '' # artwork ffmpeg can't decode
+            # /files pages carry cover_hash, so their ETags must change with it
+            bump_library_versions(
+                db.select(Media.user_id)
+                .where(Media.filename == filename, Media.cover_hash.is_distinct_from(cover_hash))
+            )
+            db.session.execute(db.update(Media).where(Media.filename == filename)
+                               .values(cover_hash=cover_hash))
+            db.session.execute(db.update(MediaBlob).where(MediaBlob.filename == filename)
+                               .values(cover_hash=cover_hash))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error extracting cover for {filename}: {e}")
+        finally:
+            with _covers_lock:
+                _covers_pending.discard(filename)
 
-@app.before_request
-def create_tables():
-    db.create_all()
+def queue_covers(filenames):
+    """Extract cover art in the background for files whose media have no cover_hash yet."""
+    global _covers_executor
+    for filename in filenames:
+        with _covers_lock:
+            if filename in _covers_pending:
+                continue
+            _covers_pending.add(filename)
+            if _covers_executor is None:
+                _covers_executor = ThreadPoolExecutor(COVER_WORKERS, thread_name_prefix='covers')
+        covers_stage.enqueue()
+        _covers_executor.submit(run_covers, filename)
+
+def remove_orphan_covers():
+    """Delete thumbnails of cover hashes no media refers to any more."""
+    referenced = set(db.session.execute(
+        db.select(Media.cover_hash).where(Media.cover_hash.isnot(None)).distinct()
+    ).scalars())
+    cutoff = time.time() - COVER_ORPHAN_GRACE
+    removed = 0
+    with os.scandir(COVER_FOLDER) as entries:
+        for entry in entries:
+            cover_hash = entry.name.split('-', 1)[0]
+            if cover_hash in referenced or entry.stat().st_mtime > cutoff:
+                continue
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+# --- Transcode Variants ---
+# Smaller encodings of library audio for slow links, made on first request
+# and kept in VARIANT_FOLDER under a total byte budget (least recently
+# served evicted first). Names embed the source size and mtime, so a
+# replaced file never serves a stale variant. Concurrent requests for one
+# variant share a single ffmpeg: waiters in this process block on an Event,
+# other processes on a lock file.
+VARIANT_FOLDER = os.environ.get('VARIANT_FOLDER', os.path.join(DOWNLOAD_FOLDER, '.variants'))
+VARIANT_CACHE_MAX_BYTES = int(os.environ.get('VARIANT_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+VARIANT_TRANSCODE_TIMEOUT = int(os.environ.get('VARIANT_TRANSCODE_TIMEOUT', '600'))
+
+# name -> (ffmpeg audio codec args, container format, extension)
+VARIANTS = {
+    'opus64': (['-c:a', 'libopus', '-b:a', '64k'], 'ogg', 'opus'),
+    'opus96': (['-c:a', 'libopus', '-b:a', '96k'], 'ogg', 'opus'),
+    'aac64': (['-c:a', 'aac', '-b:a', '64k', '-movflags', '+faststart'], 'mp4', 'm4a'),
+    'aac96': (['-c:a', 'aac', '-b:a', '96k', '-movflags', '+faststart'], 'mp4', 'm4a'),
+}
+
+Path(VARIANT_FOLDER).mkdir(parents=True, exist_ok=True)
+
+_variants_inflight = {} # target path -> Event set when its transcode finishes
+_variants_lock = threading.Lock()
+
+def variant_path(filename, name):
+    signature = _file_signature(filename)
+    if signature is None:
+        return None
+    size, mtime_ns = signature
+    digest = hashlib.sha1(filename.encode()).hexdigest()
+    return os.path.join(VARIANT_FOLDER, f"{digest}-{size:x}-{mtime_ns:x}.{name}.{VARIANTS[name][2]}")
+
+def remove_variants(filename):
+    digest = hashlib.sha1(filename.encode()).hexdigest()
+    for path in glob.glob(os.path.join(VARIANT_FOLDER, f"{digest}-*")):
+        if path.endswith('.lock'):
+            remove_variant_lock(path)
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def open_variant_lock(target):
+    """Open and exclusively lock target's lock file, waiting for another worker's transcode.
+
+    The lock file can be removed by an eviction while we wait on it; then
+    the lock we got is on a stale file, so lock the current one instead.
+    """
+    path = f"{target}.lock"
+    while True:
+        lock = open(path, 'a')
+        if not fcntl:
+            return lock
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(path).st_ino:
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+def remove_variant_lock(path):
+    """Unlink a variant's lock file unless a worker holds it."""
+    if not fcntl:
+        return # can't tell whether it is held
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.remove(path)
+    except (BlockingIOError, FileNotFoundError):
+        pass # a transcode holds it, or another worker removed it
+    finally:
+        os.close(fd)
+
+def transcode_variant(source, target, name):
+    codec_args, container, _ = VARIANTS[name]
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        subprocess.run(
+            [FFMPEG_BINARY, '-v', 'error', '-nostdin', '-y', '-i', source,
+             '-vn', '-map_metadata', '0', *codec_args, '-f', container, tmp_path],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            timeout=VARIANT_TRANSCODE_TIMEOUT,
+        )
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def enforce_variant_budget(keep=None):
+    """Delete least recently served variants until the cache fits its budget."""
+    entries, locks = [], []
+    with os.scandir(VARIANT_FOLDER) as it:
+        for entry in it:
+            if entry.name.endswith('.lock'):
+                locks.append(entry.path)
+            elif entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    # Locks outliving their variant (held when it was evicted)
+    for path in locks:
+        if not os.path.exists(path[:-len('.lock')]):
+            remove_variant_lock(path)
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= VARIANT_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # evicted by another worker
+        remove_variant_lock(f"{path}.lock")
+        total -= size
+
+def get_variant(filename, name):
+    """Path of the named variant of a library file, transcoding it if needed.
+
+    Returns None if the source is gone or the transcode failed.
+    """
+    target = variant_path(filename, name)
+    if target is None:
+        return None
+    try:
+        os.utime(target) # mtime doubles as last-served time for LRU eviction
+        return target
+    except FileNotFoundError:
+        pass
+
+    with _variants_lock:
+        done = _variants_inflight.get(target)
+        owner = done is None
+        if owner:
+            done = _variants_inflight[target] = threading.Event()
+    if not owner:
+        done.wait(VARIANT_TRANSCODE_TIMEOUT)
+        return target if os.path.exists(target) else None
+
+    try:
+        with open_variant_lock(target): # another worker may be transcoding it
+            if not os.path.exists(target):
+                with timed_ffmpeg('variant'):
+                    transcode_variant(os.path.join(DOWNLOAD_FOLDER, filename), target, name)
+        enforce_variant_budget(keep=target)
+        return target
+    except subprocess.CalledProcessError as e:
+        print(f"Error transcoding {filename} to {name}: {e.stderr.decode(errors='replace').strip()}")
+        return None
+    except Exception as e:
+        print(f"Error transcoding {filename} to {name}: {e}")
+        return None
+    finally:
+        with _variants_lock:
+            _variants_inflight.pop(target, None)
+        done.set()
+
+# --- Playlist Export ---
+# A playlist is exported as one archive (its files plus an M3U) generated on
+# the fly. The archive is laid out up front as a list of segments, each
+# literal bytes, a byte range of a library file, or bytes computed when they
+# are reached (ZIP headers that need the file's CRC-32), so the total length
+# is known before anything is read and a Range request starts at the
+# segment holding its first byte. Files are read in chunks, nothing is
+# buffered whole and nothing is written to disk. ZIPs use store mode (the
+# audio is already compressed) and switch to ZIP64 records past 4 GiB.
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_CRC_CACHE_SIZE = 4096
+ZIP64_LIMIT = 0xFFFFFFFF
+
+_crc_cache = OrderedDict() # (path, size, mtime_ns) -> CRC-32
+_crc_cache_lock = threading.Lock()
+
+def file_crc32(path, size, mtime_ns):
+    """CRC-32 of a library file, cached per file version."""
+    key = (path, size, mtime_ns)
+    with _crc_cache_lock:
+        if key in _crc_cache:
+            _crc_cache.move_to_end(key)
+            return _crc_cache[key]
+    crc = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(EXPORT_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    with _crc_cache_lock:
+        _crc_cache[key] = crc
+        while len(_crc_cache) > EXPORT_CRC_CACHE_SIZE:
+            _crc_cache.popitem(last=False)
+    return crc
+
+def _dos_datetime(timestamp):
+    t = time.localtime(max(timestamp, 315532800)) # DOS dates start in 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+def build_m3u(name, entries):
+    lines = ['#EXTM3U', f'#PLAYLIST:{name}']
+    for entry in entries:
+        lines += [f"#EXTINF:-1,{entry['title']}", entry['arcname'].split('/', 1)[1]]
+    return ('\n'.join(lines) + '\n').encode()
+
+def _zip64_fields(size, offset):
+    # The ZIP64 extra field holds, in this order, whichever values overflow 32 bits
+    return ([size, size] if size >= ZIP64_LIMIT else []) + ([offset] if offset >= ZIP64_LIMIT else [])
+
+def zip_segments(entries):
+    """Segments of a store-mode ZIP; entries are dicts with arcname, size, mtime and data or path/mtime_ns."""
+    segments, members, offset = [], [], 0
+    for entry in entries:
+        name = entry['arcname'].encode()
+        size = entry['size']
+        if 'data' in entry:
+            crc = functools.partial(zlib.crc32, entry['data'])
+        else:
+            crc = functools.partial(file_crc32, entry['path'], size, entry['mtime_ns'])
+        mod_time, mod_date = _dos_datetime(entry['mtime'])
+        zip64 = size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 0x0001, 16, size, size) if zip64 else b''
+
+        def local_header(name=name, size=min(size, ZIP64_LIMIT), crc=crc, extra=extra, zip64=zip64,
+                         mod_time=mod_time, mod_date=mod_date):
+            return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, 0x0800, 0,
+                               mod_time, mod_date, crc(), size, size, len(name), len(extra)) + name + extra
+
+        segments.append((30 + len(name) + len(extra), local_header))
+        segments.append((size, entry['data'] if 'data' in entry else (entry['path'], 0)))
+        members.append((name, size, crc, offset, mod_time, mod_date))
+        offset += 30 + len(name) + len(extra) + size
+
+    def central_directory():
+        records = []
+        for name, size, crc, member_offset, mod_time, mod_date in members:
+            fields = _zip64_fields(size, member_offset)
+            extra = struct.pack(f'<HH{len(fields)}Q', 0x0001, 8 * len(fields), *fields) if fields else b''
+            records.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, 45, 45 if fields else 20, 0x0800, 0,
+                mod_time, mod_date, crc(), min(size, ZIP64_LIMIT), min(size, ZIP64_LIMIT),
+                len(name), len(extra), 0, 0, 0, 0, min(member_offset, ZIP64_LIMIT),
+            ) + name + extra)
+        return b''.join(records)
+
+    central_size = 0
+    for name, size, _, member_offset, _, _ in members:
+        fields = _zip64_fields(size, member_offset)
+        central_size += 46 + len(name) + (4 + 8 * len(fields) if fields else 0)
+    segments.append((central_size, central_directory))
+
+    count = len(members)
+    end = b''
+    if count >= 0xFFFF or central_size >= ZIP64_LIMIT or offset >= ZIP64_LIMIT:
+        end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                           count, count, central_size, offset)
+        end += struct.pack('<IIQI', 0x07064b50, 0, offset + central_size, 1)
+    end += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                       min(central_size, ZIP64_LIMIT), min(offset, ZIP64_LIMIT), 0)
+    segments.append((len(end), end))
+    return segments
+
+def tar_segments(entries):
+    """Segments of a POSIX (pax) TAR; long or non-ASCII names get pax headers."""
+    segments = []
+    for entry in entries:
+        info = tarfile.TarInfo(entry['arcname'])
+        info.size = entry['size']
+        info.mtime = int(entry['mtime'])
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+        segments.append((len(header), header))
+        segments.append((entry['size'], entry['data'] if 'data' in entry else (entry['path'], 0)))
+        padding = -entry['size'] % tarfile.BLOCKSIZE
+        if padding:
+            segments.append((padding, b'\0' * padding))
+    segments.append((2 * tarfile.BLOCKSIZE, b'\0' * (2 * tarfile.BLOCKSIZE)))
+    return segments
+
+def iter_segments(segments, start, stop):
+    """Yield bytes start..stop-1 of the concatenated segments."""
+    position = 0
+    for length, source in segments:
+        if position + length <= start:
+            position += length
+            continue
+        if position >= stop:
+            break
+        skip, take = max(0, start - position), min(length, stop - position)
+        if callable(source):
+            source = source()
+        if isinstance(source, bytes):
+            yield source[skip:take]
+        else:
+            path, base = source
+            with open(path, 'rb') as f:
+                f.seek(base + skip)
+                remaining = take - skip
+                while remaining > 0:
+                    chunk = f.read(min(EXPORT_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError(f"{path} shrank during export")
+                    remaining -= len(chunk)
+                    yield chunk
+        position += length
+
+# --- Metrics Exposition ---
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass # exists but belongs to someone else
+    return True
+
+_metrics_file = None # (pid, snapshot path, lock file held while this process lives)
+
+def _metrics_snapshot_path():
+    """This process's snapshot file; a random suffix keeps a reused pid from sharing it."""
+    global _metrics_file
+    if _metrics_file is None or _metrics_file[0] != os.getpid(): # first write, or forked
+        Path(METRICS_DIR).mkdir(parents=True, exist_ok=True)
+        base = os.path.join(METRICS_DIR, f"{os.getpid()}-{os.urandom(4).hex()}")
+        lock = open(f"{base}.lock", 'w')
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX) # released by the kernel when the process exits
+        _metrics_file = (os.getpid(), f"{base}.json", lock)
+    return _metrics_file[1]
+
+def _snapshot_alive(path, snapshot):
+    """Whether the process that writes this snapshot is still running."""
+    if not fcntl:
+        return _pid_alive(snapshot.get('pid', 0))
+    try:
+        fd = os.open(f"{path[:-len('.json')]}.lock", os.O_RDWR)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_json(path, data):
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+def _merge_snapshot(series, histograms, snapshot, gauges=True):
+    for name, labels, value in snapshot['counters'] + (snapshot.get('gauges', []) if gauges else []):
+        series[(name, tuple(sorted(labels.items())))] += value
+    for name, labels, counts in snapshot['histograms']:
+        key = (name, tuple(sorted(labels.items())))
+        merged = histograms.setdefault(key, [0] * len(counts))
+        if len(merged) == len(counts): # bucket layout unchanged
+            histograms[key] = [a + b for a, b in zip(merged, counts)]
+
+@contextmanager
+def _metrics_dir_lock(exclusive):
+    """Readers share it; folding exited processes into the retired file is exclusive."""
+    Path(METRICS_DIR).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, 'retired.lock'), 'a') as guard:
+        if fcntl:
+            fcntl.flock(guard, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+def retire_dead_snapshots():
+    """Fold the counters and histograms of exited processes into retired.json.
+
+    Their snapshot files are then deleted, so a restarted worker (or a
+    reused pid) never drops totals from the merge. The retired file lists
+    what it already holds, so a crash between writing it and deleting the
+    snapshots can't count them twice.
+    """
+    if not fcntl:
+        return # can't tell exited processes apart safely; their files stay
+    retired_path = os.path.join(METRICS_DIR, 'retired.json')
+    with _metrics_dir_lock(exclusive=True):
+        retired = _read_snapshot(retired_path) or {'counters': [], 'histograms': [], 'folded': []}
+        folded = [name for name in retired['folded'] if os.path.exists(os.path.join(METRICS_DIR, name))]
+        dead = []
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            name = os.path.basename(path)
+            if path == retired_path or name in folded:
+                continue
+            snapshot = _read_snapshot(path)
+            if snapshot is not None and not _snapshot_alive(path, snapshot):
+                dead.append((name, snapshot))
+        if dead:
+            series, histograms = defaultdict(float), {}
+            for snapshot in [retired] + [snapshot for _, snapshot in dead]:
+                _merge_snapshot(series, histograms, snapshot, gauges=False)
+            _write_json(retired_path, {
+                'counters': [[name, dict(labels), value] for (name, labels), value in series.items()],
+                'histograms': [[name, dict(labels), counts] for (name, labels), counts in histograms.items()],
+                'folded': folded + [name for name, _ in dead],
+            })
+            folded += [name for name, _ in dead]
+        for name in folded:
+            for path in (os.path.join(METRICS_DIR, name),
+                         os.path.join(METRICS_DIR, f"{name[:-len('.json')]}.lock")):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+def write_metrics_snapshot():
+    """Write this process's metrics to its snapshot file in METRICS_DIR."""
+    snapshot = metrics.snapshot()
+    stages = (download_stage, postprocess_stage, peaks_stage, covers_stage)
+    for stage in stages:
+        stats = stage.snapshot()
+        snapshot['counters'] += [
+            ['pipeline_stage_items_total', {'stage': stage.name, 'result': 'completed'}, stats['completed']],
+            ['pipeline_stage_items_total', {'stage': stage.name, 'result': 'failed'}, stats['failed']],
+            ['pipeline_stage_bytes_total', {'stage': stage.name}, stats['bytes']],
+            ['pipeline_stage_busy_seconds_total', {'stage': stage.name}, stats['busy_seconds']],
+        ]
+    snapshot['gauges'] = [
+        ['pipeline_stage_queued', {'stage': stage.name}, stage.snapshot()['queued']] for stage in stages
+    ] + [
+        ['pipeline_stage_active', {'stage': stage.name}, stage.snapshot()['active']] for stage in stages
+    ] + [
+        ['db_pool_checked_out', {}, db.engine.pool.checkedout()],
+        ['db_pool_size', {}, db.engine.pool.size()],
+    ]
+    snapshot['pid'] = os.getpid()
+    _write_json(_metrics_snapshot_path(), snapshot)
+
+def collect_metrics():
+    """Merge every process's snapshot and the retired totals with cluster-wide gauges read now.
+
+    Exited processes' counters and histograms still count (they are totals,
+    kept in retired.json); their gauges are dropped.
+    """
+    write_metrics_snapshot()
+    retire_dead_snapshots()
+    series = defaultdict(float)
+    histograms = {}
+    with _metrics_dir_lock(exclusive=False):
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            snapshot = _read_snapshot(path)
+            if snapshot is None:
+                continue
+            if os.path.basename(path) == 'retired.json':
+                _merge_snapshot(series, histograms, snapshot, gauges=False)
+            else:
+                _merge_snapshot(series, histograms, snapshot, gauges=_snapshot_alive(path, snapshot))
+
+    jobs = dict(db.session.execute(
+        db.select(DownloadJob.status, db.func.count())
+        .where(DownloadJob.status.in_(JOB_ACTIVE_STATES))
+        .group_by(DownloadJob.status)
+    ).all())
+    for state in JOB_ACTIVE_STATES:
+        series[('download_jobs', (('status', state),))] = jobs.get(state, 0)
+    files, size = db.session.execute(
+        db.select(db.func.count(), db.func.coalesce(db.func.sum(FileIndex.size_bytes), 0))
+        .where(FileIndex.missing == db.false())
+    ).one()
+    series[('library_files', ())] = files
+    series[('library_bytes', ())] = size
+    series[('user_storage_bytes', ())] = db.session.scalar(
+        db.select(db.func.coalesce(db.func.sum(User.storage_bytes), 0))
+    )
+    disk = shutil.disk_usage(DOWNLOAD_FOLDER)
+    series[('disk_free_bytes', ())] = disk.free
+    series[('disk_total_bytes', ())] = disk.total
+    return series, histograms
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+def render_metrics():
+    """Prometheus text exposition format (0.0.4)."""
+    series, histograms = collect_metrics()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        if kind == 'histogram':
+            for (metric, labels), counts in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], counts[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(counts[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        else:
+            for (metric, labels), value in sorted(series.items()):
+                if metric == name:
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+def _metrics_flusher_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            with app.app_context():
+                write_metrics_snapshot()
+        except Exception as e:
+            print(f"Error writing metrics snapshot: {e}")
+
+def start_metrics_flusher():
+    try:
+        retire_dead_snapshots() # leftovers of workers that ran before this start
+    except OSError as e:
+        print(f"Error retiring metrics snapshots: {e}")
+    if METRICS_FLUSH_INTERVAL > 0:
+        threading.Thread(target=_metrics_flusher_loop, name='metrics-flusher', daemon=True).start()
+
+# --- Schema & Migrations ---
+# The schema is created and migrated once per process start (never per
+# request). Migrations are idempotent and recorded in schema_version, so
+# processes starting together, or an older database, converge safely.
+MIGRATION_LOCK_KEY = 727001
+
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200))
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def _create_indexes(*names):
+    """Create model-declared indexes by name if they don't exist yet."""
+    conn = db.session.connection()
+    indexes = {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+def _add_column(model, name):
+    """ALTER TABLE ... ADD COLUMN for a model column the table doesn't have yet."""
+    conn = db.session.connection()
+    table = model.__table__
+    if name in {c['name'] for c in db.inspect(conn).get_columns(table.name)}:
+        return
+    preparer = conn.dialect.identifier_preparer
+    column_ddl = CreateColumn(table.c[name]).compile(dialect=conn.dialect)
+    conn.execute(db.text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column_ddl}'))
+
+def _migration_001_hot_query_indexes():
+    # Earlier versions could race into duplicate rows; keep the oldest one
+    # so the unique index can be built.
+    db.session.execute(db.text(
+        'DELETE FROM playlist_item WHERE id NOT IN '
+        '(SELECT MIN(id) FROM playlist_item GROUP BY playlist_id, media_id)'
+    ))
+    _create_indexes('ix_media_user_created', 'ix_media_user_filename', 'ix_media_filename',
+                    'ux_playlist_user_name', 'ux_playlist_item_playlist_media')
+
+def _migration_002_library_version():
+    _add_column(User, 'library_version')
+
+def _migration_003_media_blobs():
+    _add_column(Media, 'blob_id')
+    _create_indexes('ix_media_blob_id')
+
+def _migration_004_file_index():
+    _add_column(Media, 'missing')
+
+def _migration_005_search_index():
+    _add_column(Media, 'tags')
+    _add_column(MediaBlob, 'tags')
+    _create_search_index()
+
+def _migration_006_storage_accounting():
+    _add_column(User, 'storage_bytes')
+    _add_column(User, 'storage_quota_bytes')
+    _add_column(Media, 'size_bytes')
+    _add_column(Media, 'last_played_at')
+    _create_indexes('ix_media_user_last_played')
+    db.session.execute(
+        db.update(Media).where(Media.size_bytes.is_(None), Media.blob_id.isnot(None))
+        .values(size_bytes=db.select(MediaBlob.size_bytes).where(MediaBlob.id == Media.blob_id)
+                .scalar_subquery())
+    )
+    # Synced files (and blobs from before sizes were recorded) are measured on disk
+    on_disk = scan_download_folder()
+    unsized = db.session.execute(
+        db.select(Media.filename).where(Media.size_bytes.is_(None)).distinct()
+    ).scalars().all()
+    sizes = [{'name': name, 'size': on_disk[name][0]} for name in unsized if name in on_disk]
+    if sizes:
+        db.session.execute(
+            Media.__table__.update().where(Media.__table__.c.filename == db.bindparam('name'))
+            .values(size_bytes=db.bindparam('size')),
+            sizes,
+        )
+    db.session.execute(db.update(User).values(storage_bytes=(
+        db.select(db.func.coalesce(db.func.sum(Media.size_bytes), 0))
+        .where(Media.user_id == User.id).scalar_subquery()
+    )))
+
+def _migration_007_session_version():
+    _add_column(User, 'session_version')
+
+def _migration_008_download_batches():
+    _add_column(DownloadJob, 'playlist_id')
+
+def _migration_009_change_log():
+    _add_column(User, 'sync_floor')
+    _backfill_change_log()
+    _create_change_log_triggers()
+
+def _migration_010_cover_art():
+    _add_column(Media, 'cover_hash')
+    _add_column(MediaBlob, 'cover_hash')
+    _create_change_log_triggers()
+
+def _migration_011_playlist_positions():
+    _add_column(PlaylistItem, 'position')
+    _create_indexes('ix_playlist_item_position')
+    # Existing items keep their insertion order
+    rows = db.session.execute(
+        db.select(PlaylistItem.id, PlaylistItem.playlist_id)
+        .where(PlaylistItem.position.is_(None))
+        .order_by(PlaylistItem.playlist_id, PlaylistItem.id)
+    ).all()
+    updates, playlist_id, position = [], None, None
+    for row in rows:
+        if row.playlist_id != playlist_id:
+            playlist_id, position = row.playlist_id, None
+        position = position_between(position, None)
+        updates.append({'item_id': row.id, 'position': position})
+    for chunk in _chunks(updates):
+        db.session.execute(
+            PlaylistItem.__table__.update().where(PlaylistItem.__table__.c.id == db.bindparam('item_id'))
+            .values(position=db.bindparam('position')),
+            chunk,
+        )
+
+def _migration_012_change_log_counter():
+    _create_change_log_triggers()
+
+MIGRATIONS = [
+    (1, 'Indexes for media, playlist and playlist_item hot queries', _migration_001_hot_query_indexes),
+    (2, 'Per-user library version counter for /files ETags', _migration_002_library_version),
+    (3, 'Shared media blobs with reference counts', _migration_003_media_blobs),
+    (4, 'File index for incremental library reconciliation', _migration_004_file_index),
+    (5, 'Full-text search index over media title, filename and tags', _migration_005_search_index),
+    (6, 'Per-user storage accounting and last-played tracking', _migration_006_storage_accounting),
+    (7, 'Session version for invalidating cached logins', _migration_007_session_version),
+    (8, 'Playlist target for batch download jobs', _migration_008_download_batches),
+    (9, 'Change log for delta sync', _migration_009_change_log),
+    (10, 'Extracted cover art thumbnails', _migration_010_cover_art),
+    (11, 'Fractional positions for playlist order', _migration_011_playlist_positions),
+    (12, 'Monotonic change log sequence on SQLite', _migration_012_change_log_counter),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def _current_schema_version():
+    try:
+        return db.session.scalar(db.select(db.func.max(SchemaVersion.version))) or 0
+    except Exception:
+        db.session.rollback() # schema_version does not exist yet
+        return 0
+
+@contextmanager
+def _migration_lock():
+    """Serialize migrations across processes (advisory lock on PostgreSQL)."""
+    if db.engine.dialect.name != 'postgresql':
+        yield # SQLite serializes DDL itself; failures are retried by init_db
+        return
+    with db.engine.connect() as conn:
+        conn.execute(db.text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        conn.commit()
+        try:
+            yield
+        finally:
+            conn.execute(db.text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            conn.commit()
+
+def init_db(retries=3):
+    """Create missing tables and apply pending migrations."""
+    with app.app_context():
+        if _current_schema_version() >= SCHEMA_VERSION:
+            return
+        for attempt in range(retries):
+            try:
+                with _migration_lock():
+                    db.create_all()
+                    current = _current_schema_version()
+                    for version, description, migrate in MIGRATIONS:
+                        if version <= current:
+                            continue
+                        migrate()
+                        db.session.add(SchemaVersion(version=version, description=description))
+                        db.session.commit()
+                        print(f"Applied migration {version}: {description}")
+                return
+            except Exception as e:
+                db.session.rollback()
+                if attempt == retries - 1:
+                    raise
+                print(f"Migration attempt failed, retrying: {e}")
+                time.sleep(1)
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the schema and apply pending migrations."""
+    init_db()
+    print(f"Database at schema version {SCHEMA_VERSION}")
+
+@app.cli.command('set-quota')
+@click.argument('username')
+@click.argument('quota_bytes', required=False, type=int)
+def set_quota_command(username, quota_bytes):
+    """Set a user's storage quota in bytes (omit to use STORAGE_QUOTA_BYTES, 0 = unlimited)."""
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f"No such user: {username}")
+    user.storage_quota_bytes = quota_bytes
+    db.session.commit()
+    print(f"Quota for {username}: {quota_bytes if quota_bytes is not None else 'default'}")
+
+# --- Routes ---
 
 @app.route('/')
 @login_required
 def index():
     return render_template('index.html', user=current_user)
 
+@app.route('/sw.js')
+def service_worker():
+    """The offline cache's service worker, served from the root so it controls every page."""
+    response = app.send_static_file('sw.js')
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -257,9 +2895,27 @@ def register():
 @app.route('/logout')
 @login_required
 def logout():
+    invalidate_user(current_user.id)
     logout_user()
     return redirect(url_for('login'))
 
+@app.route('/account/password', methods=['POST'])
+@login_required
+def change_password():
+    """Change the password and sign out every other session."""
+    data = request.json or {}
+    user = db.session.get(User, current_user.id)
+    if not user.check_password(data.get('current_password') or ''):
+        return jsonify({'error': 'Current password is incorrect'}), 403
+    if not data.get('new_password'):
+        return jsonify({'error': 'No new password provided'}), 400
+    user.set_password(data['new_password'])
+    user.session_version = User.session_version + 1
+    db.session.commit()
+    invalidate_user(user.id)
+    login_user(user) # keep this session under the new version
+    return jsonify({'message': 'Password changed'})
+
 @app.route('/health')
 def health():
     """Health check endpoint for Docker and Coolify"""
@@ -271,51 +2927,471 @@ def health():
         return jsonify({'status': 'unhealthy', 'error': str(e)}), 500
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target, aggregated over all gunicorn workers."""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/download', methods=['POST'])
 @login_required
 def download():
-    data = request.json
-    url = data.get('url')
+    """Queue a URL, a list of URLs ("urls") or a playlist URL, one job per entry.
+
+    Entries already stored are linked at once in bulk; the rest are queued
+    and run at most DOWNLOAD_USER_CONCURRENCY at a time. "playlist" names a
+    playlist to collect the media in (true: the source playlist's title),
+    created along with the jobs.
+    """
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls') or ([data['url']] if data.get('url') else [])
     type_format = data.get('type', 'video')
-    
-    if not url: return jsonify({'error': 'No URL provided'}), 400
-    if current_download_status['status'] == 'downloading':
-        return jsonify({'error': 'Download already in progress'}), 409
+    playlist_name = data.get('playlist')
 
-    thread = threading.Thread(target=run_download, args=(url, type_format, current_user.id))
-    thread.daemon = True
-    thread.start()
-    return jsonify({'message': 'Download started'})
+    if not isinstance(urls, list): return jsonify({'error': 'urls must be a list'}), 400
+    if type_format not in DOWNLOAD_TYPES:
+        return jsonify({'error': f"type must be one of: {', '.join(DOWNLOAD_TYPES)}"}), 400
+    if not urls: return jsonify({'error': 'No URL provided'}), 400
+    if not all(isinstance(url, str) and url.strip() for url in urls):
+        return jsonify({'error': 'URLs must be non-empty strings'}), 400
+    if len(urls) > DOWNLOAD_BATCH_MAX:
+        return jsonify({'error': f'At most {DOWNLOAD_BATCH_MAX} URLs per request'}), 400
+
+    entries, source_title = [], None
+    for url in urls:
+        title, expanded = expand_url(url.strip())
+        source_title = source_title or title
+        entries.extend(expanded)
+    entries = entries[:DOWNLOAD_BATCH_MAX]
+    if not entries:
+        return jsonify({'error': 'Playlist is empty'}), 422
+
+    playlist_id = None
+    if playlist_name is True:
+        playlist_name = source_title
+    if playlist_name:
+        playlist_name = str(playlist_name)[:100]
+        db.session.execute(insert_ignore(Playlist).values(user_id=current_user.id, name=playlist_name))
+        playlist_id = db.session.scalar(
+            db.select(Playlist.id).where(Playlist.user_id == current_user.id, Playlist.name == playlist_name)
+        )
+
+    # Already stored for someone: reference it and finish without queueing
+    linked = link_stored_blobs(current_user.id, {entry['key']: entry['url'] for entry in entries})
+    if playlist_id and linked:
+        add_blobs_to_playlist(playlist_id, current_user.id,
+                              [linked[entry['key']] for entry in entries if entry['key'] in linked])
+    now = datetime.utcnow()
+    jobs = []
+    for entry in entries:
+        job = {'user_id': current_user.id, 'url': entry['url'][:500], 'type': type_format,
+               'playlist_id': playlist_id, 'created_at': now, 'status': JOB_QUEUED,
+               'percentage': 0, 'finished_at': None}
+        if entry['key'] in linked:
+            job.update(status=JOB_DONE, percentage=100.0, finished_at=now)
+        jobs.append(job)
+    job_ids = db.session.execute(
+        db.insert(DownloadJob).returning(DownloadJob.id, sort_by_parameter_order=True), jobs
+    ).scalars().all()
+    db.session.commit()
+
+    queued = sum(1 for entry in entries if entry['key'] not in linked)
+    if queued:
+        _job_wakeup.set()
+    if len(entries) == 1:
+        if queued:
+            return jsonify({'message': 'Download queued', 'job_id': job_ids[0]}), 202
+        return jsonify({'message': 'Already in library', 'job_id': job_ids[0]})
+    return jsonify({
+        'message': f'{queued} downloads queued, {len(entries) - queued} already in library',
+        'job_ids': job_ids,
+        'queued': queued,
+        'playlist': playlist_name or None,
+    }), 202 if queued else 200
 
 @app.route('/cancel', methods=['POST'])
 @login_required
 def cancel_download():
-    global current_download_status
-    if current_download_status['status'] in ['starting', 'downloading']:
-        current_download_status['should_cancel'] = True
+    data = request.get_json(silent=True) or {}
+    mine = [DownloadJob.user_id == current_user.id]
+    if data.get('job_id'):
+        mine.append(DownloadJob.id == data['job_id'])
+
+    # Queued jobs are cancelled outright; running ones are flagged and stopped
+    # by their progress hook on the next update.
+    queued = db.session.execute(
+        db.update(DownloadJob)
+        .where(*mine, DownloadJob.status == JOB_QUEUED)
+        .values(status=JOB_CANCELLED, finished_at=datetime.utcnow())
+    ).rowcount
+    running = db.session.execute(
+        db.update(DownloadJob)
+        .where(*mine, DownloadJob.status.in_((JOB_RUNNING, JOB_POSTPROCESSING)))
+        .values(cancel_requested=True)
+    ).rowcount
+    db.session.commit()
+    if queued or running:
         return jsonify({'message': 'Cancellation requested'})
     return jsonify({'error': 'No active download'}), 400
 
 @app.route('/status')
+@login_required
 def status():
-    return jsonify(current_download_status)
+    """Status of the current user's most recent download job."""
+    job = (DownloadJob.query.filter_by(user_id=current_user.id)
+           .order_by(DownloadJob.created_at.desc(), DownloadJob.id.desc()).first())
+    if not job:
+        return jsonify({'status': 'idle', 'percentage': 0, 'filename': '', 'speed': '', 'eta': ''})
+    return jsonify(job.to_dict())
+
+@app.route('/jobs')
+@login_required
+def list_jobs():
+    query = DownloadJob.query.filter_by(user_id=current_user.id)
+    limit = 50
+    if request.args.get('active'):
+        query = query.filter(DownloadJob.status.in_(JOB_ACTIVE_STATES))
+    if request.args.get('ids'): # the jobs of one batch, e.g. ?ids=4,5,6
+        ids = [int(i) for i in request.args['ids'].split(',') if i.isdigit()][:DOWNLOAD_BATCH_MAX]
+        query = query.filter(DownloadJob.id.in_(ids))
+        limit = len(ids)
+    jobs = query.order_by(DownloadJob.created_at.desc(), DownloadJob.id.desc()).limit(limit).all()
+    return jsonify([job.to_dict() for job in jobs])
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+def get_job(job_id):
+    job = DownloadJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/resolve')
+@login_required
+def resolve():
+    """Preview a URL before downloading: title, duration and whether it's already stored."""
+    url = request.args.get('url')
+    if not url: return jsonify({'error': 'No URL provided'}), 400
+
+    info = resolve_url(url)
+    if not info:
+        return jsonify({'error': 'Could not resolve URL'}), 422
+
+    key = blob_key(info.get('extractor_key', 'Generic'), info.get('id'))
+    blob = MediaBlob.query.filter_by(key=key).first()
+    in_library = bool(blob) and db.session.scalar(
+        db.select(Media.id).where(Media.user_id == current_user.id, Media.blob_id == blob.id).limit(1)
+    ) is not None
+    return jsonify({
+        'id': info.get('id'),
+        'extractor': info.get('extractor_key'),
+        'title': info.get('title'),
+        'uploader': info.get('uploader'),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail'),
+        'webpage_url': info.get('webpage_url'),
+        'stored': bool(blob),
+        'in_library': in_library,
+    })
+
+@app.route('/pipeline/stats')
+@login_required
+def pipeline_stats():
+    """Queue depth and throughput of the download, postprocessing and peaks stages.
+
+    Job counts come from the shared queue; stage counters are for the
+    gunicorn worker that answers (identified by 'worker').
+    """
+    counts = dict(db.session.execute(
+        db.select(DownloadJob.status, db.func.count())
+        .where(DownloadJob.status.in_(JOB_ACTIVE_STATES))
+        .group_by(DownloadJob.status)
+    ).all())
+    return jsonify({
+        'worker': WORKER_ID,
+        'jobs': {state: counts.get(state, 0) for state in JOB_ACTIVE_STATES},
+        'stages': {
+            'download': dict(download_stage.snapshot(), workers=DOWNLOAD_WORKERS),
+            'postprocess': dict(postprocess_stage.snapshot(), workers=POSTPROCESS_WORKERS),
+            'peaks': dict(peaks_stage.snapshot(), workers=PEAKS_WORKERS),
+            'covers': dict(covers_stage.snapshot(), workers=COVER_WORKERS),
+        },
+    })
+
+def _job_event_stream(user_id, job_ids, payload):
+    """SSE response that sends payload(jobs) whenever the jobs change, until all are finished.
+
+    The progress hook writes throttled updates to the job rows, so this works
+    whichever gunicorn worker runs the downloads; streams served by the same
+    process are woken immediately through _job_changed. Each poll reads on a
+    short-lived connection, so an open stream holds no pooled connection.
+    """
+    def read_jobs():
+        with db.engine.connect() as conn:
+            rows = conn.execute(
+                db.select(DownloadJob.__table__)
+                .where(DownloadJob.id.in_(job_ids), DownloadJob.user_id == user_id)
+                .order_by(DownloadJob.id)
+            ).all()
+        return [DownloadJob(**row._mapping).to_dict() for row in rows]
+
+    def stream():
+        last_sent = None
+        last_write = time.monotonic()
+        yield f"retry: {int(SSE_POLL_INTERVAL * 2000)}\n\n"
+        while True:
+            jobs = read_jobs()
+            if not jobs:
+                return
+            if jobs != last_sent:
+                yield f"data: {json.dumps(payload(jobs))}\n\n"
+                last_sent = jobs
+                last_write = time.monotonic()
+            elif time.monotonic() - last_write > SSE_KEEPALIVE_INTERVAL:
+                yield ": keepalive\n\n"
+                last_write = time.monotonic()
+            if all(job['status'] in JOB_FINISHED_STATES for job in jobs):
+                return
+            with _job_changed:
+                _job_changed.wait(SSE_POLL_INTERVAL)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _owned_job_ids(user_id, job_ids):
+    """The subset of job_ids owned by user_id, on a session released before streaming."""
+    owned = db.session.execute(
+        db.select(DownloadJob.id).where(DownloadJob.id.in_(job_ids), DownloadJob.user_id == user_id)
+    ).scalars().all()
+    # The stream outlives the request; don't hold a pooled connection (idle
+    # in transaction on PostgreSQL) for as long as the tab stays open
+    db.session.remove()
+    return owned
+
+@app.route('/jobs/<int:job_id>/events')
+@login_required
+def job_events(job_id):
+    """Server-Sent Events stream of one job's progress."""
+    user_id = current_user.id
+    if not _owned_job_ids(user_id, [job_id]):
+        return jsonify({'error': 'Job not found'}), 404
+    return _job_event_stream(user_id, [job_id], lambda jobs: jobs[0])
+
+@app.route('/jobs/events')
+@login_required
+def batch_events():
+    """Server-Sent Events stream of a batch's jobs (?ids=4,5,6): the list, sent on every change."""
+    user_id = current_user.id
+    ids = [int(i) for i in request.args.get('ids', '').split(',') if i.isdigit()][:DOWNLOAD_BATCH_MAX]
+    ids = _owned_job_ids(user_id, ids) if ids else []
+    if not ids:
+        return jsonify({'error': 'Job not found'}), 404
+    return _job_event_stream(user_id, ids, lambda jobs: jobs)
+
+def encode_files_cursor(created_at, media_id):
+    raw = f"{created_at.isoformat()}|{media_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_files_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    created_at, media_id = raw.split('|')
+    return datetime.fromisoformat(created_at), int(media_id)
 
 @app.route('/files')
 @login_required
 def list_files():
-    # Helper: Sync DB with filesystem on list (Optional but good for integrity)
-    # For now, just list DB items
-    media_items = Media.query.filter_by(user_id=current_user.id).order_by(Media.created_at.desc()).all()
-    files = []
-    for item in media_items:
-        files.append({
-            'id': item.id,
-            'filename': item.filename,
-            'path': item.path,
-            'type': item.type,
-            'title': item.title
-        })
-    return jsonify(files)
+    """One page of the user's library, newest first.
+
+    Keyset-paginated on (created_at, id): pass the returned next_cursor back
+    as ?cursor= for the following page. Pages carry an ETag derived from the
+    user's library_version, so unchanged libraries answer 304 without
+    touching the media table.
+    """
+    limit = max(1, min(request.args.get('limit', FILES_PAGE_SIZE, type=int), FILES_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+
+    library_version = db.session.scalar(
+        db.select(User.library_version).where(User.id == current_user.id)
+    )
+    etag = f"lib-{current_user.id}-v{library_version}-{limit}-{cursor or 'first'}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    query = (
+        db.select(Media.id, Media.filename, Media.type, Media.title, Media.missing, Media.cover_hash,
+                  Media.created_at)
+        .where(Media.user_id == current_user.id)
+        .order_by(Media.created_at.desc(), Media.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        try:
+            after_created, after_id = decode_files_cursor(cursor)
+        except (ValueError, UnicodeDecodeError):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        query = query.where(db.tuple_(Media.created_at, Media.id) < (after_created, after_id))
+
+    rows = db.session.execute(query).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    files = [{
+        'id': row.id,
+        'filename': row.filename,
+        'path': f'/media/{row.id}/stream',
+        'type': row.type,
+        'title': row.title,
+        'missing': row.missing,
+        'cover_hash': row.cover_hash or None,
+        'peaks_version': peaks_version(row.filename),
+    } for row in rows]
+
+    response = jsonify({
+        'items': files,
+        'next_cursor': encode_files_cursor(rows[-1].created_at, rows[-1].id) if has_more else None,
+    })
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/usage')
+@login_required
+def usage():
+    """Storage used by the user's library and their quota (0 = unlimited)."""
+    storage_bytes, quota = db.session.execute(
+        db.select(User.storage_bytes, User.storage_quota_bytes).where(User.id == current_user.id)
+    ).one()
+    return jsonify({
+        'storage_bytes': storage_bytes,
+        'quota_bytes': quota if quota is not None else STORAGE_QUOTA_BYTES,
+    })
+
+@app.route('/media/<int:media_id>/played', methods=['POST'])
+@login_required
+def mark_played(media_id):
+    """Record a play; recently played media are evicted last."""
+    updated = db.session.execute(
+        db.update(Media).where(Media.id == media_id, Media.user_id == current_user.id)
+        .values(last_played_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    if not updated:
+        return jsonify({'error': 'File not found'}), 404
+    return jsonify({'message': 'Recorded'})
+
+@app.route('/search')
+@login_required
+def search():
+    """Ranked full-text search over the user's library (?q=&limit=&offset=)."""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'No query provided'}), 400
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    rows = search_media(current_user.id, q, limit + 1, offset)
+    has_more = len(rows) > limit
+    return jsonify({
+        'items': [{
+            'id': row.id,
+            'filename': row.filename,
+            'path': f'/media/{row.id}/stream',
+            'type': row.type,
+            'title': row.title,
+            'missing': bool(row.missing),
+            'cover_hash': row.cover_hash or None,
+            'peaks_version': peaks_version(row.filename),
+        } for row in rows[:limit]],
+        'next_offset': offset + limit if has_more else None,
+    })
+
+@app.route('/sync/changes')
+@login_required
+def sync_changes():
+    """Library changes after ?since=<cursor>, oldest first, for offline clients.
+
+    Each entity appears once with its current state (or in "deleted" if it
+    is gone), so a client that applies the page and stores "cursor" is up to
+    date with everything up to it; keep calling while "has_more". since=0,
+    or "reset" in the answer (cursor too old), means a full copy: the client
+    drops what it has and applies the pages from scratch.
+    """
+    since = max(0, request.args.get('since', 0, type=int))
+    limit = max(1, min(request.args.get('limit', SYNC_PAGE_SIZE, type=int), SYNC_PAGE_SIZE))
+
+    sync_floor = db.session.scalar(db.select(User.sync_floor).where(User.id == current_user.id))
+    reset = 0 < since < sync_floor
+    if reset:
+        since = 0
+    query = (
+        db.select(ChangeLog.entity, ChangeLog.entity_id, ChangeLog.seq, ChangeLog.deleted)
+        .where(ChangeLog.user_id == current_user.id, ChangeLog.seq > since)
+        .order_by(ChangeLog.seq)
+        .limit(limit)
+    )
+    high_water = None
+    if since == 0:
+        # A fresh copy needs no tombstones, but its last page's cursor covers
+        # them, so later pruning doesn't send this client back to a reset
+        high_water = db.session.scalar(
+            db.select(db.func.coalesce(db.func.max(ChangeLog.seq), 0))
+            .where(ChangeLog.user_id == current_user.id)
+        )
+        query = query.where(ChangeLog.deleted.is_(False), ChangeLog.seq <= high_water)
+    changes = db.session.execute(query).all()
+    has_more = len(changes) == limit
+
+    deleted = {entity: [] for entity in CHANGE_LOG_TABLES}
+    changed = {entity: [] for entity in CHANGE_LOG_TABLES}
+    for change in changes:
+        (deleted if change.deleted else changed)[change.entity].append(change.entity_id)
+
+    media, playlists, items = [], [], []
+    if changed['media']:
+        media = [{
+            'id': row.id,
+            'filename': row.filename,
+            'path': f'/media/{row.id}/stream',
+            'type': row.type,
+            'title': row.title,
+            'missing': row.missing,
+            'cover_hash': row.cover_hash or None,
+            'peaks_version': peaks_version(row.filename),
+            'created_at': row.created_at.isoformat() if row.created_at else None,
+        } for row in db.session.execute(
+            db.select(Media.id, Media.filename, Media.type, Media.title, Media.missing, Media.cover_hash,
+                      Media.created_at)
+            .where(Media.user_id == current_user.id, Media.id.in_(changed['media']))
+        )]
+    if changed['playlist']:
+        playlists = [{'id': row.id, 'name': row.name} for row in db.session.execute(
+            db.select(Playlist.id, Playlist.name)
+            .where(Playlist.user_id == current_user.id, Playlist.id.in_(changed['playlist']))
+        )]
+    if changed['playlist_item']:
+        items = [{'id': row.id, 'playlist_id': row.playlist_id, 'media_id': row.media_id,
+                  'position': row.position} for row in db.session.execute(
+            db.select(PlaylistItem.id, PlaylistItem.playlist_id, PlaylistItem.media_id, PlaylistItem.position)
+            .join(Playlist, Playlist.id == PlaylistItem.playlist_id)
+            .where(Playlist.user_id == current_user.id, PlaylistItem.id.in_(changed['playlist_item']))
+        )]
+
+    return jsonify({
+        'user_id': current_user.id,
+        'cursor': high_water if high_water is not None and not has_more
+                  else changes[-1].seq if changes else since,
+        'has_more': has_more,
+        'reset': reset,
+        'media': media,
+        'playlists': playlists,
+        'playlist_items': items,
+        'deleted': deleted,
+    })
 
 @app.route('/delete', methods=['POST'])
 @login_required
@@ -333,14 +3409,15 @@ def delete_file():
         return jsonify({'error': 'File not found'}), 404
         
     try:
-        # Remove from Disk
-        full_path = os.path.join(DOWNLOAD_FOLDER, media.filename)
-        if os.path.exists(full_path):
-            os.remove(full_path)
-        
-        # Remove from DB (Cascade will handle playlist items)
-        db.session.delete(media)
+        # Remove from DB first; the file goes only with its last reference
+        unlink_filename = release_media(media)
+        if unlink_filename:
+            db.session.execute(db.delete(FileIndex).where(FileIndex.name == unlink_filename))
+        bump_library_version(current_user.id)
         db.session.commit()
+
+        if unlink_filename:
+            remove_library_file(unlink_filename)
         return jsonify({'message': 'Deleted'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -349,39 +3426,225 @@ def delete_file():
 @login_required
 def sync_files():
     """Endpoint to discover files on disk not in DB and add them to current user"""
-    # Simple logic: Scan directory, if not in DB, add it.
     # Note: This assigns ALL stray files to the current user. Valid for single-user migration.
-    
-    disk_files = glob.glob(os.path.join(DOWNLOAD_FOLDER, '*'))
-    count = 0
-    for file_path in disk_files:
-        filename = os.path.basename(file_path)
-        if filename.endswith(('.mp4', '.mp3', '.m4a')):
-            exists = Media.query.filter_by(filename=filename).first()
-            if not exists:
-                ftype = 'audio' if filename.endswith(('.mp3', '.m4a')) else 'video'
-                new_media = Media(
-                    user_id=current_user.id,
-                    filename=filename,
-                    title=filename,
-                    type=ftype,
-                    path=f'/static/downloads/{filename}'
-                )
-                db.session.add(new_media)
-                count += 1
+    changes = reconcile_download_folder()
+
+    # Indexed files no media row points at, found with one anti-join
+    stray = dict(db.session.execute(
+        db.select(FileIndex.name, FileIndex.size_bytes)
+        .where(FileIndex.missing == db.false(),
+               ~db.select(Media.id).where(Media.filename == FileIndex.name).exists())
+    ).all())
+    if stray:
+        now = datetime.utcnow()
+        rows = []
+        for filename, size in stray.items():
+            title, tags = read_file_tags(os.path.join(DOWNLOAD_FOLDER, filename))
+            rows.append({
+                'user_id': current_user.id,
+                'filename': filename,
+                'title': title or filename,
+                'size_bytes': size,
+                'tags': tags,
+                'type': 'audio' if filename.endswith(('.mp3', '.m4a')) else 'video',
+                'path': f'/static/downloads/{filename}',
+                'created_at': now,
+            })
+        db.session.execute(db.insert(Media), rows)
+        adjust_storage(current_user.id, sum(stray.values()))
+    if changes['changed']:
+        # Re-extract artwork of files replaced on disk
+        for chunk in _chunks(changes['changed']):
+            bump_library_versions(
+                db.select(Media.user_id).where(Media.filename.in_(chunk), Media.cover_hash.isnot(None))
+            )
+            db.session.execute(db.update(Media).where(Media.filename.in_(chunk)).values(cover_hash=None))
+    if stray:
+        bump_library_version(current_user.id)
     db.session.commit()
-    return jsonify({'message': f'Synced {count} files'})
+    queue_peaks(stray)
+    # Also backfills covers for media stored before covers were extracted
+    queue_covers(db.session.execute(
+        db.select(Media.filename)
+        .where(Media.user_id == current_user.id, Media.cover_hash.is_(None), Media.missing == db.false())
+        .distinct()
+    ).scalars().all())
+    message = f'Synced {len(stray)} files'
+    if changes['missing']:
+        message += f", {len(changes['missing'])} missing on disk"
+    return jsonify({'message': message})
+
+# --- Media Streaming ---
+def send_media_file(full_path):
+    """Serve a library file with Range/206, strong ETag and Last-Modified.
+
+    Behind nginx (MEDIA_ACCEL_REDIRECT) or a server honouring X-Sendfile the
+    transfer is handed off entirely. Under gunicorn, ranged responses are
+    re-wrapped in the server's file wrapper at the range offset so they go
+    out through sendfile() instead of a Python read loop.
+    """
+    filename = os.path.basename(full_path)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    relative_path = os.path.relpath(full_path, DOWNLOAD_FOLDER).replace(os.sep, '/')
+
+    if MEDIA_ACCEL_REDIRECT and not relative_path.startswith('../'):
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f"{MEDIA_ACCEL_REDIRECT.rstrip('/')}/{quote(relative_path)}"
+    elif app.config['USE_X_SENDFILE']:
+        response = send_file(full_path, mimetype=mimetype, conditional=True, etag=True)
+    else:
+        stat = os.stat(full_path)
+        f = open(full_path, 'rb')
+        response = Response(wrap_file(request.environ, f), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = stat.st_size
+        response.last_modified = stat.st_mtime
+        # Strong validator: changes whenever the file is replaced
+        response.set_etag(f"{stat.st_size:x}-{stat.st_mtime_ns:x}")
+        response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+        if (response.status_code == 206
+                and request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')):
+            # gunicorn sends Content-Length bytes from the current offset
+            f.seek(response.content_range.start)
+            response.response = wrap_file(request.environ, f)
+
+    # Per-user content: browsers may reuse it, shared proxies must not
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = MEDIA_CACHE_MAX_AGE
+    return response
+
+@app.route('/media/<int:media_id>/stream')
+@login_required
+def stream_media(media_id):
+    filename = db.session.scalar(
+        db.select(Media.filename).where(Media.id == media_id, Media.user_id == current_user.id)
+    )
+    if not filename:
+        return jsonify({'error': 'File not found'}), 404
+    full_path = safe_join(DOWNLOAD_FOLDER, filename)
+    if not full_path or not os.path.isfile(full_path):
+        return jsonify({'error': 'File not found'}), 404
+    return send_media_file(full_path)
+
+@app.route('/media/<int:media_id>/variant/<name>')
+@login_required
+def stream_variant(media_id, name):
+    """Stream a lower-bitrate encoding of a library file (see VARIANTS)."""
+    if name not in VARIANTS:
+        return jsonify({'error': f"Unknown variant, expected one of: {', '.join(VARIANTS)}"}), 404
+    filename = db.session.scalar(
+        db.select(Media.filename).where(Media.id == media_id, Media.user_id == current_user.id)
+    )
+    if not filename:
+        return jsonify({'error': 'File not found'}), 404
+    full_path = safe_join(DOWNLOAD_FOLDER, filename)
+    if not full_path or not os.path.isfile(full_path):
+        return jsonify({'error': 'File not found'}), 404
+    variant = get_variant(filename, name)
+    if not variant:
+        return jsonify({'error': 'Could not transcode this file'}), 500
+    return send_media_file(variant)
+
+@app.route('/media/<int:media_id>/peaks')
+@login_required
+def media_peaks(media_id):
+    """Waveform peaks for a library file (format in the Waveform Peaks section).
+
+    Answers 202 while the peaks are still being computed. Pass the media's
+    peaks_version as ?v= and the response may be cached for good, since a
+    replaced file comes with a new version.
+    """
+    filename = db.session.scalar(
+        db.select(Media.filename).where(Media.id == media_id, Media.user_id == current_user.id)
+    )
+    if not filename:
+        return jsonify({'error': 'File not found'}), 404
+    full_path = safe_join(DOWNLOAD_FOLDER, filename)
+    if not full_path or not os.path.isfile(full_path):
+        return jsonify({'error': 'File not found'}), 404
+    if peaks_failed(filename):
+        return jsonify({'error': 'No waveform available for this file'}), 404
+    if not peaks_fresh(filename):
+        queue_peaks([filename])
+        response = jsonify({'status': 'pending'})
+        response.status_code = 202
+        response.headers['Retry-After'] = '2'
+        return response
+    # Without the current version the URL may outlive the file, so clients revalidate
+    immutable = request.args.get('v') == peaks_version(filename)
+    response = send_file(peaks_path(filename), mimetype='application/octet-stream',
+                         conditional=True, etag=True,
+                         max_age=PEAKS_CACHE_MAX_AGE if immutable else None)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = immutable or None
+    response.cache_control.no_cache = None if immutable else True
+    return response
+
+@app.route('/media/<int:media_id>/cover')
+@login_required
+def media_cover(media_id):
+    """Cover art thumbnail: ?size= in pixels (the smallest stored size that covers it).
+
+    WebP when the browser accepts it, JPEG otherwise. Pass the media's
+    cover_hash as ?v= and the response may be cached for good, since a new
+    cover comes with a new hash.
+    """
+    cover_hash = db.session.scalar(
+        db.select(Media.cover_hash).where(Media.id == media_id, Media.user_id == current_user.id)
+    )
+    if not cover_hash:
+        return jsonify({'error': 'No cover for this media'}), 404
+    requested = request.args.get('size', COVER_SIZES[1], type=int)
+    size = next((size for size in COVER_SIZES if size >= requested), COVER_SIZES[-1])
+    formats = [ext for ext in COVER_FORMATS if os.path.exists(cover_path(cover_hash, size, ext))]
+    if not formats:
+        return jsonify({'error': 'No cover for this media'}), 404
+    # Only an explicit image/webp counts: browsers without WebP still send */*
+    accepts_webp = any(mimetype == 'image/webp' for mimetype, _ in request.accept_mimetypes)
+    ext = 'webp' if 'webp' in formats and accepts_webp else formats[-1]
+
+    immutable = request.args.get('v') == cover_hash
+    response = send_file(cover_path(cover_hash, size, ext), mimetype=COVER_FORMATS[ext][0],
+                         conditional=True, etag=f"{cover_hash}-{size}.{ext}",
+                         max_age=COVER_CACHE_MAX_AGE if immutable else None)
+    response.vary.add('Accept')
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = immutable or None
+    return response
+
+@app.before_request
+def block_static_downloads():
+    # Library files are only reachable through the ownership check in /media/<id>/stream
+    if request.endpoint == 'static' and (request.view_args or {}).get('filename', '').startswith('downloads/'):
+        return jsonify({'error': 'Not found'}), 404
 
 # --- Playlist DB Routes ---
 @app.route('/playlists', methods=['GET'])
 @login_required
 def get_playlists():
-    playlists = Playlist.query.filter_by(user_id=current_user.id).all()
+    """All playlists with their items, in playlist order, from one query."""
+    rows = db.session.execute(
+        db.select(Playlist.name, Media.id, Media.filename, Media.type, Media.title)
+        .select_from(Playlist)
+        .outerjoin(PlaylistItem, PlaylistItem.playlist_id == Playlist.id)
+        .outerjoin(Media, Media.id == PlaylistItem.media_id)
+        .where(Playlist.user_id == current_user.id)
+        .order_by(Playlist.name, PlaylistItem.position)
+    ).all()
     result = {}
-    for pl in playlists:
-        # Get filenames for this playlist
-        items = [item.media.filename for item in pl.items if item.media] # check if media still exists
-        result[pl.name] = items
+    for row in rows:
+        items = result.setdefault(row.name, [])
+        if row.id is not None: # empty playlist, or media no longer exists
+            items.append({
+                'id': row.id,
+                'filename': row.filename,
+                'path': f'/media/{row.id}/stream',
+                'type': row.type,
+                'title': row.title,
+                'peaks_version': peaks_version(row.filename),
+            })
     return jsonify(result)
 
 @app.route('/playlists', methods=['POST'])
@@ -405,37 +3668,238 @@ def create_playlist():
 @app.route('/playlists/<name>', methods=['DELETE'])
 @login_required
 def delete_playlist(name):
-    pl = Playlist.query.filter_by(user_id=current_user.id, name=name).first()
-    if pl:
-        db.session.delete(pl)
+    pl_id = db.session.scalar(
+        db.select(Playlist.id).where(Playlist.user_id == current_user.id, Playlist.name == name)
+    )
+    if pl_id:
+        db.session.execute(db.delete(PlaylistItem).where(PlaylistItem.playlist_id == pl_id))
+        db.session.execute(
+            db.update(DownloadJob).where(DownloadJob.playlist_id == pl_id).values(playlist_id=None)
+        )
+        db.session.execute(db.delete(Playlist).where(Playlist.id == pl_id))
         db.session.commit()
         return jsonify({'message': 'Deleted'})
     return jsonify({'error': 'Not found'}), 404
 
+@app.route('/playlists/<name>/export')
+@login_required
+def export_playlist(name):
+    """The playlist's files plus an M3U as one download (?format=zip, the default, or tar).
+
+    Generated while it is sent, with Content-Length known up front; Range
+    requests (with If-Range) resume an interrupted export.
+    """
+    archive_format = request.args.get('format', 'zip')
+    if archive_format not in ('zip', 'tar'):
+        return jsonify({'error': 'Format must be zip or tar'}), 400
+    pl_id = db.session.scalar(
+        db.select(Playlist.id).where(Playlist.user_id == current_user.id, Playlist.name == name)
+    )
+    if not pl_id:
+        return jsonify({'error': 'Playlist not found'}), 404
+    rows = db.session.execute(
+        db.select(Media.filename, Media.title)
+        .join(PlaylistItem, PlaylistItem.media_id == Media.id)
+        .where(PlaylistItem.playlist_id == pl_id)
+        .order_by(PlaylistItem.position)
+    ).all()
+
+    folder = re.sub(r'[\\/:*?"<>|]+', '_', name).strip('. ') or 'playlist'
+    entries, seen = [], set()
+    for row in rows:
+        path = safe_join(DOWNLOAD_FOLDER, row.filename)
+        if row.filename in seen or not path or not os.path.isfile(path):
+            continue # duplicate or missing on disk
+        seen.add(row.filename)
+        stat = os.stat(path)
+        entries.append({'arcname': f"{folder}/{row.filename}", 'path': path, 'size': stat.st_size,
+                        'mtime': stat.st_mtime, 'mtime_ns': stat.st_mtime_ns,
+                        'title': row.title or os.path.splitext(row.filename)[0]})
+    m3u = build_m3u(name, entries)
+    entries.append({'arcname': f"{folder}/{folder}.m3u8", 'data': m3u, 'size': len(m3u),
+                    'mtime': max((entry['mtime'] for entry in entries), default=0)})
+
+    segments = zip_segments(entries) if archive_format == 'zip' else tar_segments(entries)
+    total = sum(length for length, _ in segments)
+    # Strong validator over everything the bytes depend on, so a resumed
+    # download never splices two different archives
+    digest = hashlib.sha1(archive_format.encode() + m3u)
+    for entry in entries[:-1]:
+        digest.update(f"{entry['arcname']}|{entry['size']}|{entry['mtime_ns']}".encode())
+
+    response = Response(iter_segments(segments, 0, total), direct_passthrough=True,
+                        mimetype='application/zip' if archive_format == 'zip' else 'application/x-tar')
+    response.content_length = total
+    response.set_etag(digest.hexdigest())
+    response.make_conditional(request, accept_ranges=True, complete_length=total)
+    if response.status_code == 206:
+        response.response = iter_segments(segments, response.content_range.start, response.content_range.stop)
+    download_name = f"{folder}.{archive_format}"
+    response.headers['Content-Disposition'] = (
+        f"attachment; filename=\"{download_name.encode('ascii', 'replace').decode()}\"; "
+        f"filename*=UTF-8''{quote(download_name)}"
+    )
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/playlists/<name>/add', methods=['POST'])
 @login_required
 def add_to_playlist(name):
     data = request.json
     filename = data.get('filename')
-    
-    pl = Playlist.query.filter_by(user_id=current_user.id, name=name).first()
-    media = Media.query.filter_by(user_id=current_user.id, filename=filename).first()
-    
-    if not pl or not media:
+
+    # Resolve playlist and media in one query; duplicates are ignored
+    row = db.session.execute(
+        db.select(Playlist.id, Media.id.label('media_id'))
+        .join(Media, Media.user_id == Playlist.user_id)
+        .where(Playlist.user_id == current_user.id, Playlist.name == name,
+               Media.filename == filename)
+        .limit(1)
+    ).first()
+    if not row:
         return jsonify({'error': 'Playlist or Media not found'}), 404
-        
-    # Check duplicate
-    exists = PlaylistItem.query.filter_by(playlist_id=pl.id, media_id=media.id).first()
-    if not exists:
-        item = PlaylistItem(playlist_id=pl.id, media_id=media.id)
-        db.session.add(item)
-        db.session.commit()
-        
+    append_playlist_items(row.id, [row.media_id])
+    db.session.commit()
+
     return jsonify({'message': 'Added'})
 
+@app.route('/playlists/<name>/items', methods=['POST'])
+@login_required
+def update_playlist_items(name):
+    """Bulk add/remove media IDs: {"add": [ids], "remove": [ids]} in one transaction."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    add_ids = data.get('add') or []
+    remove_ids = data.get('remove') or []
+    if not isinstance(add_ids, list) or not isinstance(remove_ids, list):
+        return jsonify({'error': 'add and remove must be lists of media IDs'}), 400
+    # bool is an int subclass, but True isn't a media ID
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in add_ids + remove_ids):
+        return jsonify({'error': 'Media IDs must be integers'}), 400
+
+    pl_id = db.session.scalar(
+        db.select(Playlist.id).where(Playlist.user_id == current_user.id, Playlist.name == name)
+    )
+    if not pl_id:
+        return jsonify({'error': 'Playlist not found'}), 404
+
+    added = removed = 0
+    if remove_ids:
+        removed = db.session.execute(
+            db.delete(PlaylistItem)
+            .where(PlaylistItem.playlist_id == pl_id, PlaylistItem.media_id.in_(remove_ids))
+        ).rowcount
+    if add_ids:
+        # Only media owned by the caller, appended in request order
+        owned = set(db.session.execute(
+            db.select(Media.id).where(Media.user_id == current_user.id, Media.id.in_(add_ids))
+        ).scalars())
+        added = append_playlist_items(pl_id, [media_id for media_id in add_ids if media_id in owned])
+    db.session.commit()
+    return jsonify({'added': added, 'removed': removed})
+
+@app.route('/playlists/<name>/items', methods=['GET'])
+@login_required
+def get_playlist_items(name):
+    """One window of a playlist's items, in playlist order.
+
+    Keyset-paginated on position: pass the returned next_after back as
+    ?after= for the following window, so any window of a long playlist is
+    one index range scan.
+    """
+    limit = max(1, min(request.args.get('limit', FILES_PAGE_SIZE, type=int), FILES_MAX_PAGE_SIZE))
+    after = request.args.get('after')
+    if after is not None and not POSITION_KEY.match(after):
+        return jsonify({'error': 'Invalid position'}), 400
+
+    pl_id = db.session.scalar(
+        db.select(Playlist.id).where(Playlist.user_id == current_user.id, Playlist.name == name)
+    )
+    if not pl_id:
+        return jsonify({'error': 'Playlist not found'}), 404
+    query = (
+        db.select(PlaylistItem.position, Media.id, Media.filename, Media.type, Media.title,
+                  Media.missing, Media.cover_hash)
+        .join(Media, Media.id == PlaylistItem.media_id)
+        .where(PlaylistItem.playlist_id == pl_id)
+        .order_by(PlaylistItem.position)
+        .limit(limit + 1)
+    )
+    if after is not None:
+        query = query.where(PlaylistItem.position > after)
+
+    rows = db.session.execute(query).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        'items': [{
+            'id': row.id,
+            'filename': row.filename,
+            'path': f'/media/{row.id}/stream',
+            'type': row.type,
+            'title': row.title,
+            'missing': row.missing,
+            'cover_hash': row.cover_hash or None,
+            'peaks_version': peaks_version(row.filename),
+            'position': row.position
+        } for row in rows],
+        'next_after': rows[-1].position if has_more else None,
+    })
+
+@app.route('/playlists/<name>/move', methods=['POST'])
+@login_required
+def move_playlist_item(name):
+    """Move one item: {"id": media_id, "after": media_id or null for the top}.
+
+    Only the moved item's position changes.
+    """
+    data = request.get_json(silent=True) or {}
+    media_id, after_id = data.get('id'), data.get('after')
+    if not isinstance(media_id, int) or not (after_id is None or isinstance(after_id, int)):
+        return jsonify({'error': 'Media IDs must be integers'}), 400
+    if media_id == after_id:
+        return jsonify({'error': 'Cannot move an item after itself'}), 400
+
+    pl_id = db.session.scalar(
+        db.select(Playlist.id).where(Playlist.user_id == current_user.id, Playlist.name == name)
+        .with_for_update()
+    )
+    if not pl_id:
+        return jsonify({'error': 'Playlist not found'}), 404
+    positions = dict(db.session.execute(
+        db.select(PlaylistItem.media_id, PlaylistItem.position)
+        .where(PlaylistItem.playlist_id == pl_id,
+               PlaylistItem.media_id.in_([media_id] if after_id is None else [media_id, after_id]))
+    ).all())
+    if media_id not in positions or (after_id is not None and after_id not in positions):
+        return jsonify({'error': 'Item not in playlist'}), 404
+
+    before = positions.get(after_id)
+    following = (
+        db.select(PlaylistItem.position)
+        .where(PlaylistItem.playlist_id == pl_id, PlaylistItem.media_id != media_id)
+        .order_by(PlaylistItem.position)
+        .limit(1)
+    )
+    if before is not None:
+        following = following.where(PlaylistItem.position > before)
+    position = position_between(before, db.session.scalar(following))
+    db.session.execute(
+        db.update(PlaylistItem)
+        .where(PlaylistItem.playlist_id == pl_id, PlaylistItem.media_id == media_id)
+        .values(position=position)
+    )
+    db.session.commit()
+    return jsonify({'position': position})
+
+init_db()
+start_download_workers()
+start_library_watcher()
+start_storage_evictor()
+start_housekeeping()
+start_metrics_flusher()
+
 if __name__ == '__main__':
-    # Initial DB Create handled by before_request first run or manual
-    # But better to do it here
-    with app.app_context():
-        db.create_all()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the media player.
+
+Seeds a throwaway database with users, media and playlists, starts the app
+under gunicorn and drives /files, /playlists, /status, /download and media
+streaming concurrently. Downloads point at a local HTTP server that stands in
+for YouTube, so the full download/postprocess pipeline runs without network.
+
+Reports p50/p95/p99 latency, throughput and SQL queries per request for each
+endpoint, and can write the results as JSON to compare runs:
+
+    python bench/loadtest.py --users 20 --media 1000 --duration 30 --json before.json
+    python bench/loadtest.py --users 20 --media 1000 --duration 30 --compare before.json
+
+Requires ffmpeg (to generate the stand-in audio) and gunicorn.
+"""
+
+import argparse
+import http.server
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import requests
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'bench-password'
+DEFAULT_MIX = 'files=30,playlists=20,status=20,stream=25,download=5'
+STREAM_CHUNK = 64 * 1024
+SEED_CHUNK = 5000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    seed = parser.add_argument_group('dataset')
+    seed.add_argument('--users', type=int, default=10)
+    seed.add_argument('--media', type=int, default=500, help='media rows per user')
+    seed.add_argument('--playlists', type=int, default=5, help='playlists per user')
+    seed.add_argument('--playlist-items', type=int, default=50, help='items per playlist')
+    seed.add_argument('--files', type=int, default=20, help='distinct files on disk backing the media rows')
+    seed.add_argument('--file-size', type=int, default=2 * 1024 * 1024, help='bytes per seeded file')
+    seed.add_argument('--database-url', help='scratch database to fill (default: a temporary SQLite file)')
+
+    server = parser.add_argument_group('server')
+    server.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    server.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    server.add_argument('--download-workers', type=int, default=1, help='DOWNLOAD_WORKERS per gunicorn worker')
+
+    load = parser.add_argument_group('load')
+    load.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    load.add_argument('--duration', type=float, default=20, help='seconds of load')
+    load.add_argument('--mix', default=DEFAULT_MIX, help=f'endpoint weights (default: {DEFAULT_MIX})')
+    load.add_argument('--drain', type=float, default=60, help='seconds to wait for queued downloads afterwards')
+    load.add_argument('--seed', type=int, default=1, help='random seed for reproducible request sequences')
+
+    output = parser.add_argument_group('output')
+    output.add_argument('--json', help='write results to this file')
+    output.add_argument('--compare', help='print deltas against a previous --json result')
+    output.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    return parser.parse_args()
+
+
+# --- Stand-in media source ---
+
+def generate_audio(path, seconds=20):
+    subprocess.run(
+        ['ffmpeg', '-v', 'error', '-nostdin', '-y', '-f', 'lavfi',
+         '-i', f'sine=frequency=440:duration={seconds}', '-c:a', 'aac', '-b:a', '128k', path],
+        check=True,
+    )
+
+
+def start_source_server(audio_path):
+    """Serve the same audio for any /track/<n>.m4a, like a direct media URL."""
+    with open(audio_path, 'rb') as f:
+        body = f.read()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mp4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+
+        def do_GET(self):
+            self.do_HEAD()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+# --- Dataset ---
+
+def seed_database(app_module, args, filenames):
+    """Bulk-insert users, media and playlists; returns the per-user fixtures clients use."""
+    m = app_module
+    db = m.db
+    with m.app.app_context():
+        password_hash = m.generate_password_hash(PASSWORD) # hashing is slow, share one
+        db.session.execute(db.insert(m.User), [
+            {'username': f'bench{i}', 'password_hash': password_hash} for i in range(args.users)
+        ])
+        users = db.session.execute(
+            db.select(m.User.id, m.User.username).where(m.User.username.like('bench%'))
+        ).all()
+
+        start = datetime.utcnow() - timedelta(days=30)
+        rows = []
+        for user_id, _ in users:
+            for j in range(args.media):
+                filename = filenames[j % len(filenames)]
+                rows.append({
+                    'user_id': user_id,
+                    'filename': filename,
+                    'title': f'Bench track {j}',
+                    'type': 'audio',
+                    'path': f'/static/downloads/{filename}',
+                    'created_at': start + timedelta(seconds=j),
+                    'size_bytes': args.file_size,
+                })
+        for i in range(0, len(rows), SEED_CHUNK):
+            db.session.execute(db.insert(m.Media), rows[i:i + SEED_CHUNK])
+        db.session.execute(db.update(m.User).where(m.User.username.like('bench%')).values(
+            storage_bytes=args.media * args.file_size
+        ))
+
+        media_ids = defaultdict(list)
+        for media_id, user_id in db.session.execute(db.select(m.Media.id, m.Media.user_id)):
+            media_ids[user_id].append(media_id)
+
+        rng = random.Random(args.seed)
+        db.session.execute(db.insert(m.Playlist), [
+            {'user_id': user_id, 'name': f'Playlist {k}'}
+            for user_id, _ in users for k in range(args.playlists)
+        ])
+        items = []
+        for playlist_id, user_id in db.session.execute(db.select(m.Playlist.id, m.Playlist.user_id)):
+            picks = rng.sample(media_ids[user_id], min(args.playlist_items, len(media_ids[user_id])))
+            position = None
+            for media_id in picks:
+                position = m.position_between(position, None)
+                items.append({'playlist_id': playlist_id, 'media_id': media_id, 'position': position})
+        for i in range(0, len(items), SEED_CHUNK):
+            db.session.execute(db.insert(m.PlaylistItem), items[i:i + SEED_CHUNK])
+        db.session.commit()
+        return [{'username': username, 'media_ids': media_ids[user_id]} for user_id, username in users]
+
+
+# --- Server ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(args, env, log_path):
+    port = free_port()
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--worker-class', 'gthread',
+             '--workers', str(args.workers), '--threads', str(args.threads),
+             '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app'],
+            cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with {proc.returncode}, see {log_path}')
+        try:
+            if requests.get(f'{base}/health', timeout=5).status_code == 200:
+                return proc, base
+        except requests.RequestException:
+            pass # workers still booting
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('gunicorn did not become healthy within 60s')
+
+
+# --- Load ---
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list) # endpoint -> [(latency_ms, status, queries)]
+        self.failures = defaultdict(int) # endpoint -> connection errors
+
+    def add(self, endpoint, latency_ms, status, queries):
+        with self.lock:
+            self.samples[endpoint].append((latency_ms, status, queries))
+
+    def fail(self, endpoint):
+        with self.lock:
+            self.failures[endpoint] += 1
+
+
+def client_loop(index, fixture, base, source, mix, deadline, recorder, track_ids, seed):
+    rng = random.Random(seed + index)
+    session = requests.Session()
+    session.post(f'{base}/login', data={'username': fixture['username'], 'password': PASSWORD},
+                 allow_redirects=False)
+    endpoints, weights = zip(*mix.items())
+
+    while time.time() < deadline:
+        endpoint = rng.choices(endpoints, weights)[0]
+        try:
+            started = time.perf_counter()
+            if endpoint == 'files':
+                response = session.get(f'{base}/files', params={'limit': 200})
+            elif endpoint == 'playlists':
+                response = session.get(f'{base}/playlists')
+            elif endpoint == 'status':
+                response = session.get(f'{base}/status')
+            elif endpoint == 'stream':
+                media_id = rng.choice(fixture['media_ids'])
+                response = session.get(f'{base}/media/{media_id}/stream',
+                                       headers={'Range': f'bytes=0-{STREAM_CHUNK - 1}'})
+            elif endpoint == 'download':
+                response = session.post(f'{base}/download',
+                                        json={'url': f'{source}/track/{next(track_ids)}.m4a'})
+            else:
+                raise ValueError(f'Unknown endpoint in --mix: {endpoint}')
+            response.content # include the body transfer
+            latency_ms = (time.perf_counter() - started) * 1000
+        except requests.RequestException:
+            recorder.fail(endpoint)
+            continue
+        queries = response.headers.get('X-Query-Count')
+        recorder.add(endpoint, latency_ms, response.status_code, int(queries) if queries else None)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint, samples in sorted(recorder.samples.items()):
+        latencies = sorted(s[0] for s in samples)
+        queries = [s[2] for s in samples if s[2] is not None]
+        statuses = defaultdict(int)
+        for _, status, _ in samples:
+            statuses[str(status)] += 1
+        endpoints[endpoint] = {
+            'requests': len(samples),
+            'errors': sum(1 for s in samples if s[1] >= 500) + recorder.failures[endpoint],
+            'status_codes': dict(statuses),
+            'throughput_rps': round(len(samples) / elapsed, 2),
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies), 2),
+                'p50': round(percentile(latencies, 50), 2),
+                'p95': round(percentile(latencies, 95), 2),
+                'p99': round(percentile(latencies, 99), 2),
+                'max': round(latencies[-1], 2),
+            },
+            'queries_per_request': {
+                'mean': round(sum(queries) / len(queries), 2) if queries else None,
+                'max': max(queries) if queries else None,
+            },
+        }
+    total = sum(e['requests'] for e in endpoints.values())
+    return endpoints, {
+        'requests': total,
+        'errors': sum(e['errors'] for e in endpoints.values()),
+        'throughput_rps': round(total / elapsed, 2),
+        'elapsed_seconds': round(elapsed, 2),
+    }
+
+
+def drain_downloads(app_module, timeout):
+    """Wait for queued downloads to finish; summarize job outcomes and durations."""
+    m = app_module
+    deadline = time.time() + timeout
+    with m.app.app_context():
+        while time.time() < deadline:
+            active = m.db.session.scalar(
+                m.db.select(m.db.func.count()).where(m.DownloadJob.status.in_(m.JOB_ACTIVE_STATES))
+            )
+            m.db.session.rollback()
+            if not active:
+                break
+            time.sleep(0.5)
+        jobs = m.db.session.execute(
+            m.db.select(m.DownloadJob.status, m.DownloadJob.created_at, m.DownloadJob.finished_at)
+        ).all()
+    durations = sorted((j.finished_at - j.created_at).total_seconds() * 1000
+                       for j in jobs if j.status == m.JOB_DONE and j.finished_at)
+    statuses = defaultdict(int)
+    for job in jobs:
+        statuses[job.status] += 1
+    return {
+        'jobs': dict(statuses),
+        'duration_ms': {
+            'p50': round(percentile(durations, 50), 2) if durations else None,
+            'p95': round(percentile(durations, 95), 2) if durations else None,
+            'p99': round(percentile(durations, 99), 2) if durations else None,
+        },
+    }
+
+
+# --- Reporting ---
+
+def print_report(results):
+    print(f"\n{'endpoint':<10} {'reqs':>7} {'err':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'queries':>8}")
+    for name, e in results['endpoints'].items():
+        lat = e['latency_ms']
+        queries = e['queries_per_request']['mean']
+        print(f"{name:<10} {e['requests']:>7} {e['errors']:>5} {e['throughput_rps']:>8} "
+              f"{lat['p50']:>9} {lat['p95']:>9} {lat['p99']:>9} {queries if queries is not None else '-':>8}")
+    overall = results['overall']
+    print(f"\ntotal: {overall['requests']} requests, {overall['errors']} errors, "
+          f"{overall['throughput_rps']} req/s over {overall['elapsed_seconds']}s")
+    downloads = results['downloads']
+    print(f"downloads: {downloads['jobs']}, p50 {downloads['duration_ms']['p50']} ms, "
+          f"p95 {downloads['duration_ms']['p95']} ms")
+
+
+def print_comparison(results, baseline):
+    def delta(new, old):
+        if new is None or not old:
+            return '-'
+        return f'{(new - old) / old * 100:+.1f}%'
+
+    print(f"\nvs {baseline['meta'].get('git_commit') or 'baseline'} ({baseline['meta']['started_at']}):")
+    print(f"{'endpoint':<10} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>9} {'queries':>9}")
+    for name, e in results['endpoints'].items():
+        old = baseline['endpoints'].get(name)
+        if not old:
+            continue
+        print(f"{name:<10} "
+              + ' '.join(f"{delta(e['latency_ms'][p], old['latency_ms'][p]):>9}" for p in ('p50', 'p95', 'p99'))
+              + f" {delta(e['throughput_rps'], old['throughput_rps']):>9}"
+              + f" {delta(e['queries_per_request']['mean'], old['queries_per_request']['mean']):>9}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    mix = {name: float(weight) for name, weight in (part.split('=') for part in args.mix.split(','))}
+    workdir = tempfile.mkdtemp(prefix='media-bench-')
+    download_folder = os.path.join(workdir, 'downloads')
+    os.makedirs(download_folder)
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    env = dict(os.environ, DATABASE_URL=database_url, DOWNLOAD_FOLDER=download_folder,
+               LIBRARY_WATCH_INTERVAL='0', STORAGE_EVICT_INTERVAL='0')
+    server = proc = None
+    try:
+        print(f'Preparing dataset in {workdir}')
+        source_audio = os.path.join(workdir, 'source.m4a')
+        generate_audio(source_audio)
+        filenames = []
+        payload = os.urandom(args.file_size)
+        for i in range(args.files):
+            filenames.append(f'bench-{i}.mp3')
+            with open(os.path.join(download_folder, filenames[-1]), 'wb') as f:
+                f.write(payload)
+
+        # Import the app here only to create the schema and seed it
+        os.environ.update(env, DOWNLOAD_WORKERS='0')
+        sys.path.insert(0, APP_DIR)
+        import app as app_module
+        seed_started = time.time()
+        fixtures = seed_database(app_module, args, filenames)
+        print(f'Seeded {args.users} users x {args.media} media, {args.playlists} playlists x '
+              f'{args.playlist_items} items in {time.time() - seed_started:.1f}s')
+
+        server, source = start_source_server(source_audio)
+        proc, base = start_gunicorn(args, dict(env, QUERY_COUNT_HEADER='1',
+                                               DOWNLOAD_WORKERS=str(args.download_workers)),
+                                    os.path.join(workdir, 'gunicorn.log'))
+        print(f'gunicorn at {base} ({args.workers} workers x {args.threads} threads), '
+              f'{args.concurrency} clients for {args.duration}s')
+
+        recorder = Recorder()
+        track_ids = itertools.count()
+        started_at = datetime.utcnow()
+        started = time.time()
+        deadline = started + args.duration
+        clients = [threading.Thread(target=client_loop, args=(
+            i, fixtures[i % len(fixtures)], base, source, mix, deadline, recorder, track_ids, args.seed
+        )) for i in range(args.concurrency)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - started
+
+        endpoints, overall = summarize(recorder, elapsed)
+        results = {
+            'meta': {
+                'started_at': started_at.isoformat(),
+                'git_commit': git_commit(),
+                'python': platform.python_version(),
+                'database': database_url.split(':', 1)[0],
+                'args': {k: v for k, v in vars(args).items() if k not in ('json', 'compare', 'database_url')},
+            },
+            'endpoints': endpoints,
+            'overall': overall,
+            'downloads': drain_downloads(app_module, args.drain),
+        }
+        print_report(results)
+        if args.compare:
+            with open(args.compare) as f:
+                print_comparison(results, json.load(f))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f'\nResults written to {args.json}')
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=30)
+        if server:
+            server.shutdown()
+        if args.keep:
+            print(f'Kept {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+// Offline cache for the player.
+//
+// The page shell is network-first with a cached fallback, so the player
+// still opens without a connection. Waveform peaks requested with their
+// version (?v=) never change and are cache-first, older versions of the same
+// peaks dropped when a new one is stored; unversioned peaks are network-first.
+// Audio and variants are
+// cache-first: the first full fetch of a track is split between the player
+// and the cache, so it is downloaded once, and later plays (and Range
+// requests) are answered from the cached copy. The media cache is capped at
+// MEDIA_CACHE_MAX_BYTES, evicting the least recently used files; the page
+// also removes the cached files of media that sync reports as deleted.
+const SHELL_CACHE = 'shell-v1';
+const MEDIA_CACHE = 'media-v2';
+const MEDIA_CACHE_MAX_BYTES = 512 * 1024 * 1024;
+const MEDIA_PATH = /^\/media\/\d+\/(stream|variant\/\w+)$/;
+const PEAKS_PATH = /^\/media\/\d+\/peaks$/;
+const TOUCH_INTERVAL = 60 * 1000; // ms between last-used updates of one entry
+const caching = new Set(); // URLs being fetched into MEDIA_CACHE
+const touched = new Map(); // URL -> when its last-used time was last written
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil((async () => {
+        for (const name of await caches.keys()) {
+            if (![SHELL_CACHE, MEDIA_CACHE].includes(name)) await caches.delete(name);
+        }
+        await self.clients.claim();
+    })());
+});
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    const url = new URL(request.url);
+
+    if (url.origin === location.origin && MEDIA_PATH.test(url.pathname)) {
+        event.respondWith(fromMediaCache(event, url));
+    } else if (url.origin === location.origin && PEAKS_PATH.test(url.pathname)) {
+        event.respondWith(url.searchParams.has('v') ? versionedPeaks(request, url) : networkFirst(request, MEDIA_CACHE));
+    } else if (request.mode === 'navigate' && url.pathname === '/' ||
+               url.origin !== location.origin && ['script', 'style', 'font'].includes(request.destination)) {
+        event.respondWith(networkFirst(request));
+    }
+});
+
+async function networkFirst(request, cacheName = SHELL_CACHE) {
+    const cache = await caches.open(cacheName);
+    try {
+        const response = await fetch(request);
+        // Logged-out visits are redirected to /login, and peaks still being
+        // computed answer 202; only cache complete answers
+        if (response.status === 200 && !response.redirected || response.type === 'opaque') {
+            await cache.put(request, response.clone());
+        }
+        return response;
+    } catch (e) {
+        const cached = await cache.match(request);
+        if (cached) return cached;
+        throw e;
+    }
+}
+
+async function versionedPeaks(request, url) {
+    const cache = await caches.open(MEDIA_CACHE);
+    const cached = await cache.match(request);
+    if (cached) return cached;
+    const response = await fetch(request);
+    // A stale ?v= is answered with the current peaks but not as immutable;
+    // only keep what the server says can't change
+    if (response.status === 200 && /\bimmutable\b/.test(response.headers.get('Cache-Control') || '')) {
+        for (const key of await cache.keys()) {
+            const old = new URL(key.url);
+            if (old.pathname === url.pathname && old.search !== url.search) await cache.delete(key);
+        }
+        await cache.put(request, response.clone());
+    }
+    return response;
+}
+
+async function fromMediaCache(event, url) {
+    const key = url.origin + url.pathname;
+    const range = event.request.headers.get('Range');
+    const cached = await caches.match(key, { cacheName: MEDIA_CACHE });
+    if (cached) {
+        event.waitUntil(touchEntry(key));
+        return rangeResponse(cached, range);
+    }
+
+    // Only a request for the whole file can fill the cache; seeks into an
+    // uncached track, or a fill already under way, go straight to the network
+    if (range && !/^bytes=0-$/.test(range) || caching.has(key)) return fetch(event.request);
+    caching.add(key);
+    let response;
+    try {
+        response = await fetch(key, { credentials: 'same-origin' });
+    } catch (e) {
+        caching.delete(key);
+        throw e;
+    }
+    if (response.status !== 200 || !response.body) {
+        caching.delete(key);
+        return response;
+    }
+    // One download, two readers: the player plays its branch while the
+    // other is written to the cache (and keeps going if playback stops)
+    const [playback, copy] = response.body.tee();
+    event.waitUntil(storeEntry(key, copy, response.headers).finally(() => caching.delete(key)));
+    return new Response(playback, { status: 200, statusText: response.statusText, headers: response.headers });
+}
+
+async function storeEntry(key, body, headers) {
+    let size = 0;
+    const counted = body.pipeThrough(new TransformStream({
+        transform(chunk, controller) {
+            size += chunk.byteLength;
+            controller.enqueue(chunk);
+        },
+    }));
+    try {
+        await (await caches.open(MEDIA_CACHE)).put(key, new Response(counted, { headers }));
+        await indexPut({ url: key, size, usedAt: Date.now() });
+        await evictMedia();
+    } catch (e) {
+        console.error(e);
+    }
+}
+
+// Size and last use of each cached file, kept in IndexedDB next to the cache
+function openIndex() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open('media-cache-index', 1);
+        open.onupgradeneeded = () => open.result.createObjectStore('entries', { keyPath: 'url' });
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+async function indexRequest(mode, fn) {
+    const db = await openIndex();
+    return new Promise((resolve, reject) => {
+        const tx = db.transaction('entries', mode);
+        const request = fn(tx.objectStore('entries'));
+        tx.oncomplete = () => { db.close(); resolve(request && request.result); };
+        tx.onerror = tx.onabort = () => { db.close(); reject(tx.error); };
+    });
+}
+
+const indexPut = (entry) => indexRequest('readwrite', store => store.put(entry));
+const indexDelete = (url) => indexRequest('readwrite', store => store.delete(url));
+
+async function touchEntry(key) {
+    const now = Date.now();
+    if (now - (touched.get(key) || 0) < TOUCH_INTERVAL) return;
+    touched.set(key, now);
+    try {
+        const entry = await indexRequest('readonly', store => store.get(key));
+        if (entry) await indexPut({ ...entry, usedAt: now });
+    } catch (e) {
+        console.error(e);
+    }
+}
+
+async function evictMedia() {
+    const cache = await caches.open(MEDIA_CACHE);
+    const present = new Set((await cache.keys()).map(request => request.url));
+    const entries = await indexRequest('readonly', store => store.getAll());
+    let total = 0;
+    for (const entry of entries) {
+        if (present.has(entry.url)) total += entry.size;
+        else await indexDelete(entry.url); // removed by the page after a sync
+    }
+    entries.sort((a, b) => a.usedAt - b.usedAt);
+    for (const entry of entries) {
+        if (total <= MEDIA_CACHE_MAX_BYTES) break;
+        if (!present.has(entry.url) || caching.has(entry.url)) continue;
+        await cache.delete(entry.url);
+        await indexDelete(entry.url);
+        touched.delete(entry.url);
+        total -= entry.size;
+    }
+}
+
+async function rangeResponse(response, range) {
+    const match = range && /^bytes=(\d*)-(\d*)$/.exec(range);
+    if (!match) return response;
+    const blob = await response.blob();
+    let start = match[1] === '' ? blob.size - Number(match[2]) : Number(match[1]);
+    let end = match[1] === '' || match[2] === '' ? blob.size - 1 : Math.min(Number(match[2]), blob.size - 1);
+    start = Math.max(0, start);
+    if (start > end) {
+        return new Response(null, { status: 416, headers: { 'Content-Range': `bytes */${blob.size}` } });
+    }
+    return new Response(blob.slice(start, end + 1), {
+        status: 206,
+        headers: {
+            'Content-Type': response.headers.get('Content-Type') || 'application/octet-stream',
+            'Content-Length': String(end - start + 1),
+            'Content-Range': `bytes ${start}-${end}/${blob.size}`,
+            'Accept-Ranges': 'bytes',
+        },
+    });
+}
@@ -0,0 +1,136 @@
+"""Shared fixtures: the app module against a throwaway SQLite database.
+
+app.py reads its configuration from the environment when it is imported,
+so everything is pointed at a temporary directory before the import and
+background threads that would race the tests are switched off.
+
+Tests that need a database of their own (database_url) start the app in a
+new process against it. Set TEST_POSTGRES_URL to a database the tests may
+create schemas in to run those on PostgreSQL as well; each test works in
+its own schema and drops it afterwards.
+"""
+import atexit
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+import sqlalchemy as sa
+
+TEST_ROOT = tempfile.mkdtemp(prefix='media-player-tests-')
+atexit.register(shutil.rmtree, TEST_ROOT, ignore_errors=True)
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(TEST_ROOT, 'test.db')}",
+    'DOWNLOAD_FOLDER': os.path.join(TEST_ROOT, 'downloads'),
+    'METRICS_DIR': os.path.join(TEST_ROOT, 'metrics'),
+    'SESSION_INVALIDATION_LOG': os.path.join(TEST_ROOT, 'sessions.log'),
+    'DOWNLOAD_WORKERS': '0',
+    'LIBRARY_WATCH_INTERVAL': '0',
+    'STORAGE_EVICT_INTERVAL': '0',
+    'HOUSEKEEPING_INTERVAL': '0',
+    'METRICS_FLUSH_INTERVAL': '0',
+})
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import app as media_app # noqa: E402
+from flask import g # noqa: E402
+from flask.testing import FlaskClient # noqa: E402
+
+class FreshRequestClient(FlaskClient):
+    """Requests reuse the test's app context, so forget the user Flask-Login cached in g."""
+
+    def open(self, *args, **kwargs):
+        g.pop('_login_user', None)
+        return super().open(*args, **kwargs)
+
+media_app.app.test_client_class = FreshRequestClient
+
+_usernames = (f"user{i}" for i in itertools.count())
+
+@pytest.fixture
+def app_module():
+    with media_app.app.app_context():
+        yield media_app
+        media_app.db.session.rollback()
+
+@pytest.fixture
+def make_user(app_module):
+    """Create a user with a unique name; returns its id."""
+    def make():
+        user = app_module.User(username=next(_usernames))
+        user.set_password('secret')
+        app_module.db.session.add(user)
+        app_module.db.session.commit()
+        return user.id
+
+    return make
+
+@pytest.fixture
+def client(app_module):
+    """A test client signed in as a fresh user; its id is client.user_id."""
+    client = app_module.app.test_client()
+    username = next(_usernames)
+    response = client.post('/register', data={'username': username, 'password': 'secret'})
+    assert response.status_code == 302
+    client.user_id = app_module.db.session.scalar(
+        app_module.db.select(app_module.User.id).where(app_module.User.username == username)
+    )
+    return client
+
+@pytest.fixture
+def add_media(app_module):
+    """Insert media rows for a user, oldest first; returns their ids."""
+    db = app_module.db
+
+    def add(user_id, count, filename='track{}.mp3', start=None):
+        start = start or datetime(2024, 1, 1)
+        ids = []
+        for i in range(count):
+            media = app_module.Media(user_id=user_id, filename=filename.format(i), title=f"Track {i}",
+                                     type='audio', created_at=start + timedelta(seconds=i))
+            db.session.add(media)
+            db.session.flush()
+            ids.append(media.id)
+        app_module.bump_library_version(user_id)
+        db.session.commit()
+        return ids
+
+    return add
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def database_url(request):
+    """URL of an empty database, on each backend available."""
+    if request.param == 'sqlite':
+        yield f"sqlite:///{os.path.join(TEST_ROOT, f'{uuid.uuid4().hex}.db')}"
+        return
+    base = os.environ.get('TEST_POSTGRES_URL')
+    if not base:
+        pytest.skip('TEST_POSTGRES_URL not set')
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    admin = sa.create_engine(base)
+    with admin.begin() as conn:
+        conn.execute(sa.text(f'CREATE SCHEMA {schema}'))
+    try:
+        yield sa.make_url(base).update_query_dict({'options': f'-csearch_path={schema}'}) \
+            .render_as_string(hide_password=False)
+    finally:
+        with admin.begin() as conn:
+            conn.execute(sa.text(f'DROP SCHEMA {schema} CASCADE'))
+        admin.dispose()
+
+def start_app(database_url, script='import app'):
+    """Run script in a new process whose app uses database_url; returns its stdout.
+
+    Importing the app creates the schema and applies pending migrations.
+    """
+    env = dict(os.environ, DATABASE_URL=database_url)
+    result = subprocess.run([sys.executable, '-c', script], cwd=APP_DIR, env=env,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
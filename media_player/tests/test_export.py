@@ -0,0 +1,103 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+@pytest.fixture
+def playlist(client, app_module):
+    """A playlist "Mix: 1" with three files on disk; returns {arcname: bytes} in playlist order."""
+    names = [f"{client.user_id} first.mp3",
+             f"{client.user_id} Motörhead – Ace Of Spades.mp3",
+             f"{client.user_id} {'long title ' * 12}.mp3"] # past the 100-byte ustar name field
+    contents = {}
+    for i, name in enumerate(names):
+        data = os.urandom(3000 + i * 1500)
+        with open(os.path.join(app_module.DOWNLOAD_FOLDER, name), 'wb') as f:
+            f.write(data)
+        app_module.db.session.add(app_module.Media(user_id=client.user_id, filename=name, title=f"Song {i}",
+                                                   type='audio'))
+        contents[f"Mix_ 1/{name}"] = data
+    app_module.db.session.commit()
+
+    assert client.post('/playlists', json={'name': 'Mix: 1'}).status_code == 200
+    for name in names:
+        assert client.post('/playlists/Mix%3A%201/add', json={'filename': name}).status_code == 200
+    return contents
+
+def export(client, archive_format, headers=None):
+    return client.get(f'/playlists/Mix%3A%201/export?format={archive_format}', headers=headers or {})
+
+def test_zip_export_is_a_valid_archive(client, playlist):
+    response = export(client, 'zip')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    assert response.content_length == len(response.data)
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.testzip() is None
+        names = archive.namelist()
+        assert names == [*playlist, 'Mix_ 1/Mix_ 1.m3u8']
+        for name, data in playlist.items():
+            assert archive.read(name) == data
+        m3u = archive.read('Mix_ 1/Mix_ 1.m3u8').decode()
+    assert m3u.startswith('#EXTM3U')
+    assert [line for line in m3u.splitlines() if not line.startswith('#')] == [
+        name.split('/', 1)[1] for name in playlist
+    ]
+
+def test_tar_export_is_a_valid_archive(client, playlist):
+    response = export(client, 'tar')
+
+    assert response.status_code == 200
+    assert response.content_length == len(response.data)
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        members = archive.getmembers()
+        assert [member.name for member in members] == [*playlist, 'Mix_ 1/Mix_ 1.m3u8']
+        for name, data in playlist.items():
+            assert archive.extractfile(name).read() == data
+
+@pytest.mark.parametrize('archive_format', ['zip', 'tar'])
+def test_range_requests_resume_the_same_bytes(client, playlist, archive_format):
+    full = export(client, archive_format)
+    body, etag = full.data, full.headers['ETag']
+    assert full.headers['Accept-Ranges'] == 'bytes'
+
+    middle = export(client, archive_format, {'Range': 'bytes=100-4999'})
+    assert middle.status_code == 206
+    assert middle.headers['Content-Range'] == f"bytes 100-4999/{len(body)}"
+    assert middle.data == body[100:5000]
+
+    split = len(body) // 2
+    head = export(client, archive_format, {'Range': f'bytes=0-{split - 1}'}).data
+    tail = export(client, archive_format, {'Range': f'bytes={split}-', 'If-Range': etag})
+    assert tail.status_code == 206
+    assert head + tail.data == body
+
+def test_if_range_mismatch_sends_the_whole_archive(client, playlist):
+    body = export(client, 'zip').data
+
+    response = export(client, 'zip', {'Range': 'bytes=100-', 'If-Range': '"stale"'})
+
+    assert response.status_code == 200
+    assert response.data == body
+
+def test_changed_file_changes_the_etag(client, playlist, app_module):
+    etag = export(client, 'zip').headers['ETag']
+    first = next(iter(playlist)).split('/', 1)[1]
+    with open(os.path.join(app_module.DOWNLOAD_FOLDER, first), 'ab') as f:
+        f.write(b'more')
+
+    assert export(client, 'zip').headers['ETag'] != etag
+
+def test_unsatisfiable_range(client, playlist):
+    length = export(client, 'tar').content_length
+
+    response = export(client, 'tar', {'Range': f'bytes={length}-'})
+
+    assert response.status_code == 416
+
+def test_unknown_format_and_playlist(client, playlist):
+    assert export(client, 'rar').status_code == 400
+    assert client.get('/playlists/missing/export').status_code == 404
@@ -0,0 +1,76 @@
+def test_cursor_walks_the_library_newest_first(client, add_media):
+    ids = add_media(client.user_id, 7)
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        response = client.get('/files', query_string={'limit': 3, **({'cursor': cursor} if cursor else {})})
+        assert response.status_code == 200
+        page = response.get_json()
+        seen += [item['id'] for item in page['items']]
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert seen == ids[::-1]
+
+def test_cursor_breaks_created_at_ties_by_id(client, add_media, app_module):
+    ids = add_media(client.user_id, 4)
+    app_module.db.session.execute(
+        app_module.db.update(app_module.Media).where(app_module.Media.id.in_(ids))
+        .values(created_at=app_module.datetime(2024, 6, 1))
+    )
+    app_module.db.session.commit()
+
+    first = client.get('/files', query_string={'limit': 2}).get_json()
+    second = client.get('/files', query_string={'limit': 2, 'cursor': first['next_cursor']}).get_json()
+
+    assert [item['id'] for item in first['items'] + second['items']] == ids[::-1]
+    assert second['next_cursor'] is None
+
+def test_unchanged_library_answers_304(client, add_media):
+    add_media(client.user_id, 2)
+    first = client.get('/files')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    again = client.get('/files', headers={'If-None-Match': etag})
+
+    assert again.status_code == 304
+    assert again.headers['ETag'] == etag
+    assert again.data == b''
+
+def test_changed_library_gets_a_new_etag(client, add_media):
+    add_media(client.user_id, 2)
+    etag = client.get('/files').headers['ETag']
+    add_media(client.user_id, 1, filename='later{}.mp3')
+
+    response = client.get('/files', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(response.get_json()['items']) == 3
+
+def test_etag_differs_per_page(client, add_media):
+    add_media(client.user_id, 3)
+    first = client.get('/files', query_string={'limit': 2})
+    cursor = first.get_json()['next_cursor']
+
+    second = client.get('/files', query_string={'limit': 2, 'cursor': cursor},
+                        headers={'If-None-Match': first.headers['ETag']})
+
+    assert second.status_code == 200
+    assert len(second.get_json()['items']) == 1
+
+def test_invalid_cursor_is_rejected(client, add_media):
+    add_media(client.user_id, 1)
+    for cursor in ('not-base64!', 'Zm9v', 'MjAyNC0wMS0wMXxub3Rhbmlk'): # "foo", "2024-01-01|notanid"
+        response = client.get('/files', query_string={'cursor': cursor})
+        assert response.status_code == 400
+        assert response.get_json() == {'error': 'Invalid cursor'}
+
+def test_libraries_are_per_user(client, add_media, make_user):
+    add_media(make_user(), 3)
+
+    assert client.get('/files').get_json() == {'items': [], 'next_cursor': None}
@@ -0,0 +1,37 @@
+import os
+from datetime import datetime, timedelta
+
+def test_housekeeping_runs_with_quota_eviction_off(app_module, client, add_media, make_user):
+    assert app_module.STORAGE_EVICT_INTERVAL == 0
+    add_media(client.user_id, 1, filename=f"{client.user_id}-gone{{}}.mp3")
+    client.post('/delete', json={'filename': f"{client.user_id}-gone0.mp3"})
+    add_media(make_user(), 1) # keeps the tombstone from being the newest log row
+    db = app_module.db
+    db.session.execute(
+        db.update(app_module.ChangeLog).where(app_module.ChangeLog.user_id == client.user_id)
+        .values(changed_at=datetime.utcnow() - timedelta(seconds=app_module.SYNC_TOMBSTONE_TTL + 60))
+    )
+    db.session.commit()
+    stale = app_module.job_staging_path(987654)
+    os.makedirs(stale)
+
+    app_module.run_housekeeping()
+
+    tombstones = db.session.scalar(
+        db.select(db.func.count()).select_from(app_module.ChangeLog)
+        .where(app_module.ChangeLog.user_id == client.user_id, app_module.ChangeLog.deleted.is_(True))
+    )
+    assert tombstones == 0
+    assert not os.path.exists(stale)
+
+def test_a_failing_step_does_not_stop_the_others(app_module, monkeypatch):
+    def broken():
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(app_module, 'prune_change_log', broken)
+    stale = app_module.job_staging_path(987655)
+    os.makedirs(stale)
+
+    app_module.run_housekeeping()
+
+    assert not os.path.exists(stale)
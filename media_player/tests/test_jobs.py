@@ -0,0 +1,171 @@
+import json
+import threading
+from collections import Counter
+
+import pytest
+
+from conftest import start_app
+
+@pytest.fixture
+def queue(app_module, monkeypatch):
+    """An empty job queue with room for several claims per query."""
+    db = app_module.db
+    monkeypatch.setattr(app_module, 'DOWNLOAD_WORKERS', 4)
+    db.session.execute(db.delete(app_module.DownloadJob))
+    db.session.commit()
+
+    def enqueue(user_id, count):
+        db.session.add_all([app_module.DownloadJob(user_id=user_id, url=f"https://example.com/{i}")
+                            for i in range(count)])
+        db.session.commit()
+
+    yield enqueue
+    db.session.execute(db.delete(app_module.DownloadJob))
+    db.session.commit()
+
+def claim_concurrently(app_module, threads=8):
+    """Race `threads` workers on claim_next_job until none gets a job; returns every claimed id."""
+    claimed, errors = [], []
+    start = threading.Barrier(threads)
+
+    def worker():
+        with app_module.app.app_context():
+            start.wait()
+            try:
+                while (job_id := app_module.claim_next_job()) is not None:
+                    claimed.append(job_id)
+            except Exception as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    assert not errors
+    return claimed
+
+def test_each_job_is_claimed_once(app_module, client, queue, monkeypatch):
+    monkeypatch.setattr(app_module, 'DOWNLOAD_USER_CONCURRENCY', 0)
+    queue(client.user_id, 20)
+
+    claimed = claim_concurrently(app_module)
+
+    assert len(claimed) == 20
+    assert len(set(claimed)) == 20
+    statuses = app_module.db.session.execute(
+        app_module.db.select(app_module.DownloadJob.status, app_module.DownloadJob.attempts)
+    ).all()
+    assert set(statuses) == {(app_module.JOB_RUNNING, 1)}
+
+def test_claims_respect_user_concurrency(app_module, make_user, queue, monkeypatch):
+    monkeypatch.setattr(app_module, 'DOWNLOAD_USER_CONCURRENCY', 2)
+    user_ids = [make_user() for _ in range(3)]
+    for user_id in user_ids:
+        queue(user_id, 5)
+
+    claimed = claim_concurrently(app_module)
+
+    assert len(claimed) == len(set(claimed)) == 6
+    running = Counter(app_module.db.session.execute(
+        app_module.db.select(app_module.DownloadJob.user_id)
+        .where(app_module.DownloadJob.status == app_module.JOB_RUNNING)
+    ).scalars())
+    assert running == {user_id: 2 for user_id in user_ids}
+
+def test_event_stream_holds_no_pooled_connection(app_module, client, queue):
+    queue(client.user_id, 1)
+    job_id = app_module.db.session.scalar(app_module.db.select(app_module.DownloadJob.id))
+    app_module.db.session.remove()
+
+    response = client.get(f'/jobs/{job_id}/events', buffered=False)
+    try:
+        chunks = iter(response.response)
+        assert next(chunks).startswith(b'retry:')
+        assert b'"status": "queued"' in next(chunks)
+        assert app_module.db.engine.pool.checkedout() == 0
+    finally:
+        response.close()
+
+def test_event_stream_of_another_users_job(app_module, client, make_user, queue):
+    queue(make_user(), 1)
+    job_id = app_module.db.session.scalar(app_module.db.select(app_module.DownloadJob.id))
+
+    assert client.get(f'/jobs/{job_id}/events').status_code == 404
+    assert app_module.db.engine.pool.checkedout() == 0
+
+def test_batch_event_stream_sends_the_batch_until_it_finishes(app_module, client, make_user, queue):
+    queue(client.user_id, 2)
+    queue(make_user(), 1)
+    db = app_module.db
+    mine = db.session.execute(
+        db.select(app_module.DownloadJob.id).where(app_module.DownloadJob.user_id == client.user_id)
+    ).scalars().all()
+    theirs = db.session.scalar(
+        db.select(app_module.DownloadJob.id).where(app_module.DownloadJob.user_id != client.user_id)
+    )
+    db.session.execute(
+        db.update(app_module.DownloadJob).where(app_module.DownloadJob.id.in_(mine))
+        .values(status=app_module.JOB_DONE)
+    )
+    db.session.commit()
+
+    response = client.get(f"/jobs/events?ids={','.join(map(str, mine + [theirs]))}")
+
+    events = [json.loads(line[len(b'data: '):]) for line in response.data.split(b'\n')
+              if line.startswith(b'data: ')]
+    assert len(events) == 1 # every job already finished: one update, then the stream ends
+    assert [job['id'] for job in events[0]] == sorted(mine)
+
+def test_batch_event_stream_of_no_owned_jobs(app_module, client, make_user, queue):
+    queue(make_user(), 1)
+    job_id = app_module.db.session.scalar(app_module.db.select(app_module.DownloadJob.id))
+
+    assert client.get(f'/jobs/events?ids={job_id}').status_code == 404
+    assert client.get('/jobs/events?ids=x').status_code == 404
+
+CLAIM_RACE = """
+import json, threading
+import app
+app.DOWNLOAD_WORKERS, app.DOWNLOAD_USER_CONCURRENCY = 4, 2
+with app.app.app_context():
+    for name in ('a', 'b', 'c'):
+        user = app.User(username=name, password_hash='x')
+        app.db.session.add(user)
+        app.db.session.flush()
+        app.db.session.add_all([app.DownloadJob(user_id=user.id, url=str(i)) for i in range(5)])
+    app.db.session.commit()
+start, claimed = threading.Barrier(8), []
+def worker():
+    with app.app.app_context():
+        start.wait()
+        while (job_id := app.claim_next_job()) is not None:
+            claimed.append(job_id)
+threads = [threading.Thread(target=worker) for _ in range(8)]
+for thread in threads: thread.start()
+for thread in threads: thread.join()
+with app.app.app_context():
+    running = app.db.session.execute(
+        app.db.select(app.DownloadJob.user_id, app.db.func.count())
+        .where(app.DownloadJob.status == app.JOB_RUNNING).group_by(app.DownloadJob.user_id)
+    ).all()
+print(json.dumps({'claimed': claimed, 'running': sorted(count for _, count in running)}))
+"""
+
+def test_claims_respect_user_concurrency_on_each_backend(database_url):
+    result = json.loads(start_app(database_url, CLAIM_RACE).splitlines()[-1])
+
+    assert len(result['claimed']) == len(set(result['claimed'])) == 6
+    assert result['running'] == [2, 2, 2]
+
+@pytest.mark.parametrize('payload', [
+    {'url': 'https://example.com/a', 'type': 'x' * 50},
+    {'url': 'https://example.com/a', 'type': ['audio']},
+    {'urls': 'https://example.com/a'},
+    {'urls': [''], 'type': 'audio'},
+])
+def test_download_rejects_malformed_requests(client, queue, payload):
+    response = client.post('/download', json=payload)
+
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
@@ -0,0 +1,55 @@
+"""Migrations run in a fresh process per database, the way the app applies them at startup."""
+import sqlalchemy as sa
+
+from conftest import media_app, start_app
+
+def schema_version(conn):
+    return conn.scalar(sa.text('SELECT MAX(version) FROM schema_version'))
+
+def add_playlist(conn, name):
+    user_id = conn.scalar(sa.text("SELECT id FROM \"user\" WHERE username = 'migrator'"))
+    if user_id is None:
+        conn.execute(sa.text("INSERT INTO \"user\" (username, password_hash) VALUES ('migrator', 'x')"))
+        user_id = conn.scalar(sa.text("SELECT id FROM \"user\" WHERE username = 'migrator'"))
+    conn.execute(sa.text('INSERT INTO playlist (user_id, name) VALUES (:user_id, :name)'),
+                 {'user_id': user_id, 'name': name})
+    return conn.scalar(sa.text('SELECT seq FROM change_log WHERE entity = \'playlist\' AND entity_id = '
+                               '(SELECT id FROM playlist WHERE name = :name)'), {'name': name})
+
+def test_fresh_database_reaches_the_current_schema(database_url):
+    start_app(database_url)
+
+    engine = sa.create_engine(database_url)
+    with engine.begin() as conn:
+        assert schema_version(conn) == media_app.SCHEMA_VERSION
+        first, second = add_playlist(conn, 'one'), add_playlist(conn, 'two')
+    engine.dispose()
+    assert 0 < first < second
+
+def test_upgrade_backfills_the_change_log_and_continues_after_it(database_url):
+    start_app(database_url)
+    engine = sa.create_engine(database_url)
+    with engine.begin() as conn:
+        add_playlist(conn, 'before')
+        add_playlist(conn, 'also before')
+        # Back to a schema from before the change log (migration 9)
+        if conn.dialect.name == 'postgresql':
+            for table in media_app.CHANGE_LOG_TABLES:
+                conn.execute(sa.text(f'DROP TRIGGER change_log_{table} ON {table}'))
+            conn.execute(sa.text('DROP SEQUENCE change_log_seq'))
+        else:
+            for table in media_app.CHANGE_LOG_TABLES:
+                for suffix in ('ai', 'ad', 'au'):
+                    conn.execute(sa.text(f'DROP TRIGGER change_log_{table}_{suffix}'))
+            conn.execute(sa.text('DROP TABLE change_log_seq'))
+        conn.execute(sa.text('DELETE FROM change_log'))
+        conn.execute(sa.text('DELETE FROM schema_version WHERE version >= 9'))
+
+    start_app(database_url)
+
+    with engine.begin() as conn:
+        assert schema_version(conn) == media_app.SCHEMA_VERSION
+        backfilled = conn.execute(sa.text('SELECT entity, seq FROM change_log')).all()
+        assert [entity for entity, _ in backfilled].count('playlist') == 2
+        assert add_playlist(conn, 'after') > max(seq for _, seq in backfilled)
+    engine.dispose()
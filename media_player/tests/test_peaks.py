@@ -0,0 +1,51 @@
+import os
+import subprocess
+
+import pytest
+
+@pytest.fixture
+def track(client, app_module):
+    """A one-second tone in the library with its peaks computed; returns (media_id, filename)."""
+    filename = f"{client.user_id}-tone.wav"
+    path = os.path.join(app_module.DOWNLOAD_FOLDER, filename)
+    subprocess.run([app_module.FFMPEG_BINARY, '-v', 'error', '-y', '-f', 'lavfi', '-i', 'sine=duration=1', path],
+                   check=True)
+    media = app_module.Media(user_id=client.user_id, filename=filename, title='Tone', type='audio')
+    app_module.db.session.add(media)
+    app_module.db.session.commit()
+    app_module.run_peaks(filename)
+    assert app_module.peaks_fresh(filename)
+    return media.id, filename
+
+def listed_version(client, media_id):
+    return next(f['peaks_version'] for f in client.get('/files').get_json()['items'] if f['id'] == media_id)
+
+def test_current_version_is_immutable(client, track):
+    media_id, _ = track
+    version = listed_version(client, media_id)
+
+    response = client.get(f'/media/{media_id}/peaks?v={version}')
+
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == 365 * 24 * 3600
+    assert not response.cache_control.no_cache
+
+@pytest.mark.parametrize('query', ['', '?v=stale'])
+def test_unversioned_or_stale_url_revalidates(client, track, query):
+    media_id, _ = track
+
+    response = client.get(f'/media/{media_id}/peaks{query}')
+
+    assert response.status_code == 200
+    assert response.cache_control.no_cache
+    assert not response.cache_control.immutable
+
+def test_replaced_file_gets_a_new_version(client, track, app_module):
+    media_id, filename = track
+    version = listed_version(client, media_id)
+    with open(os.path.join(app_module.DOWNLOAD_FOLDER, filename), 'ab') as f:
+        f.write(b'\0' * 64)
+
+    assert listed_version(client, media_id) != version
+    assert client.get(f'/media/{media_id}/peaks?v={version}').status_code == 202 # recomputing
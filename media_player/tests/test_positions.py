@@ -0,0 +1,112 @@
+import random
+
+import pytest
+
+from conftest import media_app
+
+position_between = media_app.position_between
+SMALLEST = media_app._POSITION_SMALLEST
+LARGEST = 'z' + 'z' * 26
+
+def assert_valid(key):
+    assert media_app.POSITION_KEY.match(key)
+    integer = media_app._position_integer(key)
+    # A fraction ending in '0' would leave no key between it and its prefix
+    assert key == integer or not key.endswith('0')
+
+def test_first_key():
+    assert position_between(None, None) == 'a0'
+
+@pytest.mark.parametrize('start', ['a0', 'az', 'Zz', 'bzz', 'a0V'])
+def test_appending_keeps_increasing(start):
+    key = start
+    for _ in range(200):
+        following = position_between(key, None)
+        assert_valid(following)
+        assert following > key
+        key = following
+
+@pytest.mark.parametrize('start', ['a0', 'a1', 'b10', 'a0V'])
+def test_prepending_keeps_decreasing(start):
+    key = start
+    for _ in range(200):
+        preceding = position_between(None, key)
+        assert_valid(preceding)
+        assert preceding < key
+        key = preceding
+
+@pytest.mark.parametrize('a, b', [('a0', 'a1'), ('a0', 'a0V'), ('a0V', 'a1'), ('Zz', 'a0'), ('az', 'b10'),
+                                  ('a0', 'a01'), ('a0z', 'a1')])
+def test_between_neighbours(a, b):
+    key = position_between(a, b)
+    assert_valid(key)
+    assert a < key < b
+
+def test_repeated_insertion_next_to_the_same_key():
+    low, high = 'a0', 'a1'
+    for _ in range(100): # always right after low
+        high = position_between(low, high)
+        assert_valid(high)
+        assert low < high
+    low, high = 'a0', 'a1'
+    for _ in range(100): # always right before high
+        low = position_between(low, high)
+        assert_valid(low)
+        assert low < high
+
+def test_random_inserts_stay_ordered_and_unique():
+    rng = random.Random(7)
+    keys = [position_between(None, None)]
+    for _ in range(500):
+        i = rng.randrange(len(keys) + 1)
+        key = position_between(keys[i - 1] if i else None, keys[i] if i < len(keys) else None)
+        assert_valid(key)
+        keys.insert(i, key)
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+
+def test_ends_of_the_integer_range_fall_back_to_fractions():
+    after_largest = position_between(LARGEST, None)
+    assert after_largest > LARGEST and after_largest.startswith(LARGEST)
+    before_smallest = position_between(None, SMALLEST + 'V')
+    assert before_smallest < SMALLEST + 'V' and before_smallest.startswith(SMALLEST)
+
+def test_nothing_sorts_before_the_smallest_key():
+    with pytest.raises(ValueError):
+        position_between(None, SMALLEST)
+
+@pytest.mark.parametrize('a, b', [('a1', 'a1'), ('a2', 'a1')])
+def test_out_of_order_bounds_raise(a, b):
+    with pytest.raises(ValueError):
+        position_between(a, b)
+
+def test_truncated_key_raises():
+    with pytest.raises(ValueError):
+        position_between('c1', None)
+
+def test_moves_reorder_a_playlist(client, add_media):
+    ids = add_media(client.user_id, 4, filename=f"{client.user_id}-move{{}}.mp3")
+    client.post('/playlists', json={'name': 'order'})
+    client.post('/playlists/order/items', json={'add': ids})
+
+    def order():
+        return [item['id'] for item in client.get('/playlists/order/items').get_json()['items']]
+
+    assert order() == ids
+    assert client.post('/playlists/order/move', json={'id': ids[3], 'after': None}).status_code == 200
+    assert order() == [ids[3], ids[0], ids[1], ids[2]]
+    assert client.post('/playlists/order/move', json={'id': ids[0], 'after': ids[1]}).status_code == 200
+    assert order() == [ids[3], ids[1], ids[0], ids[2]]
+    assert client.post('/playlists/order/move', json={'id': ids[3], 'after': ids[2]}).status_code == 200
+    assert order() == [ids[1], ids[0], ids[2], ids[3]]
+    assert client.post('/playlists/order/move', json={'id': ids[1], 'after': ids[1]}).status_code == 400
+
+@pytest.mark.parametrize('body', [{'add': '12'}, {'add': 3}, {'remove': 'abc'}, {'remove': {'1': 2}},
+                                  {'add': ['1']}, {'add': [1.5]}, {'remove': [True]}, [1, 2]])
+def test_bulk_update_rejects_anything_but_lists_of_ids(client, body):
+    client.post('/playlists', json={'name': 'bulk'})
+
+    response = client.post('/playlists/bulk/items', json=body)
+
+    assert response.status_code == 400
+    assert client.get('/playlists/bulk/items').get_json()['items'] == []
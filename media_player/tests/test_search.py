@@ -0,0 +1,42 @@
+import os
+import subprocess
+
+import pytest
+
+def search(client, q):
+    return [item['title'] for item in client.get('/search', query_string={'q': q}).get_json()['items']]
+
+@pytest.fixture
+def like_backend(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, '_search_backend', 'like')
+
+def test_every_term_matches_as_a_prefix(client, add_media, app_module):
+    ids = add_media(client.user_id, 2, filename=f"{client.user_id}-prefix{{}}.mp3")
+    for media_id, title in zip(ids, ['Bohemian Rhapsody', 'Rhapsody in Blue']):
+        app_module.db.session.get(app_module.Media, media_id).title = title
+    app_module.db.session.commit()
+
+    assert search(client, 'boh rhap') == ['Bohemian Rhapsody']
+    assert sorted(search(client, 'rhap')) == ['Bohemian Rhapsody', 'Rhapsody in Blue']
+
+def test_like_fallback_treats_underscore_literally(client, add_media, app_module, like_backend):
+    ids = add_media(client.user_id, 2, filename=f"{client.user_id}-like{{}}.mp3")
+    for media_id, title in zip(ids, ['snake_case', 'snakeXcase']):
+        app_module.db.session.get(app_module.Media, media_id).title = title
+    app_module.db.session.commit()
+
+    assert search(client, 'snake_case') == ['snake_case']
+
+def test_synced_file_is_titled_from_its_tags(client, app_module):
+    filename = f"{client.user_id}-tagged.mp3"
+    subprocess.run([app_module.FFMPEG_BINARY, '-v', 'error', '-y', '-f', 'lavfi', '-i', 'sine=duration=1',
+                    '-metadata', 'title=Héllo Wörld', '-metadata', 'album_artist=The Band',
+                    os.path.join(app_module.DOWNLOAD_FOLDER, filename)], check=True)
+
+    assert client.post('/files/sync').status_code == 200
+
+    media = app_module.db.session.scalar(app_module.db.select(app_module.Media).where(
+        app_module.Media.filename == filename))
+    assert media.title == 'Héllo Wörld'
+    assert 'The Band' in media.tags
+    assert search(client, 'hello') == ['Héllo Wörld']
@@ -0,0 +1,95 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+@contextmanager
+def count_queries(app_module):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(app_module.db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(app_module.db.engine, 'before_cursor_execute', record)
+
+@pytest.fixture
+def cold_cache(app_module):
+    with app_module._user_cache_lock:
+        app_module._user_cache.clear()
+
+def test_warm_identity_needs_no_query(client, app_module, cold_cache):
+    with count_queries(app_module) as cold:
+        assert app_module.load_user(f"{client.user_id}:0").id == client.user_id
+    with count_queries(app_module) as warm:
+        assert app_module.load_user(f"{client.user_id}:0").id == client.user_id
+
+    assert len(cold) == 1
+    assert warm == []
+
+def test_warm_request_runs_only_the_endpoints_queries(client, app_module):
+    client.get('/usage')
+    with count_queries(app_module) as statements:
+        assert client.get('/usage').status_code == 200
+
+    assert len(statements) == 1 # the usage lookup itself
+
+def test_invalidation_from_another_worker_reloads(client, app_module, cold_cache):
+    app_module.load_user(f"{client.user_id}:0")
+    with open(app_module.SESSION_INVALIDATION_LOG, 'a') as log: # what another process's invalidate_user writes
+        log.write(f"{client.user_id}\n")
+
+    with count_queries(app_module) as statements:
+        assert app_module.load_user(f"{client.user_id}:0") is not None
+
+    assert len(statements) == 1
+
+def test_partial_log_line_waits_for_the_rest(client, app_module, cold_cache):
+    app_module.load_user(f"{client.user_id}:0")
+    with open(app_module.SESSION_INVALIDATION_LOG, 'a') as log:
+        log.write(str(client.user_id))
+        log.flush()
+        with count_queries(app_module) as before:
+            app_module.load_user(f"{client.user_id}:0")
+        log.write('\n')
+    with count_queries(app_module) as after:
+        app_module.load_user(f"{client.user_id}:0")
+
+    assert before == []
+    assert len(after) == 1
+
+def test_password_change_signs_out_other_sessions(client, app_module):
+    other = app_module.app.test_client()
+    username = app_module.db.session.get(app_module.User, client.user_id).username
+    other.post('/login', data={'username': username, 'password': 'secret'})
+    assert other.get('/usage').status_code == 200
+
+    response = client.post('/account/password', json={'current_password': 'secret', 'new_password': 'changed'})
+
+    assert response.status_code == 200
+    assert client.get('/usage').status_code == 200
+    assert other.get('/usage').status_code == 302 # back to the login page
+
+def test_newer_session_version_than_cached_reloads(client, app_module, cold_cache):
+    app_module.load_user(f"{client.user_id}:0")
+    app_module.db.session.execute(
+        app_module.db.update(app_module.User).where(app_module.User.id == client.user_id)
+        .values(session_version=1)
+    )
+    app_module.db.session.commit() # changed by a worker whose signal never reached this one
+
+    assert app_module.load_user(f"{client.user_id}:1").session_version == 1
+    assert app_module.load_user(f"{client.user_id}:0") is None
+
+def test_logout_drops_the_cached_identity(client, app_module):
+    client.get('/usage')
+    assert client.user_id in app_module._user_cache
+
+    client.get('/logout')
+
+    assert client.user_id not in app_module._user_cache
+    with open(app_module.SESSION_INVALIDATION_LOG) as log:
+        assert str(client.user_id) in log.read().split()
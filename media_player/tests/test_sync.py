@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+def pull(client, since=0, limit=None):
+    """Follow /sync/changes from `since` to the end; returns (pages, final cursor)."""
+    pages = []
+    while True:
+        query = {'since': since, **({'limit': limit} if limit else {})}
+        page = client.get('/sync/changes', query_string=query).get_json()
+        pages.append(page)
+        since = page['cursor']
+        if not page['has_more']:
+            return pages, since
+
+def media_ids(pages):
+    return {media['id'] for page in pages for media in page['media']}
+
+def deleted_media(pages):
+    return {media_id for page in pages for media_id in page['deleted']['media']}
+
+@pytest.fixture
+def expire_tombstones(app_module):
+    """Age every tombstone past SYNC_TOMBSTONE_TTL and prune; returns the rows pruned."""
+    def expire():
+        db = app_module.db
+        db.session.execute(
+            db.update(app_module.ChangeLog).where(app_module.ChangeLog.deleted.is_(True))
+            .values(changed_at=datetime.utcnow() - timedelta(seconds=app_module.SYNC_TOMBSTONE_TTL + 60))
+        )
+        db.session.commit()
+        return app_module.prune_change_log()
+
+    return expire
+
+def test_incremental_pull_reports_deletions(client, add_media):
+    ids = add_media(client.user_id, 3)
+    pages, cursor = pull(client)
+    assert media_ids(pages) == set(ids)
+
+    assert client.post('/delete', json={'filename': 'track0.mp3'}).status_code == 200
+    pages, _ = pull(client, cursor)
+
+    assert deleted_media(pages) == {ids[0]}
+    assert not pages[0]['reset']
+
+def test_cursor_older_than_the_prune_resets(client, add_media, expire_tombstones):
+    ids = add_media(client.user_id, 3)
+    _, stale_cursor = pull(client)
+    client.post('/delete', json={'filename': 'track0.mp3'})
+    client.post('/delete', json={'filename': 'track1.mp3'})
+    later = add_media(client.user_id, 1, filename='after{}.mp3')
+    assert expire_tombstones() >= 2
+
+    pages, _ = pull(client, stale_cursor)
+
+    assert pages[0]['reset']
+    assert media_ids(pages) == {ids[2], *later}
+    assert deleted_media(pages) == set()
+
+def test_full_copy_cursor_survives_a_later_prune(client, add_media, make_user, expire_tombstones):
+    add_media(client.user_id, 3)
+    client.post('/delete', json={'filename': 'track0.mp3'})
+    add_media(make_user(), 1) # the tombstone is no longer the newest log row, so it is pruned
+    _, cursor = pull(client)
+    assert expire_tombstones() >= 1
+
+    pages, _ = pull(client, cursor)
+
+    assert not pages[0]['reset']
+    assert media_ids(pages) == set()
+
+def test_sequence_numbers_are_not_reused_after_a_prune(client, add_media, expire_tombstones):
+    add_media(client.user_id, 2)
+    client.post('/delete', json={'filename': 'track0.mp3'})
+    client.post('/delete', json={'filename': 'track1.mp3'}) # the newest log row is now a tombstone
+    _, cursor = pull(client)
+    expire_tombstones()
+
+    ids = add_media(client.user_id, 1, filename='after{}.mp3')
+    pages, _ = pull(client, cursor)
+
+    assert not pages[0]['reset']
+    assert media_ids(pages) == set(ids)
+    assert pages[-1]['cursor'] > cursor